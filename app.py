@@ -1,17 +1,35 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
-from openai import OpenAI
+from flask import Flask, request, jsonify, render_template, send_from_directory, send_file, Response, abort, make_response, g, has_request_context
 import os
 import base64
-from datetime import datetime
+from datetime import datetime, date, timedelta, timezone
+from zoneinfo import ZoneInfo
 import json
 import uuid
 import logging
 from functools import wraps
+from urllib.parse import quote
 import time
+import io
+import csv
+import math
+import threading
+import weakref
+from collections import deque
+from contextlib import contextmanager
 from celery import Celery
+from celery.schedules import crontab
+from celery.signals import task_prerun, task_postrun
 import redis
+import random
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+from blob_store import TieredBlobStore, create_blob_store, detect_image_mimetype, is_valid_key, blob_key
+from image_pipeline import normalize_image, make_thumbnail
+from metrics import MetricsRecorder, ErrorLogHandler, PROCESS_STARTED_AT
+from migrations import HISTORY_SEARCH_EXPRESSION, SCHOOL_TIMEZONE
+from partitions import PARTITION_KEYS, PARTITION_MONTHS_AHEAD, ensure_partitions, expired_partitions, is_partitioned, retire_partition
+from resilience import CircuitBreaker, CircuitOpenError, InvalidInputError, is_retryable, retry_countdown, user_error_message
 
 # ... (既存のコードは変更なし) ...
 # ログ設定
@@ -38,187 +56,1523 @@ celery = Celery(
 )
 celery.conf.update(
     broker_connection_retry_on_startup=True,
+    # 解析タスクはほぼOpenAIの応答待ちなので、threads プールなら1プロセスで多数を並行処理できる
+    # （prefork は1タスク1プロセス）。同時実行数は CELERY_WORKER_CONCURRENCY で指定する。
+    worker_pool=os.getenv('CELERY_WORKER_POOL', 'prefork'),
+    worker_prefetch_multiplier=1,
 )
+if os.getenv('CELERY_WORKER_CONCURRENCY'):
+    celery.conf.worker_concurrency = int(os.getenv('CELERY_WORKER_CONCURRENCY'))
+
+# キュー
+# 初回の解析・再質問・後回しにできる処理（リトライ、書き起こし、定期処理）を分ける。
+# ワーカーは -Q re_question,analysis,background のように並べた順に優先して取り出す。
+ANALYSIS_QUEUE = 'analysis'
+REQUESTION_QUEUE = 're_question'
+BACKGROUND_QUEUE = 'background'
+TASK_QUEUES = (REQUESTION_QUEUE, ANALYSIS_QUEUE, BACKGROUND_QUEUE)
+celery.conf.update(
+    task_default_queue=BACKGROUND_QUEUE,
+    broker_transport_options={'queue_order_strategy': 'priority'},
+)
+
+# 受付制御
+# キューの長さと1タスクあたりの平均処理時間から待ち時間を見積もり、
+# クライアントが待つ時間内に終わりそうにない解析は受け付けずに503を返す。
+QUEUE_WORKER_SLOTS = int(os.getenv('QUEUE_WORKER_SLOTS', 16))
+QUEUE_MAX_DEPTH = int(os.getenv('QUEUE_MAX_DEPTH', 1000))
+QUEUE_STATS_KEY = "queue_stats"
+# 実績がまだないときの1タスクあたりの処理時間（秒）
+DEFAULT_TASK_SECONDS = {ANALYSIS_QUEUE: 30.0, REQUESTION_QUEUE: 10.0, BACKGROUND_QUEUE: 10.0}
+# クライアントが結果を待つ時間（秒）。これを過ぎたタスクは実行しない
+TASK_DEFAULT_DEADLINE = 240
+TASK_MAX_DEADLINE = 600
+QUEUE_EWMA_SCRIPT = redis_client.register_script("""
+local avg = tonumber(redis.call('HGET', KEYS[1], ARGV[1]))
+local value = tonumber(ARGV[2])
+if avg then
+    value = avg + tonumber(ARGV[3]) * (value - avg)
+end
+redis.call('HSET', KEYS[1], ARGV[1], value)
+return tostring(value)
+""")
+
+def record_queue_task_seconds(queue, seconds):
+    """キューごとの平均処理時間（指数移動平均）を更新する"""
+    QUEUE_EWMA_SCRIPT(keys=[QUEUE_STATS_KEY], args=[queue, seconds, 0.1])
+
+def get_queue_stats():
+    """キューごとの長さ・平均処理時間・待ち時間の見積もり
+
+    優先度の高いキューは先に取り出されるので、待ち時間にはそれより前のキューの仕事量も含める。
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for queue in TASK_QUEUES:
+        pipe.llen(queue)
+    pipe.hgetall(QUEUE_STATS_KEY)
+    *depths, averages = pipe.execute()
+    stats = {}
+    work_ahead = 0.0
+    for queue, depth in zip(TASK_QUEUES, depths):
+        task_seconds = float(averages.get(queue) or DEFAULT_TASK_SECONDS[queue])
+        work_ahead += depth * task_seconds
+        stats[queue] = {
+            "depth": depth,
+            "avg_task_seconds": round(task_seconds, 2),
+            "estimated_wait_seconds": round(work_ahead / QUEUE_WORKER_SLOTS, 1),
+        }
+    return stats
+
+def check_admission(queue, deadline_seconds):
+    """キューが混んでいて期限内に終わらない見込みなら503のレスポンスを返す"""
+    try:
+        stats = get_queue_stats()[queue]
+    except Exception as e:
+        logger.warning(f"Could not read queue stats: {e}")
+        return None
+    finishes_in = stats["estimated_wait_seconds"] + stats["avg_task_seconds"]
+    if stats["depth"] < QUEUE_MAX_DEPTH and finishes_in <= deadline_seconds:
+        return None
+    retry_after = max(1, math.ceil(stats["estimated_wait_seconds"]))
+    logger.warning(f"Rejected {queue} task: depth={stats['depth']} estimated_wait={stats['estimated_wait_seconds']}s")
+    response = jsonify({
+        "error": f"ただいま混み合っています。約{retry_after}秒後にもう一度お試しください。",
+        "queue_depth": stats["depth"],
+        "estimated_wait_seconds": stats["estimated_wait_seconds"],
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def request_deadline():
+    """クライアントが指定した待ち時間（deadline_seconds）を期限の時刻に直す"""
+    try:
+        seconds = float(_request_param('deadline_seconds', TASK_DEFAULT_DEADLINE))
+    except (TypeError, ValueError):
+        seconds = TASK_DEFAULT_DEADLINE
+    seconds = min(max(seconds, 30), TASK_MAX_DEADLINE)
+    return seconds, time.time() + seconds
+
+# メトリクス（全ワーカーの値をRedisの時間バケットに集計する）
+metrics = MetricsRecorder(redis_client)
+MONITORING_TOKEN = os.getenv('MONITORING_TOKEN')
+
+def _current_endpoint():
+    # request.path はクライアントが自由に決められるので、ルートのパターンだけを記録する
+    if not has_request_context():
+        return None
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+logging.getLogger().addHandler(ErrorLogHandler(metrics, _current_endpoint))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.record_request(endpoint, time.perf_counter() - started, response.status_code)
+    return response
+
+_task_started = {}
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+@task_postrun.connect
+def record_task_metrics(task_id=None, task=None, state=None, retval=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        seconds = time.perf_counter() - started
+        metrics.record_task(task.name, seconds, failed=state not in ('SUCCESS', None))
+        # 期限切れで実行しなかったタスクは平均処理時間に含めない
+        if state == 'SUCCESS' and not (isinstance(retval, dict) and retval.get('expired')):
+            try:
+                record_queue_task_seconds(getattr(task, 'queue', None) or BACKGROUND_QUEUE, seconds)
+            except Exception as e:
+                logger.warning(f"Could not record queue stats: {e}")
 
 # OpenAIクライアント
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# スレッド間で共有し、httpxのコネクションプールでTLS接続を使い回す。
+# openai と httpx の import とクライアントの構築は最初の呼び出しまで遅らせ（起動時間の大半を占めるため）、
+# fork した子プロセスでは親の接続を使わずに作り直す。
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 100))
 
-# レート制限用のデコレーター
-def rate_limit(max_calls=10, period=60):
-    calls = {}
-    
+class OpenAIClient:
+    """プロセスごとに1つだけ OpenAI クライアントを作って返す"""
+    def __init__(self):
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import httpx
+                    from openai import OpenAI
+                    # リトライはタスク側で分類して行うので、クライアント内では再試行しない（既定値0）
+                    self._client = OpenAI(
+                        api_key=os.getenv("OPENAI_API_KEY"),
+                        max_retries=int(os.getenv('OPENAI_MAX_RETRIES', 0)),
+                        http_client=httpx.Client(limits=httpx.Limits(
+                            max_connections=OPENAI_MAX_CONNECTIONS,
+                            max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                        )),
+                    )
+        return self._client
+
+openai_client = OpenAIClient()
+
+# 上流が不調なときは呼び出しを即座に失敗させ、ワーカーの枠をタイムアウト待ちで埋めない
+openai_circuit = CircuitBreaker(
+    redis_client, 'openai',
+    window=int(os.getenv('OPENAI_CIRCUIT_WINDOW', 30)),
+    min_calls=int(os.getenv('OPENAI_CIRCUIT_MIN_CALLS', 10)),
+    failure_ratio=float(os.getenv('OPENAI_CIRCUIT_FAILURE_RATIO', 0.5)),
+    cooldown=int(os.getenv('OPENAI_CIRCUIT_COOLDOWN', 30)),
+)
+
+# OpenAIへの同時リクエスト数の上限（全ワーカー合計、0で無制限）
+# Redisのソート済みセットを期限付きのセマフォとして使う。プロセスが落ちても
+# OPENAI_SLOT_LEASE 秒で枠が戻る。
+OPENAI_GLOBAL_CONCURRENCY = int(os.getenv('OPENAI_GLOBAL_CONCURRENCY', 0))
+OPENAI_SLOT_LEASE = 180
+OPENAI_SLOT_WAIT = float(os.getenv('OPENAI_SLOT_WAIT', 60))
+OPENAI_SEMAPHORE_KEY = "openai_semaphore"
+OPENAI_SEMAPHORE_SCRIPT = redis_client.register_script("""
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[4])
+    return 1
+end
+return 0
+""")
+
+class OpenAISlotTimeout(RuntimeError):
+    """OpenAIの同時リクエスト枠が空かなかった"""
+
+@contextmanager
+def openai_slot():
+    """全ワーカー共通のOpenAI同時リクエスト枠を1つ確保する"""
+    if OPENAI_GLOBAL_CONCURRENCY <= 0:
+        yield
+        return
+    token = uuid.uuid4().hex
+    started = time.monotonic()
+    delay = 0.05
+    while not OPENAI_SEMAPHORE_SCRIPT(
+        keys=[OPENAI_SEMAPHORE_KEY],
+        args=[time.time(), OPENAI_GLOBAL_CONCURRENCY, OPENAI_SLOT_LEASE, token],
+    ):
+        if time.monotonic() - started > OPENAI_SLOT_WAIT:
+            raise OpenAISlotTimeout("OpenAIの同時リクエスト数の上限に達しています")
+        time.sleep(delay + random.uniform(0, delay))
+        delay = min(delay * 2, 1.0)
+    metrics.observe('openai_slot_wait', 'global', time.monotonic() - started)
+    try:
+        yield
+    finally:
+        redis_client.zrem(OPENAI_SEMAPHORE_KEY, token)
+
+# 画像ブロブストア（SHA-256キーで生バイトを保存）
+# COLD_BLOB_STORE_BACKEND を設定すると、古い履歴の画像を保存期間の安いストアへ移す（maintain_partitions）
+blob_store = create_blob_store()
+if os.getenv('COLD_BLOB_STORE_BACKEND'):
+    blob_store = TieredBlobStore(blob_store, create_blob_store('COLD_BLOB_STORE'))
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600
+
+def image_url(image_key):
+    """ブロブキーから画像配信URLを作る"""
+    return f"/image/{image_key}"
+
+def load_history_image(row):
+    """履歴行の画像バイトを取得する（未移行の行は image_base64 から復元）"""
+    if row['image_key']:
+        return blob_store.get(row['image_key'])
+    return base64.b64decode(row['image_base64'])
+
+# アップロード画像のステージング
+# Celeryのメッセージには画像本体ではなく参照文字列だけを載せる。
+# redis: Webとワーカーで共有できるRedisにTTL付きで保存（デフォルト）
+# blob:  ブロブストアの staging/<task_id> に保存（共有ディスクやS3を使う場合）。
+#        同じ画像のタスクどうしで共有しないよう、内容ではなくタスクIDをキーにする。
+#        片付け損ねたものは purge_staged_uploads が UPLOAD_STAGING_TTL を過ぎたら消す
+UPLOAD_STAGING_BACKEND = os.getenv('UPLOAD_STAGING_BACKEND', 'redis')
+UPLOAD_STAGING_TTL = int(os.getenv('UPLOAD_STAGING_TTL', 6 * 3600))
+redis_binary_client = redis.from_url(REDIS_URL)
+
+def stage_upload(task_id, image_data):
+    """アップロード画像を一度だけ保存し、タスクに渡す参照を返す"""
+    if UPLOAD_STAGING_BACKEND == 'blob':
+        blob_store.put_staged(task_id, image_data)
+        return f"staged:{task_id}"
+    staging_key = f"upload:{task_id}"
+    redis_binary_client.setex(staging_key, UPLOAD_STAGING_TTL, image_data)
+    return f"redis:{staging_key}"
+
+def load_staged_upload(image_ref):
+    """参照からステージング済みの画像バイトを読み出す"""
+    scheme, _, name = image_ref.partition(':')
+    if scheme == 'staged':
+        return blob_store.get_staged(name)
+    if scheme == 'blob':
+        # 以前の形式（コンテンツアドレスのブロブ）で積まれたタスク
+        return blob_store.get(name)
+    if scheme == 'redis':
+        image_data = redis_binary_client.get(name)
+        if image_data is None:
+            raise FileNotFoundError(f"ステージングされた画像が見つかりません: {image_ref}")
+        return image_data
+    raise InvalidInputError(f"不正な画像参照です: {image_ref}")
+
+def discard_staged_upload(image_ref):
+    """ステージングした画像を片付ける
+
+    以前の形式の blob: 参照は他のタスクや履歴と共有されうるコンテンツアドレスなので消さない。
+    """
+    scheme, _, name = image_ref.partition(':')
+    try:
+        if scheme == 'redis':
+            redis_binary_client.delete(name)
+        elif scheme == 'staged':
+            blob_store.delete_staged(name)
+    except Exception as e:
+        logger.error(f"Error discarding staged upload {image_ref}: {e}")
+
+# 解説キャッシュ
+# 同じ問題の画像が何度もアップロードされるので、正規化後の画像の
+# SHA-256（完全一致）と知覚ハッシュ（ほぼ一致）で過去の解説を再利用する。
+# プロンプトを変更したら PROMPT_VERSION を上げて古いキャッシュを無効にすること。
+PROMPT_VERSION = 1
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true') == 'true'
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 30 * 24 * 3600))
+# ほぼ一致とみなす知覚ハッシュのハミング距離（既定の0ではほぼ一致の検索をせず、完全一致だけを使う）。
+# 同じ書式のプリントは別の問題でもハッシュが近く、別の問題の解説を返してしまうので、
+# 有効にするときは実際の画像で bench_image_pipeline.py --phash を実行し、
+# 別の問題どうしの最小距離より小さい値にすること。
+PHASH_MAX_DISTANCE = int(os.getenv('PHASH_MAX_DISTANCE', 0))
+
+def _phash_bands(phash):
+    """64ビットのハッシュを PHASH_MAX_DISTANCE + 1 個の帯に分割する
+
+    距離が PHASH_MAX_DISTANCE 以下なら、鳩の巣原理で少なくとも1つの帯は完全に一致する。
+    """
+    count = PHASH_MAX_DISTANCE + 1
+    width = 64 // count
+    bands = []
+    for i in range(count):
+        shift = i * width
+        bits = 64 - shift if i == count - 1 else width
+        bands.append((i, (phash >> shift) & ((1 << bits) - 1)))
+    return bands
+
+def _result_cache_prefix(grade_level):
+    return f"result_cache:v{PROMPT_VERSION}:{grade_level}"
+
+def _prune_phash(prefix, phash_hex):
+    pipe = redis_client.pipeline()
+    for band, value in _phash_bands(int(phash_hex, 16)):
+        pipe.srem(f"{prefix}:band:{band}:{value:x}", phash_hex)
+    pipe.execute()
+
+def get_cached_explanation(content_hash, phash, grade_level):
+    """キャッシュ済みの解説を (解説, 'exact'|'near') で返す。なければ (None, None)"""
+    if not RESULT_CACHE_ENABLED:
+        return None, None
+    prefix = _result_cache_prefix(grade_level)
+    try:
+        exact_key = f"{prefix}:exact:{content_hash}"
+        explanation = redis_client.get(exact_key)
+        if explanation is not None:
+            redis_client.expire(exact_key, RESULT_CACHE_TTL)
+            redis_client.incr("result_cache:hits:exact")
+            return explanation, 'exact'
+
+        if PHASH_MAX_DISTANCE > 0:
+            pipe = redis_client.pipeline()
+            for band, value in _phash_bands(phash):
+                pipe.smembers(f"{prefix}:band:{band}:{value:x}")
+            candidates = set().union(*pipe.execute())
+            matches = []
+            for candidate in candidates:
+                distance = bin(int(candidate, 16) ^ phash).count('1')
+                if distance <= PHASH_MAX_DISTANCE:
+                    matches.append((distance, candidate))
+            matches.sort()
+            for _, candidate in matches:
+                near_key = f"{prefix}:phash:{candidate}"
+                explanation = redis_client.get(near_key)
+                if explanation is not None:
+                    redis_client.expire(near_key, RESULT_CACHE_TTL)
+                    redis_client.incr("result_cache:hits:near")
+                    return explanation, 'near'
+                # 解説が期限切れで消えたハッシュは帯からも取り除く（帯のTTLは追加のたびに延びるので残り続ける）
+                _prune_phash(prefix, candidate)
+
+        redis_client.incr("result_cache:misses")
+    except Exception as e:
+        logger.error(f"Error reading result cache: {e}")
+    return None, None
+
+def store_cached_explanation(content_hash, phash, grade_level, explanation):
+    """解説をキャッシュに保存する（TTLで期限切れ、Redisのallkeys-lruでも追い出される）"""
+    if not RESULT_CACHE_ENABLED:
+        return
+    prefix = _result_cache_prefix(grade_level)
+    phash_hex = f"{phash:016x}"
+    try:
+        pipe = redis_client.pipeline()
+        pipe.setex(f"{prefix}:exact:{content_hash}", RESULT_CACHE_TTL, explanation)
+        if PHASH_MAX_DISTANCE > 0:
+            pipe.setex(f"{prefix}:phash:{phash_hex}", RESULT_CACHE_TTL, explanation)
+            for band, value in _phash_bands(phash):
+                band_key = f"{prefix}:band:{band}:{value:x}"
+                pipe.sadd(band_key, phash_hex)
+                pipe.expire(band_key, RESULT_CACHE_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error writing result cache: {e}")
+
+def get_result_cache_stats():
+    """キャッシュのヒット/ミス数と節約できたAPI呼び出し数"""
+    exact, near, misses = redis_client.mget(
+        "result_cache:hits:exact", "result_cache:hits:near", "result_cache:misses"
+    )
+    exact, near, misses = int(exact or 0), int(near or 0), int(misses or 0)
+    lookups = exact + near + misses
+    return {
+        "hits_exact": exact,
+        "hits_near": near,
+        "misses": misses,
+        "hit_rate": (exact + near) / lookups if lookups else 0.0,
+        "api_calls_saved": exact + near,
+    }
+
+# レート制限
+# 全ワーカーで共有するため、Redisのソート済みセットでスライディングウィンドウを管理する。
+# 判定と記録は1回のLuaスクリプト実行でアトミックに行う。
+RATE_LIMIT_SCRIPT = redis_client.register_script("""
+local now = tonumber(ARGV[1])
+local member = ARGV[2]
+local allowed = 1
+local remaining = -1
+local retry_after = 0
+local limit_out = 0
+local limit_index = 1
+for i, key in ipairs(KEYS) do
+    local limit = tonumber(ARGV[1 + i * 2])
+    local period = tonumber(ARGV[2 + i * 2])
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - period)
+    local left = limit - redis.call('ZCARD', key)
+    if left <= 0 then
+        allowed = 0
+        local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+        local wait = period
+        if oldest[2] then
+            wait = tonumber(oldest[2]) + period - now
+        end
+        if wait > retry_after then
+            retry_after = wait
+        end
+    end
+    if remaining < 0 or left < remaining then
+        remaining = left
+        limit_out = limit
+        limit_index = i
+    end
+end
+if allowed == 1 then
+    for i, key in ipairs(KEYS) do
+        redis.call('ZADD', key, now, member)
+        redis.call('PEXPIRE', key, tonumber(ARGV[2 + i * 2]))
+    end
+    remaining = remaining - 1
+    -- 残り回数の基準になったウィンドウで、最も古い記録が期限切れになって枠が1つ戻るまでの時間
+    local oldest = redis.call('ZRANGE', KEYS[limit_index], 0, 0, 'WITHSCORES')
+    retry_after = tonumber(oldest[2]) + tonumber(ARGV[2 + limit_index * 2]) - now
+end
+return {allowed, remaining, retry_after, limit_out}
+""")
+
+class LocalRateLimiter:
+    """Redisに接続できないときのプロセス内フォールバック
+
+    ウィンドウが空になったキーは削除するので、ユーザーが増え続けてもメモリは増えない。
+    """
+
+    def __init__(self):
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def check(self, rules, now):
+        with self._lock:
+            if now - self._last_sweep > 60:
+                self._sweep(now)
+            allowed, remaining, retry_after, limit_out = True, None, 0.0, 0
+            limit_window = limit_period = None
+            for key, limit, period in rules:
+                window = self._windows.setdefault(key, deque())
+                while window and window[0] <= now - period:
+                    window.popleft()
+                left = limit - len(window)
+                if left <= 0:
+                    allowed = False
+                    retry_after = max(retry_after, window[0] + period - now)
+                if remaining is None or left < remaining:
+                    remaining, limit_out = left, limit
+                    limit_window, limit_period = window, period
+            if allowed:
+                for key, _, _ in rules:
+                    self._windows[key].append(now)
+                remaining -= 1
+                retry_after = limit_window[0] + limit_period - now
+            return allowed, max(remaining, 0), retry_after, limit_out
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        # 1時間以上記録のないキーは削除する
+        for key in [k for k, w in self._windows.items() if not w or w[-1] <= now - 3600]:
+            del self._windows[key]
+
+local_rate_limiter = LocalRateLimiter()
+
+def check_rate_limit(rules):
+    """rules: [(キー, 回数, 期間秒), ...] をすべて満たすか判定し、満たせば記録する
+
+    (許可, 残り回数, 枠が戻るまでの秒数, 残り回数の基準になった上限) を返す。
+    枠が戻るまでの秒数は、拒否したときは再試行できるまで、許可したときは
+    基準になったウィンドウの最も古い記録が期限切れになるまでの秒数。
+    """
+    now = time.time()
+    try:
+        keys = [key for key, _, _ in rules]
+        args = [int(now * 1000), f"{now}-{uuid.uuid4().hex[:8]}"]
+        for _, limit, period in rules:
+            args.extend([limit, int(period * 1000)])
+        allowed, remaining, retry_after_ms, limit_out = RATE_LIMIT_SCRIPT(keys=keys, args=args)
+        return bool(allowed), max(int(remaining), 0), int(retry_after_ms) / 1000, int(limit_out)
+    except redis.RedisError as e:
+        logger.warning(f"Rate limiter falling back to in-process counters: {e}")
+        return local_rate_limiter.check(rules, now)
+
+def _request_param(name, default):
+    """フォーム・クエリ・JSONボディの順にパラメーターを探す"""
+    value = request.form.get(name, request.args.get(name))
+    if value is None and request.is_json:
+        value = (request.get_json(silent=True) or {}).get(name)
+    return value or default
+
+def rate_limit(max_calls=10, period=60, school_max_calls=None):
+    """ユーザーごと（と学校ごと）のリクエスト数をルート単位で制限するデコレーター"""
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            user_id = request.form.get('user_id', request.args.get('user_id', 'default_user'))
-            now = time.time()
-            
-            if user_id not in calls:
-                calls[user_id] = []
+            user_id = _request_param('user_id', 'default_user')
+            rules = [(f"rate_limit:{f.__name__}:user:{user_id}", max_calls, period)]
+            if school_max_calls:
+                school_id = _request_param('school_id', 'default_school')
+                rules.append((f"rate_limit:{f.__name__}:school:{school_id}", school_max_calls, period))
             
-            calls[user_id] = [call_time for call_time in calls[user_id] if call_time > now - period]
+            allowed, remaining, retry_after, limit = check_rate_limit(rules)
+            headers = {
+                'X-RateLimit-Limit': str(limit),
+                'X-RateLimit-Remaining': str(remaining),
+                'X-RateLimit-Reset': str(math.ceil(retry_after)),
+            }
             
-            if len(calls[user_id]) >= max_calls:
-                return jsonify({"error": f"{period}秒間に{max_calls}回までしかリクエストできません"}), 429
-            
-            calls[user_id].append(now)
-            return f(*args, **kwargs)
+            if not allowed:
+                response = jsonify({"error": f"{period}秒間に{limit}回までしかリクエストできません"})
+                response.status_code = 429
+                headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.headers.extend(headers)
+            return response
         return wrapper
     return decorator
 
 # データベース関連
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 5))
+# 接続が空くまで待つ最大秒数
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+# これ以上アイドルだった接続は貸し出し前に SELECT 1 で確認する
+DB_POOL_CHECK_IDLE = float(os.getenv('DB_POOL_CHECK_IDLE', 30))
+
+class DatabasePool:
+    """プロセスごとのPostgreSQL接続プール
+
+    gunicornのワーカーやCeleryのpreforkの子プロセスでは、fork後に親の接続を
+    使い回すとソケットが共有されて壊れるため、子プロセスで作り直す。
+    """
+
+    def __init__(self, minconn, maxconn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._reset()
+        # 親プロセスの接続は閉じると相手側のセッションも切れてしまうので、
+        # 参照を保持したまま使わないようにする
+        self._abandoned = []
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._pool = None
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(self.maxconn)
+        # 最後に返却された時刻。id(conn) をキーにすると閉じた接続のidが新しい接続に再利用されるので、
+        # 接続そのものを弱参照のキーにする（閉じて捨てられた接続の分は自動で消える）
+        self._last_used = weakref.WeakKeyDictionary()
+        self.stats = {"checkouts": 0, "timeouts": 0, "discarded": 0, "health_checks": 0}
+
+    def _after_fork(self):
+        if self._pool is not None:
+            self._abandoned.append(self._pool)
+        self._reset()
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    database_url = os.getenv('DATABASE_URL')
+                    if not database_url:
+                        raise ValueError("DATABASE_URL environment variable is not set.")
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, database_url)
+        return self._pool
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(conn, 0) < DB_POOL_CHECK_IDLE:
+            return True
+        self.stats["health_checks"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self, pool):
+        # プール内の接続がすべて壊れていても、最大数を超えない回数で諦める
+        for _ in range(self.maxconn + 1):
+            conn = pool.getconn()
+            if self._is_healthy(conn):
+                return conn
+            self.stats["discarded"] += 1
+            pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("No healthy database connection available.")
+
+    @contextmanager
+    def connection(self):
+        """接続を借りる。ブロックを抜けるとコミット（例外時はロールバック）して返却する"""
+        pool = self._get_pool()
+        if not self._semaphore.acquire(timeout=DB_POOL_TIMEOUT):
+            self.stats["timeouts"] += 1
+            raise psycopg2.pool.PoolError("Timed out waiting for a database connection.")
+        try:
+            conn = self._checkout(pool)
+            self.stats["checkouts"] += 1
+            discard = False
+            failed = False
+            started = time.perf_counter()
+            try:
+                with conn:
+                    yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                discard = failed = True
+                raise
+            except Exception:
+                failed = True
+                raise
+            finally:
+                metrics.record_db(time.perf_counter() - started, error=failed)
+                discard = discard or bool(conn.closed)
+                if discard:
+                    self.stats["discarded"] += 1
+                    self._last_used.pop(conn, None)
+                else:
+                    self._last_used[conn] = time.monotonic()
+                pool.putconn(conn, close=discard)
+        finally:
+            self._semaphore.release()
+
+    def metrics(self):
+        """/health で返すプールの状態"""
+        pool = self._pool
+        in_use = len(pool._used) if pool else 0
+        idle = len(pool._pool) if pool else 0
+        return {
+            "pid": os.getpid(),
+            "min": self.minconn,
+            "max": self.maxconn,
+            "in_use": in_use,
+            "idle": idle,
+            **self.stats,
+        }
+
+db_pool = DatabasePool(DB_POOL_MIN, DB_POOL_MAX)
+
 def get_db_connection():
-    """データベース接続を取得する"""
-    database_url = os.getenv('DATABASE_URL')
-    if not database_url:
-        raise ValueError("DATABASE_URL environment variable is not set.")
-    conn = psycopg2.connect(database_url)
-    return conn
-
-def init_db():
-    """データベースのテーブルを初期化"""
-    with app.app_context():
+    """プールからデータベース接続を借りる（with文で使う）"""
+    return db_pool.connection()
+
+@contextmanager
+def task_stage(name):
+    """解析タスクの段階ごとの処理時間を記録する"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('task_stage', name, time.perf_counter() - started)
+
+# Celeryタスク: 画像解析の非同期処理
+@celery.task(bind=True, max_retries=3, queue=ANALYSIS_QUEUE)
+def analyze_image_task(self, task_id, user_id, school_id, image_ref, grade_level='junior-high', deadline=None):
+    """画像解析を非同期で実行するタスク"""
+    if expire_if_past_deadline(task_id, user_id, deadline, ANALYSIS_QUEUE, self.request.retries):
+        discard_staged_upload(image_ref)
+        return {"success": False, "expired": True}
+    # 処理時間はこの試行の開始から数える（キューでの待ち時間とリトライの間隔は含めない）
+    started = time.perf_counter()
+    try:
+        set_task_state(task_id, user_id, 'processing', attempt=self.request.retries + 1)
+        
+        # 向き補正・縮小・再エンコードしてからAPIに送る
+        with task_stage('normalize'):
+            normalized = normalize_image(load_staged_upload(image_ref))
+            image_key = blob_key(normalized.data)
+        
+        with task_stage('cache_lookup'):
+            explanation_text, cache_hit = get_cached_explanation(image_key, normalized.phash, grade_level)
+        if explanation_text is None:
+            on_delta = TaskStreamPublisher(task_id) if STREAMING_ENABLED else None
+            with task_stage('explanation'):
+                explanation_text = request_explanation(normalized, grade_level, on_delta=on_delta)
+            store_cached_explanation(image_key, normalized.phash, grade_level, explanation_text)
+        else:
+            logger.info(f"Result cache hit ({cache_hit}) for task: {task_id}")
+        
+        with task_stage('store_images'):
+            blob_store.put(normalized.data)
+            thumbnail_key = blob_store.put(make_thumbnail(normalized.data))
+        
+        with task_stage('complete'):
+            history_id = complete_task(
+                task_id, user_id, school_id, image_key, thumbnail_key, explanation_text,
+                cached=cache_hit is not None, grade_level=grade_level,
+                processing_ms=int((time.perf_counter() - started) * 1000)
+            )
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error in analyze_image_task: {error_msg}")
+        if not is_retryable(e) or self.request.retries >= self.max_retries:
+            fail_task(task_id, user_id, user_error_message(e))
+            discard_staged_upload(image_ref)
+            raise
+        # リトライが残っている間は失敗を確定させない（リトライは優先度の低いキューに回す）
+        countdown = retry_countdown(e, self.request.retries)
+        set_task_state(task_id, user_id, 'retrying', error=user_error_message(e), retry_in=countdown)
+        raise self.retry(exc=e, countdown=countdown, queue=BACKGROUND_QUEUE)
+
+    # ここから先は履歴を保存したあとの後処理。失敗してもタスクは成功のままにする
+    # （リトライすると一時保存した画像がもうないので、保存済みのタスクを失敗で上書きしてしまう）
+    try:
+        discard_staged_upload(image_ref)
+    except Exception as e:
+        logger.error(f"Error discarding staged upload: {str(e)}")
+    try:
+        # キャッシュから答えた問題は、同じ画像の履歴の書き起こしを使い回して書き起こしの呼び出しを省く
+        if cache_hit is None:
+            transcribe_problem_task.delay(history_id)
+        else:
+            copy_problem_text(history_id, image_key)
+    except Exception as e:
+        logger.error(f"Error preparing problem text: {str(e)}")
+
+    logger.info(f"Successfully processed image for user: {user_id}, task: {task_id}")
+    return {"success": True, "explanation": explanation_text}
+
+def request_explanation(normalized, grade_level, on_delta=None):
+    """正規化済み画像をVision APIに送り、解説文を返す
+
+    on_delta を渡すとストリーミングAPIを使い、受け取った差分ごとに呼び出す。
+    """
+    base64_image = base64.b64encode(normalized.data).decode('utf-8')
+    
+    # ▼▼▼ 学年に応じてプロンプトを切り替える ▼▼▼
+    if grade_level == 'high-school':
+        prompt = """
+        あなたは優秀な高校教師です。この画像に写っている問題を分析して、高校生の学習者に適した教育的な指導をしてください。
+
+        【絶対に守ること】
+        - 計算しなくていいから、解き方の手順だけ教えてください
+        - 日本の高校生の知識の範囲内で、専門用語も適宜使用して説明してください
+
+        【表示形式】
+        - 考え方と手順のみ表示
+        - 重要な数式は $$...$$ で中央揃え表示
+        - 式に番号を振ってください
+
+        まず画像の内容を詳しく分析し、問題文を正確に読み取ってから指導を開始してください。
+        """
+    else:  # デフォルトは中学生向け
+        prompt = """
+        あなたは優秀な中学教師です。この画像に写っている問題を分析して、中学生の学習者に適した教育的な指導をしてください。
+
+        【絶対に守ること】
+        - 計算しなくていいから、解き方の手順だけ教えてください
+        - 日本の中学生の知識の範囲内で、専門用語は避け、平易な言葉で説明してください
+        - できるだけで細かく、わかりやすく説明してください
+
+        【表示形式】
+        - 考え方と手順のみ表示
+        - 重要な数式は $$...$$ で中央揃え表示
+        - 式に番号を振ってください
+
+        まず画像の内容を詳しく分析し、問題文を正確に読み取ってから指導を開始してください。
+        """
+    # ▲▲▲ プロンプトの切り替えここまで ▲▲▲
+    
+    completion_args = dict(
+        model="gpt-5",
+        messages=[
+            {"role": "user", "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {
+                    "url": f"data:{normalized.mimetype};base64,{base64_image}",
+                    "detail": "auto"
+                }}
+            ]}
+        ],
+        max_tokens=2000,
+        temperature=0.7,
+        timeout=60
+    )
+    
+    if on_delta is not None:
+        return stream_completion(on_delta, **completion_args)
+    gpt_response = create_chat_completion('vision', **completion_args)
+    return gpt_response.choices[0].message.content.strip()
+
+def create_chat_completion(kind, **completion_args):
+    """OpenAIのチャット補完を呼び出し、レイテンシとトークン数を記録する"""
+    model = completion_args['model']
+    started = time.perf_counter()
+    try:
+        with openai_circuit.guard(), openai_slot():
+            started = time.perf_counter()
+            response = openai_client.get().chat.completions.create(**completion_args)
+    except (OpenAISlotTimeout, CircuitOpenError):
+        raise
+    except Exception:
+        metrics.record_openai(model, time.perf_counter() - started, kind=kind, error=True)
+        raise
+    usage = response.usage
+    metrics.record_openai(
+        model, time.perf_counter() - started, kind=kind,
+        prompt_tokens=usage.prompt_tokens if usage else None,
+        completion_tokens=usage.completion_tokens if usage else None,
+    )
+    return response
+
+def _usage_tokens(usage):
+    """ストリームの usage から (prompt_tokens, completion_tokens) を取り出す
+
+    openai 1.12 の ChatCompletionChunk には usage のフィールドがないので、未知のフィールドとして dict のまま届く。
+    """
+    if usage is None:
+        return None, None
+    if isinstance(usage, dict):
+        return usage.get('prompt_tokens'), usage.get('completion_tokens')
+    return usage.prompt_tokens, usage.completion_tokens
+
+def iter_chat_completion(kind, **completion_args):
+    """ストリーミングAPIで補完を受け取り、差分のテキストを順に返す（計測付き）
+
+    stream_options.include_usage を付け、choices が空の最後のチャンクでトークン数を受け取る。
+    """
+    model = completion_args['model']
+    extra_body = {**completion_args.pop('extra_body', {}), "stream_options": {"include_usage": True}}
+    started = time.perf_counter()
+    first_token = None
+    usage = None
+    try:
+        with openai_circuit.guard(), openai_slot():
+            started = time.perf_counter()
+            stream = openai_client.get().chat.completions.create(stream=True, extra_body=extra_body, **completion_args)
+            for chunk in stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    yield chunk.choices[0].delta.content
+    except (OpenAISlotTimeout, CircuitOpenError):
+        raise
+    except Exception:
+        metrics.record_openai(model, time.perf_counter() - started, kind=kind, error=True)
+        raise
+    prompt_tokens, completion_tokens = _usage_tokens(usage)
+    metrics.record_openai(
+        model, time.perf_counter() - started, kind=kind,
+        prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+        time_to_first_token=first_token,
+    )
+
+# ストリーミング出力
+# 生成途中のテキストを少しずつ届け、最初の文字が表示されるまでの時間を短くする。
+STREAMING_ENABLED = os.getenv('STREAMING_ENABLED', 'true') == 'true'
+# 差分をまとめて通知する間隔（トークンごとにRedisへ書かないため）
+STREAM_FLUSH_INTERVAL = 0.1
+
+def stream_completion(on_delta, kind='vision', **completion_args):
+    """ストリーミングAPIで補完を受け取り、差分ごとに on_delta を呼んで全文を返す"""
+    parts = []
+    for delta in iter_chat_completion(kind, **completion_args):
+        parts.append(delta)
+        on_delta(delta)
+    if hasattr(on_delta, 'flush'):
+        on_delta.flush()
+    return ''.join(parts).strip()
+
+class TaskStreamPublisher:
+    """生成中の解説をタスクのチャンネルに流す
+
+    途中から購読したクライアントのために、それまでのテキストを
+    task_partial: キーにも溜めておく。差分には先頭からの文字数（offset）を
+    付けるので、クライアントは重複して受け取っても正しく組み立てられる。
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.partial_key = f"task_partial:{task_id}"
+        self.length = 0
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        # リトライ時は前回の途中経過を捨てる
+        redis_client.delete(self.partial_key)
+
+    def __call__(self, delta):
+        self.buffer.append(delta)
+        if time.monotonic() - self.last_flush >= STREAM_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        text = ''.join(self.buffer)
+        self.buffer = []
+        try:
+            pipe = redis_client.pipeline()
+            pipe.append(self.partial_key, text)
+            pipe.expire(self.partial_key, TASK_RESULT_TTL)
+            pipe.publish(_task_channel(self.task_id), json.dumps({
+                "status": "streaming",
+                "offset": self.length,
+                "delta": text
+            }))
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Error publishing stream delta: {str(e)}")
+        self.length += len(text)
+
+# タスクの状態
+# pending/processing/retrying などの途中経過はRedisのハッシュにだけ置き、
+# 完了・失敗したときに1回のトランザクションで task_status に確定させる。
+# 結果の本文は history.explanation にだけ保存し、task_status は history_id で参照する。
+TASK_STATE_TTL = 24 * 3600
+TASK_ACTIVE_KEY = "task_states:active"
+# これ以上状態が更新されないタスクは失敗として確定させる（秒）
+TASK_STALE_AFTER = int(os.getenv('TASK_STALE_AFTER', 15 * 60))
+
+def set_task_state(task_id, user_id, status, **fields):
+    """途中経過の状態をRedisに記録して通知する"""
+    now = datetime.now().isoformat()
+    state = {"user_id": user_id, "status": status, "updated_at": now, **fields}
+    try:
+        pipe = redis_client.pipeline()
+        if status == 'pending':
+            state["created_at"] = now
+        pipe.hset(f"task_state:{task_id}", mapping={k: str(v) for k, v in state.items()})
+        pipe.expire(f"task_state:{task_id}", TASK_STATE_TTL)
+        pipe.zadd(TASK_ACTIVE_KEY, {task_id: time.time()})
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error updating task state: {str(e)}")
+    publish_task_event(task_id, {"status": status, **fields})
+
+def get_task_state(task_id):
+    """Redis上の途中経過の状態（なければNone）"""
+    state = redis_client.hgetall(f"task_state:{task_id}")
+    return state or None
+
+def _finish_task_state(task_id, payload):
+    set_task_result(task_id, payload)
+    try:
+        pipe = redis_client.pipeline()
+        pipe.delete(f"task_state:{task_id}")
+        pipe.zrem(TASK_ACTIVE_KEY, task_id)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error clearing task state: {str(e)}")
+
+def _task_created_at(task_id):
+    try:
+        created_at = redis_client.hget(f"task_state:{task_id}", "created_at")
+        return datetime.fromisoformat(created_at) if created_at else datetime.now()
+    except Exception:
+        return datetime.now()
+
+# task_status に書き込むときの created_at（パラメーターは task_id と、行がないときの時刻）。
+# 既に行があればその値に合わせて ON CONFLICT で更新させる（Redisの状態は完了時に消え、
+# 期限切れでもなくなるので、その時刻で挿入すると同じタスクの行が増えてしまう）。
+# 別の SELECT にせず INSERT に埋め込み、確定を1往復で済ませる。
+TASK_STATUS_CREATED_AT_SQL = (
+    "COALESCE((SELECT created_at FROM task_status WHERE task_id = %s ORDER BY created_at LIMIT 1), %s)"
+)
+
+def expire_if_past_deadline(task_id, user_id, deadline, queue, retries=0):
+    """クライアントが待つのをやめた後に取り出されたタスクを、実行せずに失敗として確定させる"""
+    expired = deadline is not None and time.time() > deadline
+    if retries == 0:
+        # 期限切れはエラーとして数える
+        waited = (datetime.now() - _task_created_at(task_id)).total_seconds()
+        metrics.observe('queue_wait', queue, waited, error=expired)
+    if not expired:
+        return False
+    logger.warning(f"Task {task_id} expired before it started ({queue})")
+    fail_task(task_id, user_id, "混雑のため時間内に処理を開始できませんでした。もう一度お試しください。")
+    return True
+
+def complete_task(task_id, user_id, school_id, image_key, thumbnail_key, explanation, cached=False,
+                  grade_level=None, processing_ms=None):
+    """履歴の追加とタスクの完了を1つのトランザクションで確定させ、history_id を返す
+
+    processing_ms はワーカーが処理にかけた時間（キューでの待ち時間を含まない）。
+    """
+    now = datetime.now()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                WITH new_history AS (
+                    INSERT INTO history (user_id, school_id, image_key, thumbnail_key, explanation, grade_level,
+                                         processing_ms, timestamp)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                )
+                INSERT INTO task_status (task_id, user_id, status, history_id, created_at, updated_at)
+                SELECT %s, %s, 'completed', id, {TASK_STATUS_CREATED_AT_SQL}, %s FROM new_history
+                ON CONFLICT (task_id, created_at) DO UPDATE SET
+                    status = EXCLUDED.status, history_id = EXCLUDED.history_id,
+                    error_message = NULL, updated_at = EXCLUDED.updated_at
+                RETURNING history_id
+                """,
+                (user_id, school_id, image_key, thumbnail_key, explanation, grade_level, processing_ms, now,
+                 task_id, user_id, task_id, _task_created_at(task_id), now)
+            )
+            history_id = cur.fetchone()[0]
+    _finish_task_state(task_id, {
+        "status": "completed",
+        "result": explanation,
+        "history_id": history_id,
+        "cached": cached
+    })
+    return history_id
+
+def fail_task(task_id, user_id, error_message):
+    """タスクの失敗を確定させる"""
+    try:
+        now = datetime.now()
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    INSERT INTO task_status (task_id, user_id, status, error_message, created_at, updated_at)
+                    VALUES (%s, %s, 'failed', %s, {TASK_STATUS_CREATED_AT_SQL}, %s)
+                    ON CONFLICT (task_id, created_at) DO UPDATE SET
+                        status = EXCLUDED.status, error_message = EXCLUDED.error_message,
+                        updated_at = EXCLUDED.updated_at
+                    """,
+                    (task_id, user_id, error_message, task_id, _task_created_at(task_id), now)
+                )
+    except Exception as e:
+        logger.error(f"Error updating task status: {str(e)}")
+    _finish_task_state(task_id, {
+        "status": "failed",
+        "error": error_message
+    })
+
+@celery.task
+def reconcile_task_states():
+    """状態が長く更新されていないタスクを片付ける（Celery beatで定期実行）
+
+    ワーカーが落ちるなどして完了も失敗も記録されなかったタスクを失敗として確定させる。
+    """
+    cutoff = time.time() - TASK_STALE_AFTER
+    stale_ids = redis_client.zrangebyscore(TASK_ACTIVE_KEY, '-inf', cutoff, start=0, num=500)
+    reconciled = 0
+    for task_id in stale_ids:
+        state = get_task_state(task_id)
+        if redis_client.exists(f"task_result:{task_id}") or state is None:
+            redis_client.zrem(TASK_ACTIVE_KEY, task_id)
+            continue
+        fail_task(task_id, state['user_id'], "タスクが時間内に完了しませんでした")
+        reconciled += 1
+    if reconciled:
+        logger.info(f"Reconciled {reconciled} stale tasks")
+    return reconciled
+
+# パーティションの保守と保存期間
+# task_status は保存期間を過ぎた月のパーティションごと削除する（archive なら archive スキーマへ移す）。
+# history は消さずに、古い行の画像だけを cold ストアへ移す。
+TASK_STATUS_RETENTION_DAYS = int(os.getenv('TASK_STATUS_RETENTION_DAYS', 90))
+TASK_STATUS_RETENTION_MODE = os.getenv('TASK_STATUS_RETENTION_MODE', 'drop')
+IMAGE_COLD_AFTER_DAYS = int(os.getenv('IMAGE_COLD_AFTER_DAYS', 180))
+IMAGE_ARCHIVE_BATCH_SIZE = int(os.getenv('IMAGE_ARCHIVE_BATCH_SIZE', 100))
+IMAGE_ARCHIVE_MAX_ROWS = int(os.getenv('IMAGE_ARCHIVE_MAX_ROWS', 5000))
+# パーティションの作成・切り離しは親テーブルを短時間ロックするので、待たされたら諦めて翌日に回す
+PARTITION_LOCK_TIMEOUT = os.getenv('PARTITION_LOCK_TIMEOUT', '5s')
+
+def archive_image_batch(cutoff, batch_size):
+    """cutoff より古い履歴の画像を1バッチ分 cold ストアへ移し、処理した件数を返す"""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            # SKIP LOCKED で複数のワーカーから同時に実行されても同じ行を処理しない
+            cur.execute(
+                """
+                SELECT id, timestamp, image_key, thumbnail_key, image_base64 FROM history
+                WHERE timestamp < %s AND image_archived_at IS NULL
+                ORDER BY timestamp LIMIT %s FOR UPDATE SKIP LOCKED
+                """,
+                (cutoff, batch_size)
+            )
+            rows = cur.fetchall()
+            for row in rows:
+                image_key, thumbnail_key, image_data = row['image_key'], row['thumbnail_key'], None
+                if not image_key and row['image_base64']:
+                    # 未移行の行は画像を直接 cold ストアへ移し、一覧用のサムネイルだけ hot に作る
+                    image_data = base64.b64decode(row['image_base64'])
+                    image_key = blob_key(image_data)
+                    try:
+                        thumbnail_key = blob_store.put(make_thumbnail(image_data))
+                    except Exception as e:
+                        logger.warning(f"Could not create thumbnail for history {row['id']}: {e}")
+                if image_key:
+                    # 同じ画像を新しい履歴も参照していれば hot にも残す
+                    cur.execute(
+                        "SELECT 1 FROM history WHERE image_key = %s AND timestamp >= %s LIMIT 1",
+                        (image_key, cutoff)
+                    )
+                    keep_hot = cur.fetchone() is not None
+                    try:
+                        blob_store.archive(image_key, data=image_data, keep_hot=keep_hot)
+                    except FileNotFoundError:
+                        logger.warning(f"Image {image_key} for history {row['id']} is missing; marking it archived")
+                cur.execute(
+                    """
+                    UPDATE history SET image_key = %s, thumbnail_key = %s, image_base64 = NULL, image_archived_at = now()
+                    WHERE id = %s AND timestamp = %s
+                    """,
+                    (image_key, thumbnail_key, row['id'], row['timestamp'])
+                )
+    return len(rows)
+
+@celery.task
+def maintain_partitions():
+    """パーティションの作成、期限切れの task_status の削除、古い画像の移動（Celery beatで毎日実行）"""
+    now = datetime.now(timezone.utc)
+    summary = {"created": [], "retired": [], "images_archived": 0}
+
+    # 段階ごとに失敗を閉じ込め、1つがロック待ちで失敗しても残りは実行する（失敗した段階は翌日に再試行）
+    for table in PARTITION_KEYS:
         try:
             with get_db_connection() as conn:
                 with conn.cursor() as cur:
-                    cur.execute('''
-                    CREATE TABLE IF NOT EXISTS history (
-                        id SERIAL PRIMARY KEY,
-                        user_id VARCHAR(255) NOT NULL,
-                        school_id VARCHAR(255),
-                        image_base64 TEXT NOT NULL,
-                        explanation TEXT NOT NULL,
-                        timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                    )
-                    ''')
-                    cur.execute('''
-                    CREATE TABLE IF NOT EXISTS task_status (
-                        task_id VARCHAR(255) PRIMARY KEY,
-                        user_id VARCHAR(255) NOT NULL,
-                        status VARCHAR(50) NOT NULL,
-                        result TEXT,
-                        error_message TEXT,
-                        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                    )
-                    ''')
-                    cur.execute('CREATE INDEX IF NOT EXISTS idx_history_user_timestamp ON history(user_id, timestamp DESC)')
-                    cur.execute('CREATE INDEX IF NOT EXISTS idx_task_status_user ON task_status(user_id, created_at DESC)')
-            
-            logger.info("Database tables initialized or verified successfully.")
+                    cur.execute("SET LOCAL lock_timeout = %s", (PARTITION_LOCK_TIMEOUT,))
+                    if is_partitioned(cur, table):
+                        summary["created"].extend(ensure_partitions(cur, table, PARTITION_MONTHS_AHEAD, now))
+                    else:
+                        logger.warning(f"{table} is not partitioned yet; run migrate_partitions.py")
+        except psycopg2.Error as e:
+            logger.error(f"Error creating partitions for {table}: {str(e)}")
+
+    cutoff = now - timedelta(days=TASK_STATUS_RETENTION_DAYS)
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                expired = expired_partitions(cur, 'task_status', cutoff) if is_partitioned(cur, 'task_status') else []
+    except psycopg2.Error as e:
+        logger.error(f"Error listing expired partitions: {str(e)}")
+        expired = []
+    for name in expired:
+        # 1パーティションずつ確定させ、親テーブルのロックを長く持たない
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SET LOCAL lock_timeout = %s", (PARTITION_LOCK_TIMEOUT,))
+                    retire_partition(cur, 'task_status', name, TASK_STATUS_RETENTION_MODE)
+            summary["retired"].append(name)
+        except psycopg2.Error as e:
+            logger.error(f"Error retiring partition {name}: {str(e)}")
+
+    if isinstance(blob_store, TieredBlobStore):
+        image_cutoff = now - timedelta(days=IMAGE_COLD_AFTER_DAYS)
+        try:
+            while summary["images_archived"] < IMAGE_ARCHIVE_MAX_ROWS:
+                archived = archive_image_batch(image_cutoff, IMAGE_ARCHIVE_BATCH_SIZE)
+                if archived == 0:
+                    break
+                summary["images_archived"] += archived
         except Exception as e:
-            logger.error(f"Error initializing database: {e}")
-            raise
+            # 確定済みのバッチはそのまま残り、続きは翌日に行う
+            logger.error(f"Error archiving images: {str(e)}")
 
-# Celeryタスク: 画像解析の非同期処理
-@celery.task(bind=True, max_retries=3)
-def analyze_image_task(self, task_id, user_id, school_id, base64_image, grade_level='junior-high'):
-    """画像解析を非同期で実行するタスク"""
+    logger.info(f"Partition maintenance: {summary}")
+    return summary
+
+@celery.task
+def purge_staged_uploads():
+    """片付け損ねたステージング画像を消す（Celery beatで定期実行）
+
+    enqueue に失敗したアップロードや、ワーカーが落ちて discard されなかったタスクの分。
+    """
+    if UPLOAD_STAGING_BACKEND != 'blob':
+        return 0
+    purged = blob_store.purge_staged(time.time() - UPLOAD_STAGING_TTL)
+    if purged:
+        logger.info(f"Purged {purged} stale staged uploads")
+    return purged
+
+celery.conf.beat_schedule = {
+    'reconcile-task-states': {
+        'task': reconcile_task_states.name,
+        'schedule': 300.0,
+    },
+    # 利用の少ない時間帯（日本時間の午前4時）に実行する
+    'maintain-partitions': {
+        'task': maintain_partitions.name,
+        'schedule': crontab(hour=19, minute=0),
+    },
+    'purge-staged-uploads': {
+        'task': purge_staged_uploads.name,
+        'schedule': 3600.0,
+    },
+}
+
+# タスクの状態変化の通知（Redis pub/sub）
+# クライアントはSSEかロングポーリングで待ち受け、変化があった瞬間に結果を受け取る。
+TASK_TERMINAL_STATUSES = ('completed', 'failed')
+TASK_RESULT_TTL = 3600
+TASK_EVENTS_TIMEOUT = 120
+TASK_EVENTS_HEARTBEAT = 15
+# SSEとロングポーリングは待っている間gunicornのスレッドを1本占有するので、
+# プロセスあたりの同時待機数をスレッド数より小さく抑え、残りを他のリクエストに残す
+# （render.yaml では --threads 8 に対して6。既定の1は --threads 2 で動かす場合の値）。
+# 上限を超えたSSEは429で断り（クライアントはロングポーリングに切り替える）、
+# ロングポーリングは待たずに現在の状態を返す。
+TASK_WAIT_MAX_CONCURRENT = int(os.getenv('TASK_WAIT_MAX_CONCURRENT', 1))
+TASK_WAIT_MAX_SECONDS = 30
+TASK_POLL_RETRY_AFTER = 3
+_task_wait_slots = threading.BoundedSemaphore(TASK_WAIT_MAX_CONCURRENT)
+
+def _task_channel(task_id):
+    return f"task_events:{task_id}"
+
+def publish_task_event(task_id, payload):
+    """タスクの状態変化を購読中のクライアントに通知する"""
     try:
-        update_task_status(task_id, 'processing')
-        
-        # ▼▼▼ 学年に応じてプロンプトを切り替える ▼▼▼
-        if grade_level == 'high-school':
-            prompt = """
-            あなたは優秀な高校教師です。この画像に写っている問題を分析して、高校生の学習者に適した教育的な指導をしてください。
+        redis_client.publish(_task_channel(task_id), json.dumps(payload))
+    except Exception as e:
+        logger.error(f"Error publishing task event: {str(e)}")
 
-            【絶対に守ること】
-            - 計算しなくていいから、解き方の手順だけ教えてください
-            - 日本の高校生の知識の範囲内で、専門用語も適宜使用して説明してください
+def set_task_result(task_id, payload):
+    """終了したタスクの結果をRedisに保存して通知する
 
-            【表示形式】
-            - 考え方と手順のみ表示
-            - 重要な数式は $$...$$ で中央揃え表示
-            - 式に番号を振ってください
+    データベースへの確定の後に呼ばれるので、Redisの失敗は記録するだけで送出しない
+    （送出するとタスクがリトライされ、履歴やメッセージが二重に追加される）。
+    結果を保存できなくても /task/<task_id> はデータベースから答える。
+    """
+    data = json.dumps(payload)
+    try:
+        redis_client.setex(f"task_result:{task_id}", TASK_RESULT_TTL, data)
+    except Exception as e:
+        logger.error(f"Error storing task result: {str(e)}")
+    try:
+        redis_client.publish(_task_channel(task_id), data)
+    except Exception as e:
+        logger.error(f"Error publishing task event: {str(e)}")
+
+def iter_task_events(task_id, timeout):
+    """タスクの状態変化を順に返すジェネレーター
+
+    購読を開始してから保存済みの結果を確認するので、その間に完了しても取りこぼさない。
+    終了状態に達するか timeout 秒経つと止まる。イベントがない間は None を返す。
+    """
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(_task_channel(task_id))
+        stored = redis_client.get(f"task_result:{task_id}")
+        if stored:
+            yield json.loads(stored)
+            return
+        partial = redis_client.get(f"task_partial:{task_id}")
+        if partial:
+            yield {"status": "streaming", "offset": 0, "delta": partial}
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=min(1.0, max(0.0, deadline - time.monotonic())))
+            if message is None:
+                yield None
+                continue
+            event = json.loads(message['data'])
+            yield event
+            if event.get('status') in TASK_TERMINAL_STATUSES:
+                return
+    finally:
+        pubsub.close()
+
+# 再質問のスレッド
+# 解析の完了後に問題文を一度だけ書き起こしておき、再質問では画像を送らずに
+# 「固定のシステムプロンプト → 問題文と最初の解説 → 直近のやり取り → 新しい質問」の順で
+# メッセージを組み立てる。先頭ほど変わらない並びにして、プロバイダ側のプロンプトキャッシュに乗せる。
+TRANSCRIBE_MODEL = os.getenv('TRANSCRIBE_MODEL', 'gpt-4.1-mini')
+REQUESTION_MODEL = os.getenv('REQUESTION_MODEL', 'gpt-4.1-mini')
+# 直近のやり取りに使うトークン数の目安と、読み込む最大件数
+REQUESTION_CONTEXT_TOKENS = int(os.getenv('REQUESTION_CONTEXT_TOKENS', 6000))
+REQUESTION_MAX_MESSAGES = 40
+REQUESTION_MAX_CHARS = 2000
 
-            まず画像の内容を詳しく分析し、問題文を正確に読み取ってから指導を開始してください。
-            """
-        else:  # デフォルトは中学生向け
-            prompt = """
-            あなたは優秀な中学教師です。この画像に写っている問題を分析して、中学生の学習者に適した教育的な指導をしてください。
+TRANSCRIBE_PROMPT = """
+画像に写っている問題文を、そのまま正確に書き起こしてください。
+- 解説や解答は書かないでください
+- 数式は LaTeX（$...$）で書いてください
+- 図やグラフがある場合は、読み取れる数値や条件を文章で補ってください
+"""
 
-            【絶対に守ること】
-            - 計算しなくていいから、解き方の手順だけ教えてください
-            - 日本の中学生の知識の範囲内で、専門用語は避け、平易な言葉で説明してください
-            - できるだけで細かく、わかりやすく説明してください
+FOLLOWUP_SYSTEM_PROMPT = """
+あなたは優秀な教師です。生徒は以前に問題の解説を受け取っており、その内容について追加で質問しています。
+問題文・最初の解説・これまでのやり取りを踏まえて、分かりやすく丁寧に答えてください。
+重要な数式は $$...$$ を使って表現してください。
+"""
 
-            【表示形式】
-            - 考え方と手順のみ表示
-            - 重要な数式は $$...$$ で中央揃え表示
-            - 式に番号を振ってください
+def estimate_tokens(text):
+    """トークン数のおおまかな見積もり（ASCIIは4文字で1、それ以外は1文字で1）"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars)
 
-            まず画像の内容を詳しく分析し、問題文を正確に読み取ってから指導を開始してください。
-            """
-        # ▲▲▲ プロンプトの切り替えここまで ▲▲▲
+@celery.task(bind=True, max_retries=2)
+def transcribe_problem_task(self, history_id):
+    """履歴の画像から問題文を書き起こして history.problem_text に保存する"""
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute("SELECT image_key, image_base64, problem_text FROM history WHERE id = %s", (history_id,))
+                row = cur.fetchone()
+        if row is None or row['problem_text']:
+            return
         
-        gpt_response = client.chat.completions.create(
-            model="gpt-5",
+        image_data = load_history_image(row)
+        base64_image = base64.b64encode(image_data).decode('utf-8')
+        response = create_chat_completion(
+            'transcribe',
+            model=TRANSCRIBE_MODEL,
             messages=[
                 {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
+                    {"type": "text", "text": TRANSCRIBE_PROMPT},
                     {"type": "image_url", "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}",
+                        "url": f"data:{detect_image_mimetype(image_data[:16])};base64,{base64_image}",
                         "detail": "auto"
                     }}
                 ]}
             ],
-            max_tokens=2000,
-            temperature=0.7,
+            max_tokens=1000,
+            temperature=0,
             timeout=60
         )
-        
-        explanation_text = gpt_response.choices[0].message.content.strip()
+        problem_text = response.choices[0].message.content.strip()
         
         with get_db_connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    "INSERT INTO history (user_id, school_id, image_base64, explanation, timestamp) VALUES (%s, %s, %s, %s, %s)",
-                    (user_id, school_id, base64_image, explanation_text, datetime.now())
+                    "UPDATE history SET problem_text = %s WHERE id = %s AND problem_text IS NULL",
+                    (problem_text, history_id)
                 )
+        logger.info(f"Transcribed problem for history_id: {history_id}")
+        
+    except Exception as e:
+        logger.error(f"Error in transcribe_problem_task: {str(e)}")
+        # 書き起こしがなくても再質問は画像付きで動くので、リトライを使い切ったら諦める
+        if is_retryable(e) and self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=retry_countdown(e, self.request.retries))
+
+def copy_problem_text(history_id, image_key):
+    """同じ画像の別の履歴に書き起こしがあれば、それを履歴にコピーする
+
+    書き起こしがまだなければ何もしない（再質問は画像を付けて行う）。
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE history SET problem_text = source.problem_text
+                FROM (
+                    SELECT problem_text FROM history
+                    WHERE image_key = %s AND id <> %s AND problem_text IS NOT NULL
+                    ORDER BY timestamp DESC LIMIT 1
+                ) AS source
+                WHERE history.id = %s AND history.problem_text IS NULL
+                """,
+                (image_key, history_id, history_id)
+            )
+
+def load_thread(history_id, limit=REQUESTION_MAX_MESSAGES):
+    """スレッドの直近のメッセージを古い順に返す"""
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            cur.execute(
+                "SELECT id, role, content, created_at FROM history_messages "
+                "WHERE history_id = %s ORDER BY id DESC LIMIT %s",
+                (history_id, limit)
+            )
+            rows = cur.fetchall()
+    return [dict(row) for row in reversed(rows)]
+
+def build_followup_messages(history_row, thread, question_text, budget=REQUESTION_CONTEXT_TOKENS):
+    """再質問のメッセージを組み立てる
+
+    問題文がまだ書き起こされていない履歴（旧データなど）だけ画像を添付する。
+    直近のやり取りは新しいものから予算内に収まる分だけ、質問と回答の組で含める。
+    """
+    context = f"【問題文】\n{history_row['problem_text']}\n\n" if history_row['problem_text'] else ""
+    context += f"【最初の解説】\n{history_row['explanation']}"
+    if history_row['problem_text']:
+        context_message = {"role": "user", "content": context}
+    else:
+        image_data = load_history_image(history_row)
+        base64_image = base64.b64encode(image_data).decode('utf-8')
+        context_message = {"role": "user", "content": [
+            {"type": "text", "text": "問題の画像と最初の解説です。\n\n" + context},
+            {"type": "image_url", "image_url": {
+                "url": f"data:{detect_image_mimetype(image_data[:16])};base64,{base64_image}",
+                "detail": "auto"
+            }}
+        ]}
+
+    turns = []
+    used = 0
+    pending_answer = None
+    for message in reversed(thread):
+        if message['role'] == 'assistant':
+            pending_answer = message
+            continue
+        if pending_answer is None:
+            continue
+        cost = estimate_tokens(message['content']) + estimate_tokens(pending_answer['content'])
+        if used + cost > budget:
+            break
+        used += cost
+        turns[:0] = [
+            {"role": "user", "content": message['content']},
+            {"role": "assistant", "content": pending_answer['content']},
+        ]
+        pending_answer = None
+
+    return [
+        {"role": "system", "content": FOLLOWUP_SYSTEM_PROMPT},
+        context_message,
+        {"role": "assistant", "content": "問題と解説を確認しました。質問をどうぞ。"},
+        *turns,
+        {"role": "user", "content": question_text},
+    ]
+
+@celery.task(bind=True, max_retries=2, queue=REQUESTION_QUEUE)
+def re_question_task(self, task_id, user_id, history_id, question_text, deadline=None):
+    """再質問に回答するタスク"""
+    if expire_if_past_deadline(task_id, user_id, deadline, REQUESTION_QUEUE, self.request.retries):
+        return {"success": False, "expired": True}
+    try:
+        set_task_state(task_id, user_id, 'processing', attempt=self.request.retries + 1)
         
-        update_task_status(task_id, 'completed', result=explanation_text)
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(
+                    "SELECT image_key, image_base64, explanation, problem_text FROM history WHERE id = %s",
+                    (history_id,)
+                )
+                history_row = cur.fetchone()
+        if history_row is None:
+            raise InvalidInputError("元の質問が見つかりません")
         
-        redis_client.setex(f"task_result:{task_id}", 3600, json.dumps({
-            "status": "completed",
-            "result": explanation_text
-        }))
+        completion_args = dict(
+            model=REQUESTION_MODEL,
+            messages=build_followup_messages(history_row, load_thread(history_id), question_text),
+            max_tokens=1000,
+            temperature=0.7,
+            timeout=60
+        )
+        if STREAMING_ENABLED:
+            answer_text = stream_completion(TaskStreamPublisher(task_id), kind='followup', **completion_args)
+        else:
+            answer_text = create_chat_completion('followup', **completion_args).choices[0].message.content.strip()
         
-        logger.info(f"Successfully processed image for user: {user_id}, task: {task_id}")
-        return {"success": True, "explanation": explanation_text}
+        complete_followup(task_id, user_id, history_id, question_text, answer_text)
+        logger.info(f"Successfully answered re-question for history_id: {history_id}, task: {task_id}")
+        return {"success": True}
         
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"Error in analyze_image_task: {error_msg}")
-        update_task_status(task_id, 'failed', error_message=error_msg)
-        redis_client.setex(f"task_result:{task_id}", 3600, json.dumps({
-            "status": "failed",
-            "error": error_msg
-        }))
-        raise self.retry(exc=e, countdown=60)
+        logger.error(f"Error in re_question_task: {error_msg}")
+        if not is_retryable(e) or self.request.retries >= self.max_retries:
+            fail_task(task_id, user_id, user_error_message(e))
+            raise
+        countdown = retry_countdown(e, self.request.retries)
+        set_task_state(task_id, user_id, 'retrying', error=user_error_message(e), retry_in=countdown)
+        raise self.retry(exc=e, countdown=countdown, queue=BACKGROUND_QUEUE)
 
-def update_task_status(task_id, status, result=None, error_message=None):
-    """タスクのステータスを更新"""
-    try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                now = datetime.now()
-                if result:
-                    cur.execute(
-                        "UPDATE task_status SET status = %s, result = %s, updated_at = %s WHERE task_id = %s",
-                        (status, result, now, task_id)
-                    )
-                elif error_message:
-                    cur.execute(
-                        "UPDATE task_status SET status = %s, error_message = %s, updated_at = %s WHERE task_id = %s",
-                        (status, error_message, now, task_id)
-                    )
-                else:
-                    cur.execute(
-                        "UPDATE task_status SET status = %s, updated_at = %s WHERE task_id = %s",
-                        (status, now, task_id)
-                    )
-    except Exception as e:
-        logger.error(f"Error updating task status: {str(e)}")
+def complete_followup(task_id, user_id, history_id, question_text, answer_text):
+    """質問と回答の追加とタスクの完了を1つのトランザクションで確定させる"""
+    now = datetime.now()
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                WITH new_messages AS (
+                    INSERT INTO history_messages (history_id, role, content, created_at)
+                    VALUES (%s, 'user', %s, %s), (%s, 'assistant', %s, %s)
+                    RETURNING id, role
+                )
+                INSERT INTO task_status (task_id, user_id, status, history_id, message_id, created_at, updated_at)
+                SELECT %s, %s, 'completed', %s, id, {TASK_STATUS_CREATED_AT_SQL}, %s
+                FROM new_messages WHERE role = 'assistant'
+                ON CONFLICT (task_id, created_at) DO UPDATE SET
+                    status = EXCLUDED.status, history_id = EXCLUDED.history_id, message_id = EXCLUDED.message_id,
+                    error_message = NULL, updated_at = EXCLUDED.updated_at
+                RETURNING message_id
+                """,
+                (history_id, question_text, now, history_id, answer_text, now,
+                 task_id, user_id, history_id, task_id, _task_created_at(task_id), now)
+            )
+            message_id = cur.fetchone()[0]
+    _finish_task_state(task_id, {
+        "status": "completed",
+        "result": answer_text,
+        "history_id": history_id,
+        "message_id": message_id
+    })
+    return message_id
 
 # ... (既存のルート、アップロード、タスク確認、履歴取得、ヘルスチェックなどの関数は変更なし) ...
 # ルートページ
@@ -239,10 +1593,46 @@ def manifest():
 def serve_static(filename):
     return send_from_directory('static', filename)
 
+# 冪等キー
+# タイムアウト後の再送などで同じアップロードを二重に解析しないよう、
+# Idempotency-Key ヘッダー（またはフォームの idempotency_key）を受け付け済みの task_id に対応付ける。
+IDEMPOTENCY_TTL = TASK_RESULT_TTL
+IDEMPOTENCY_KEY_MAX_LENGTH = 200
+
+def _idempotency_key(user_id, key):
+    return f"idempotency:{user_id}:{key}"
+
+def find_idempotent_task(user_id, key):
+    """同じキーで受け付け済みのタスクIDを返す（失敗したタスクは再利用しない）"""
+    task_id = redis_client.get(_idempotency_key(user_id, key))
+    if task_id is None:
+        return None
+    result = redis_client.get(f"task_result:{task_id}")
+    if result and json.loads(result).get('status') == 'failed':
+        redis_client.delete(_idempotency_key(user_id, key))
+        return None
+    return task_id
+
+def claim_idempotency_key(user_id, key, task_id):
+    """キーに task_id を結び付ける。同時に届いた別のリクエストが先に結び付けていればそのIDを返す"""
+    if redis_client.set(_idempotency_key(user_id, key), task_id, nx=True, ex=IDEMPOTENCY_TTL):
+        return task_id
+    return redis_client.get(_idempotency_key(user_id, key))
+
+def duplicate_upload_response(task_id):
+    return jsonify({
+        "success": True,
+        "task_id": task_id,
+        "duplicate": True,
+        "message": "同じ画像の解析をすでに受け付けています。"
+    })
+
 # 画像アップロード
 @app.route('/upload', methods=['POST'])
-@rate_limit(max_calls=5, period=60)
+@rate_limit(max_calls=5, period=60, school_max_calls=int(os.getenv('SCHOOL_UPLOAD_LIMIT', 200)))
 def upload():
+    claimed_key = None
+    image_ref = None
     try:
         school_id = request.form.get('school_id', 'default_school')
         user_id = request.form.get('user_id', 'default_user')
@@ -264,18 +1654,34 @@ def upload():
         if len(image_data) > 16 * 1024 * 1024:
             return jsonify({"error": "ファイルサイズが大きすぎます"}), 413
         
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-        task_id = str(uuid.uuid4())
+        idempotency_key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+        if idempotency_key:
+            if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                return jsonify({"error": "Idempotency-Key が長すぎます"}), 400
+            existing_task_id = find_idempotent_task(user_id, idempotency_key)
+            if existing_task_id:
+                return duplicate_upload_response(existing_task_id)
         
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO task_status (task_id, user_id, status, created_at, updated_at) VALUES (%s, %s, %s, %s, %s)",
-                    (task_id, user_id, 'pending', datetime.now(), datetime.now())
-                )
+        deadline_seconds, deadline = request_deadline()
+        rejected = check_admission(ANALYSIS_QUEUE, deadline_seconds)
+        if rejected is not None:
+            return rejected
+        
+        task_id = str(uuid.uuid4())
+        if idempotency_key:
+            claimed_task_id = claim_idempotency_key(user_id, idempotency_key, task_id)
+            if claimed_task_id != task_id:
+                return duplicate_upload_response(claimed_task_id)
+            claimed_key = _idempotency_key(user_id, idempotency_key)
+        image_ref = stage_upload(task_id, image_data)
+        set_task_state(task_id, user_id, 'pending')
         
         # ▼▼▼ Celeryタスクに学年情報を渡す ▼▼▼
-        analyze_image_task.apply_async(args=[task_id, user_id, school_id, base64_image, grade_level], task_id=task_id)
+        analyze_image_task.apply_async(
+            args=[task_id, user_id, school_id, image_ref, grade_level],
+            kwargs={"deadline": deadline},
+            task_id=task_id
+        )
         
         logger.info(f"Task created for user: {user_id}, task_id: {task_id}")
         
@@ -287,19 +1693,62 @@ def upload():
         
     except Exception as e:
         logger.error(f"Error in upload: {str(e)}")
+        # キューに積めなかったタスクの画像は誰も片付けないので、ここで消す
+        if image_ref:
+            discard_staged_upload(image_ref)
+        # 受け付けられなかったので、同じキーでの再送を通す
+        if claimed_key:
+            try:
+                redis_client.delete(claimed_key)
+            except Exception:
+                pass
         return jsonify({"error": "画像のアップロードに失敗しました。"}), 500
 
 # タスクステータス確認
+# ?wait=秒 を付けるとロングポーリングになり、完了するかタイムアウトするまで待つ
 @app.route('/task/<task_id>', methods=['GET'])
 def get_task_status(task_id):
     try:
-        redis_result = redis_client.get(f"task_result:{task_id}")
-        if redis_result:
-            return jsonify(json.loads(redis_result))
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return jsonify({"error": "wait は秒数で指定してください"}), 400
+    if not math.isfinite(wait):
+        return jsonify({"error": "wait は秒数で指定してください"}), 400
+    wait = min(wait, TASK_WAIT_MAX_SECONDS)
+
+    try:
+        # 待機の枠が空いていなければ待たずに答え、少し間をおいて再確認してもらう
+        waited = wait > 0 and _task_wait_slots.acquire(blocking=False)
+        if waited:
+            try:
+                for event in iter_task_events(task_id, wait):
+                    if event and event.get('status') in TASK_TERMINAL_STATUSES:
+                        return jsonify(event)
+            finally:
+                _task_wait_slots.release()
+        else:
+            redis_result = redis_client.get(f"task_result:{task_id}")
+            if redis_result:
+                return jsonify(json.loads(redis_result))
+        
+        # 実行中ならRedisの状態だけで答える
+        state = get_task_state(task_id)
+        if state:
+            response = jsonify({"task_id": task_id, **state})
+            if wait > 0 and not waited:
+                response.headers['Retry-After'] = str(TASK_POLL_RETRY_AFTER)
+            return response
         
         with get_db_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-                cur.execute("SELECT * FROM task_status WHERE task_id = %s", (task_id,))
+                cur.execute(
+                    "SELECT t.task_id, t.user_id, t.status, COALESCE(t.result, m.content, h.explanation) AS result, "
+                    "t.history_id, t.message_id, t.error_message, t.created_at, t.updated_at "
+                    "FROM task_status t LEFT JOIN history h ON h.id = t.history_id "
+                    "LEFT JOIN history_messages m ON m.id = t.message_id WHERE t.task_id = %s "
+                    "ORDER BY t.updated_at DESC LIMIT 1",
+                    (task_id,)
+                )
                 task = cur.fetchone()
         
         if not task:
@@ -316,36 +1765,693 @@ def get_task_status(task_id):
         logger.error(f"Error in get_task_status: {str(e)}")
         return jsonify({"error": "タスクステータスの取得に失敗しました"}), 500
 
+# タスクの状態変化をServer-Sent Eventsで配信
+@app.route('/task/<task_id>/events', methods=['GET'])
+def task_events(task_id):
+    if not _task_wait_slots.acquire(blocking=False):
+        response = jsonify({
+            "error": "接続が混み合っています。ロングポーリングで結果を確認してください。",
+            "poll_url": f"/task/{task_id}?wait={TASK_WAIT_MAX_SECONDS}",
+        })
+        response.status_code = 429
+        response.headers['Retry-After'] = str(TASK_POLL_RETRY_AFTER)
+        return response
+
+    def generate():
+        last_sent = time.monotonic()
+        for event in iter_task_events(task_id, TASK_EVENTS_TIMEOUT):
+            if event is not None:
+                last_sent = time.monotonic()
+                yield f"data: {json.dumps(event)}\n\n"
+            elif time.monotonic() - last_sent >= TASK_EVENTS_HEARTBEAT:
+                # プロキシに接続を切られないようにコメント行を送る
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    # ストリームを閉じたとき（途中で切断された場合も）に枠を返す
+    response.call_on_close(_task_wait_slots.release)
+    return response
+
 # 履歴取得
+# 一覧は軽量な列だけを返し、(timestamp, id) のカーソルでページングする
+HISTORY_PREVIEW_LENGTH = 200
+
+def encode_history_cursor(timestamp, history_id):
+    """一覧の最後の行からカーソル文字列を作る"""
+    raw = f"{timestamp.isoformat()}|{history_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_history_cursor(cursor):
+    """カーソル文字列を (timestamp, id) に戻す"""
+    raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    timestamp, history_id = raw.rsplit('|', 1)
+    return datetime.fromisoformat(timestamp), int(history_id)
+
+def parse_page_limit(default=20, maximum=100):
+    """?limit= を 1〜maximum の整数にする（整数でなければ ValueError）"""
+    return min(max(int(request.args.get('limit', default)), 1), maximum)
+
+def history_image_urls(row, user_id):
+    """履歴行の画像URLとサムネイルURL（未移行の行は旧形式の配信ルート。履歴の持ち主の user_id を付ける）"""
+    if row['image_key']:
+        full_url = image_url(row['image_key'])
+    else:
+        full_url = f"/history/{row['id']}/image?user_id={quote(user_id, safe='')}"
+    thumbnail_url = image_url(row['thumbnail_key']) if row['thumbnail_key'] else full_url
+    return full_url, thumbnail_url
+
 @app.route('/history', methods=['GET'])
 @rate_limit(max_calls=20, period=60)
 def get_history():
     try:
         user_id = request.args.get('user_id', 'default_user')
-        limit = min(int(request.args.get('limit', 20)), 100)
-        offset = int(request.args.get('offset', 0))
+        try:
+            limit = parse_page_limit()
+        except ValueError:
+            return jsonify({"error": "limit は整数で指定してください"}), 400
+        cursor = request.args.get('cursor')
+        try:
+            after = decode_history_cursor(cursor) if cursor else None
+        except ValueError:
+            return jsonify({"error": "不正なカーソルです"}), 400
         
         with get_db_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-                cur.execute(
-                    "SELECT * FROM history WHERE user_id = %s ORDER BY timestamp DESC LIMIT %s OFFSET %s",
-                    (user_id, limit, offset)
+                # idx_history_user_timestamp を範囲スキャンする（OFFSETのように読み飛ばさない）
+                query = (
+                    "SELECT id, timestamp, image_key, thumbnail_key, LEFT(explanation, %s) AS preview, "
+                    "char_length(explanation) > %s AS truncated FROM history WHERE user_id = %s"
                 )
+                params = [HISTORY_PREVIEW_LENGTH, HISTORY_PREVIEW_LENGTH, user_id]
+                if after:
+                    query += " AND (timestamp, id) < (%s, %s)"
+                    params.extend(after)
+                query += " ORDER BY timestamp DESC, id DESC LIMIT %s"
+                params.append(limit + 1)
+                cur.execute(query, params)
                 history_rows = cur.fetchall()
-                history = [dict(row) for row in history_rows]
 
-                cur.execute("SELECT COUNT(*) as total FROM history WHERE user_id = %s", (user_id,))
-                total_count = cur.fetchone()['total']
+                cur.execute("SELECT total FROM history_counts WHERE user_id = %s", (user_id,))
+                count_row = cur.fetchone()
+                total_count = count_row['total'] if count_row else 0
 
-        for item in history:
-            item['timestamp'] = item['timestamp'].isoformat()
+        has_more = len(history_rows) > limit
+        history_rows = history_rows[:limit]
+        history = []
+        for row in history_rows:
+            full_url, thumbnail_url = history_image_urls(row, user_id)
+            history.append({
+                "id": row['id'],
+                "timestamp": row['timestamp'].isoformat(),
+                "preview": row['preview'],
+                "truncated": row['truncated'],
+                "image_url": full_url,
+                "thumbnail_url": thumbnail_url,
+            })
+        
+        next_cursor = None
+        if has_more:
+            last = history_rows[-1]
+            next_cursor = encode_history_cursor(last['timestamp'], last['id'])
         
-        return jsonify({"history": history, "total": total_count, "limit": limit, "offset": offset})
+        return jsonify({"history": history, "total": total_count, "limit": limit, "next_cursor": next_cursor})
         
     except Exception as e:
         logger.error(f"Error in history: {str(e)}")
         return jsonify({"error": "履歴の取得に失敗しました"}), 500
 
+# 履歴の検索
+# 日本語は空白で単語に区切れないので、tsvector ではなく pg_trgm（3文字のn-gram）の
+# GINインデックスで解説と問題文を部分一致検索し、word_similarity の高い順に返す。
+# インデックスは (user_id, HISTORY_SEARCH_EXPRESSION)（migrations.py の HISTORY_SEARCH_INDEX）に張っている。
+# よくある語は履歴の多いユーザーだと数千行に一致し、ページごとに全部を順位付けすると1〜2秒かかるので、
+# 順位付けするのは新しい順に HISTORY_SEARCH_MAX_RANKED 件までの一致に限る。それより古い一致は、
+# 順位付けした分を返し終えたあとに新しい順で続けて返す（カーソルが (timestamp, id) のキーセットに切り替わる）。
+# 順位付けする範囲は最初のページを返した時刻（as_of）までの行に固定し、途中で増えた行でずれないようにする。
+HISTORY_SEARCH_MAX_LENGTH = 100
+HISTORY_SEARCH_MAX_RANKED = int(os.getenv('HISTORY_SEARCH_MAX_RANKED', 200))
+HISTORY_SEARCH_MAX_TERMS = 5
+HISTORY_SNIPPET_LENGTH = 160
+
+def parse_search_terms(query):
+    """検索語を空白（全角の空白を含む）で区切る
+
+    インデックスを張った本文は正規化していないので、検索語も正規化しない
+    （NFKCにすると全角の英数字や記号を含む本文に一致しなくなる）。
+    """
+    return query.split()[:HISTORY_SEARCH_MAX_TERMS]
+
+def _like_pattern(term):
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+def encode_search_cursor(rank, history_id, as_of):
+    """関連度順のページのカーソル"""
+    raw = f"r|{rank!r}|{history_id}|{as_of.isoformat()}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def encode_search_older_cursor(timestamp, history_id):
+    """順位付けした範囲より古い一致（新しい順）のページのカーソル"""
+    raw = f"t|{timestamp.isoformat()}|{history_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_search_cursor(cursor):
+    """カーソルを (種類, (キー, id), as_of) に戻す（種類は 'rank' か 'time'）"""
+    raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    parts = raw.split('|')
+    if parts[0] == 'r' and len(parts) == 4:
+        return 'rank', (float(parts[1]), int(parts[2])), datetime.fromisoformat(parts[3])
+    if parts[0] == 't' and len(parts) == 3:
+        return 'time', (datetime.fromisoformat(parts[1]), int(parts[2])), None
+    raise ValueError("不正なカーソルです")
+
+def _search_conditions(user_id, terms):
+    conditions = ' AND '.join([f"{HISTORY_SEARCH_EXPRESSION} ILIKE %s"] * len(terms))
+    return f"user_id = %s AND {conditions}", [user_id, *(_like_pattern(term) for term in terms)]
+
+def build_history_search_query(user_id, terms, after=None, limit=20, as_of=None):
+    """検索のSQLと引数を返す（as_of までのすべての語を含む新しい行を、関連度・新しい順に並べる）
+
+    各行には順位付けした件数（matched）と、その中で最も古い行（oldest_timestamp, oldest_id）も付ける。
+    """
+    where, where_params = _search_conditions(user_id, terms)
+    if as_of:
+        where += " AND timestamp <= %s"
+        where_params.append(as_of)
+    query = f"""
+        SELECT id, timestamp, image_key, thumbnail_key, rank, matched, oldest_timestamp, oldest_id,
+               substr(search_text, greatest(strpos(lower(search_text), lower(%s)) - 40, 1), %s) AS snippet
+        FROM (
+            SELECT id, timestamp, image_key, thumbnail_key, search_text,
+                   word_similarity(%s, search_text)::float8 AS rank,
+                   count(*) OVER () AS matched,
+                   first_value(timestamp) OVER oldest AS oldest_timestamp,
+                   first_value(id) OVER oldest AS oldest_id
+            FROM (
+                SELECT id, timestamp, image_key, thumbnail_key, {HISTORY_SEARCH_EXPRESSION} AS search_text
+                FROM history
+                WHERE {where}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT %s
+            ) recent
+            WINDOW oldest AS (ORDER BY timestamp, id)
+        ) matches
+    """
+    params = [terms[0], HISTORY_SNIPPET_LENGTH, ' '.join(terms), *where_params, HISTORY_SEARCH_MAX_RANKED]
+    if after:
+        query += " WHERE (rank, id) < (%s, %s)"
+        params.extend(after)
+    query += " ORDER BY rank DESC, id DESC LIMIT %s"
+    params.append(limit)
+    return query, params
+
+def build_history_search_older_query(user_id, terms, before, limit=20):
+    """順位付けした範囲より古い一致を、(timestamp, id) が before より前から新しい順に返すSQLと引数"""
+    where, where_params = _search_conditions(user_id, terms)
+    query = f"""
+        SELECT id, timestamp, image_key, thumbnail_key, word_similarity(%s, search_text)::float8 AS rank,
+               substr(search_text, greatest(strpos(lower(search_text), lower(%s)) - 40, 1), %s) AS snippet
+        FROM (
+            SELECT id, timestamp, image_key, thumbnail_key, {HISTORY_SEARCH_EXPRESSION} AS search_text
+            FROM history
+            WHERE {where} AND (timestamp, id) < (%s, %s)
+            ORDER BY timestamp DESC, id DESC
+            LIMIT %s
+        ) older
+        ORDER BY timestamp DESC, id DESC
+    """
+    params = [' '.join(terms), terms[0], HISTORY_SNIPPET_LENGTH, *where_params, *before, limit]
+    return query, params
+
+@app.route('/history/search', methods=['GET'])
+@rate_limit(max_calls=20, period=60)
+def search_history():
+    try:
+        user_id = request.args.get('user_id', 'default_user')
+        try:
+            limit = parse_page_limit()
+        except ValueError:
+            return jsonify({"error": "limit は整数で指定してください"}), 400
+        query_text = request.args.get('q', '').strip()
+        if not query_text:
+            return jsonify({"error": "検索語を入力してください"}), 400
+        if len(query_text) > HISTORY_SEARCH_MAX_LENGTH:
+            return jsonify({"error": f"検索語は{HISTORY_SEARCH_MAX_LENGTH}文字以内で入力してください"}), 400
+        cursor = request.args.get('cursor')
+        try:
+            mode, after, as_of = decode_search_cursor(cursor) if cursor else ('rank', None, None)
+        except ValueError:
+            return jsonify({"error": "不正なカーソルです"}), 400
+        
+        terms = parse_search_terms(query_text)
+        if mode == 'time':
+            query, params = build_history_search_older_query(user_id, terms, after, limit + 1)
+        else:
+            as_of = as_of or datetime.now(timezone.utc)
+            query, params = build_history_search_query(user_id, terms, after, limit + 1, as_of=as_of)
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        results = []
+        for row in rows:
+            full_url, thumbnail_url = history_image_urls(row, user_id)
+            results.append({
+                "id": row['id'],
+                "timestamp": row['timestamp'].isoformat(),
+                "preview": row['snippet'],
+                "truncated": True,
+                "rank": row['rank'],
+                "image_url": full_url,
+                "thumbnail_url": thumbnail_url,
+            })
+        next_cursor = None
+        if mode == 'time':
+            if has_more:
+                next_cursor = encode_search_older_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+        elif has_more:
+            next_cursor = encode_search_cursor(rows[-1]['rank'], rows[-1]['id'], as_of)
+        elif rows and rows[0]['matched'] >= HISTORY_SEARCH_MAX_RANKED:
+            # 順位付けした分を返し終えた。残りの古い一致は新しい順に続ける
+            next_cursor = encode_search_older_cursor(rows[0]['oldest_timestamp'], rows[0]['oldest_id'])
+        
+        # order: このページの並び順（relevance: 関連度順、recent: 順位付けの範囲外の古い一致を新しい順）
+        order = 'recent' if mode == 'time' else 'relevance'
+        return jsonify({
+            "history": results, "query": query_text, "limit": limit, "order": order, "next_cursor": next_cursor
+        })
+        
+    except Exception as e:
+        logger.error(f"Error in history search: {str(e)}")
+        return jsonify({"error": "履歴の検索に失敗しました"}), 500
+
+# 履歴の詳細
+@app.route('/history/<int:history_id>', methods=['GET'])
+def get_history_detail(history_id):
+    try:
+        user_id = request.args.get('user_id', 'default_user')
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(
+                    "SELECT id, school_id, timestamp, image_key, thumbnail_key, explanation FROM history WHERE id = %s AND user_id = %s",
+                    (history_id, user_id)
+                )
+                row = cur.fetchone()
+        
+        if not row:
+            return jsonify({"error": "履歴が見つかりません"}), 404
+        
+        full_url, thumbnail_url = history_image_urls(row, user_id)
+        return jsonify({
+            "id": row['id'],
+            "school_id": row['school_id'],
+            "timestamp": row['timestamp'].isoformat(),
+            "explanation": row['explanation'],
+            "image_url": full_url,
+            "thumbnail_url": thumbnail_url,
+        })
+        
+    except Exception as e:
+        logger.error(f"Error in history detail: {str(e)}")
+        return jsonify({"error": "履歴の取得に失敗しました"}), 500
+
+# 再質問のスレッド
+@app.route('/history/<int:history_id>/messages', methods=['GET'])
+def get_history_messages(history_id):
+    try:
+        user_id = request.args.get('user_id', 'default_user')
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 FROM history WHERE id = %s AND user_id = %s", (history_id, user_id))
+                if cur.fetchone() is None:
+                    return jsonify({"error": "履歴が見つかりません"}), 404
+        
+        messages = load_thread(history_id)
+        for message in messages:
+            message['created_at'] = message['created_at'].isoformat()
+        return jsonify({"messages": messages})
+        
+    except Exception as e:
+        logger.error(f"Error in history messages: {str(e)}")
+        return jsonify({"error": "スレッドの取得に失敗しました"}), 500
+
+# 未移行の履歴画像（image_base64）の配信
+@app.route('/history/<int:history_id>/image', methods=['GET'])
+def get_legacy_history_image(history_id):
+    user_id = request.args.get('user_id', 'default_user')
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            cur.execute(
+                "SELECT image_key, image_base64 FROM history WHERE id = %s AND user_id = %s",
+                (history_id, user_id)
+            )
+            row = cur.fetchone()
+    if not row:
+        abort(404)
+    if row['image_key']:
+        return Response(status=301, headers={'Location': image_url(row['image_key'])})
+    data = base64.b64decode(row['image_base64'])
+    response = Response(data, mimetype=detect_image_mimetype(data[:16]))
+    response.cache_control.max_age = 3600
+    return response
+
+# 画像配信（コンテンツアドレスなので無期限にキャッシュできる）
+@app.route('/image/<key>', methods=['GET'])
+def get_image(key):
+    if not is_valid_key(key):
+        abort(404)
+    try:
+        path = blob_store.local_path(key)
+        if path:
+            with open(path, 'rb') as f:
+                mimetype = detect_image_mimetype(f.read(16))
+            response = send_file(path, mimetype=mimetype, conditional=True, etag=key, max_age=IMAGE_CACHE_MAX_AGE)
+        else:
+            data = blob_store.get(key)
+            response = Response(data, mimetype=detect_image_mimetype(data[:16]))
+            response.set_etag(key)
+            response.cache_control.public = True
+            response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+            response = response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+        response.cache_control.immutable = True
+        return response
+    except FileNotFoundError:
+        abort(404)
+
+# キューの長さと待ち時間の見積もり（混雑状況の表示用）
+@app.route('/api/queue/stats', methods=['GET'])
+def queue_stats():
+    try:
+        return jsonify({"queues": get_queue_stats(), "worker_slots": QUEUE_WORKER_SLOTS})
+    except Exception as e:
+        logger.error(f"Error in queue stats: {str(e)}")
+        return jsonify({"error": "キューの状態の取得に失敗しました"}), 500
+
+# 解説キャッシュの統計
+@app.route('/api/cache/stats', methods=['GET'])
+def result_cache_stats():
+    try:
+        return jsonify(get_result_cache_stats())
+    except Exception as e:
+        logger.error(f"Error in result_cache_stats: {str(e)}")
+        return jsonify({"error": "キャッシュ統計の取得に失敗しました"}), 500
+
+# 学校単位の履歴エクスポートと統計（教員向け）
+# Authorization: Bearer <EXPORT_TOKEN> が必要（未設定なら常に拒否）
+EXPORT_TOKEN = os.getenv('EXPORT_TOKEN')
+# サーバー側カーソルから一度に取り出す行数（メモリ使用量は結果の件数によらずこの行数分で済む）
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 500))
+# エクスポート中は接続を1本占有するので、プロセスあたりの同時実行数を接続プールより小さく抑える
+EXPORT_MAX_CONCURRENT = int(os.getenv('EXPORT_MAX_CONCURRENT', 1))
+SCHOOL_STATS_MAX_DAYS = 366
+EXPORT_COLUMNS = ['id', 'timestamp', 'user_id', 'grade_level', 'processing_ms', 'problem_text', 'explanation']
+_export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+def require_export_token(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        auth = request.headers.get('Authorization', '')
+        if not EXPORT_TOKEN or auth != f"Bearer {EXPORT_TOKEN}":
+            return jsonify({"error": "認証が必要です"}), 401
+        return f(*args, **kwargs)
+    return wrapper
+
+def parse_date_range(default_days=None):
+    """from / to（YYYY-MM-DD、toを含む）を学校のタイムゾーンの日付として読む"""
+    today = datetime.now(ZoneInfo(SCHOOL_TIMEZONE)).date()
+    to_day = date.fromisoformat(request.args['to']) if request.args.get('to') else today
+    if request.args.get('from'):
+        from_day = date.fromisoformat(request.args['from'])
+    elif default_days:
+        from_day = to_day - timedelta(days=default_days - 1)
+    else:
+        raise ValueError("from is required")
+    if from_day > to_day:
+        raise ValueError("from is after to")
+    return from_day, to_day
+
+def _day_start(day):
+    return datetime(day.year, day.month, day.day, tzinfo=ZoneInfo(SCHOOL_TIMEZONE))
+
+def iter_school_history(school_id, from_day, to_day):
+    """学校の履歴を古い順にサーバー側カーソルで EXPORT_BATCH_SIZE 行ずつ取り出す"""
+    with get_db_connection() as conn:
+        # 名前付きカーソルはトランザクション内でだけ有効（接続の返却時に閉じられる）
+        with conn.cursor(name=f"history_export_{uuid.uuid4().hex}",
+                         cursor_factory=psycopg2.extras.DictCursor) as cur:
+            cur.execute(
+                """
+                SELECT id, timestamp, user_id, grade_level, processing_ms, problem_text, explanation,
+                       image_key, thumbnail_key
+                FROM history
+                WHERE school_id = %s AND timestamp >= %s AND timestamp < %s
+                ORDER BY timestamp, id
+                """,
+                (school_id, _day_start(from_day), _day_start(to_day + timedelta(days=1)))
+            )
+            while True:
+                rows = cur.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+
+def export_record(row, base_url=None):
+    """エクスポートの1行（base_url を渡すと画像の絶対URLを含める）"""
+    record = {column: row[column] for column in EXPORT_COLUMNS}
+    record['timestamp'] = row['timestamp'].isoformat()
+    if base_url:
+        full_url, thumbnail_url = history_image_urls(row, row['user_id'])
+        record['image_url'] = base_url + full_url
+        record['thumbnail_url'] = base_url + thumbnail_url
+    return record
+
+@app.route('/api/schools/<school_id>/history/export', methods=['GET'])
+@require_export_token
+def export_school_history(school_id):
+    """学校の履歴をNDJSONまたはCSVでストリーミングする"""
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({"error": "format は ndjson か csv を指定してください"}), 400
+    try:
+        from_day, to_day = parse_date_range()
+    except ValueError:
+        return jsonify({"error": "from / to は YYYY-MM-DD 形式で指定してください"}), 400
+    include_images = request.args.get('include_images') in ('1', 'true')
+    columns = EXPORT_COLUMNS + (['image_url', 'thumbnail_url'] if include_images else [])
+
+    if not _export_slots.acquire(blocking=False):
+        response = jsonify({"error": "他のエクスポートを実行中です。しばらくしてからもう一度お試しください。"})
+        response.status_code = 429
+        response.headers['Retry-After'] = '30'
+        return response
+
+    # ジェネレーターはリクエストコンテキストの外で動くので、必要な値は先に読んでおく
+    base_url = request.host_url.rstrip('/') if include_images else None
+
+    def generate():
+        exported = 0
+        try:
+            if export_format == 'csv':
+                # Excelで文字化けしないようBOMを付ける
+                yield '\ufeff' + ','.join(columns) + '\r\n'
+            for rows in iter_school_history(school_id, from_day, to_day):
+                buffer = io.StringIO()
+                writer = csv.writer(buffer) if export_format == 'csv' else None
+                for row in rows:
+                    record = export_record(row, base_url)
+                    if writer:
+                        writer.writerow([record[column] for column in columns])
+                    else:
+                        buffer.write(json.dumps(record, ensure_ascii=False) + '\n')
+                exported += len(rows)
+                yield buffer.getvalue()
+            logger.info(f"Exported {exported} history rows for school {school_id}")
+        except Exception as e:
+            # ヘッダーは送信済みなので、途中で失敗したことを本文で伝える
+            logger.error(f"Error in export_school_history: {str(e)}")
+            if export_format == 'ndjson':
+                yield json.dumps({"error": "エクスポートが途中で失敗しました", "exported": exported}, ensure_ascii=False) + '\n'
+            else:
+                yield f"# エクスポートが途中で失敗しました（{exported}件まで）\r\n"
+            # 終端のチャンクを送らずに接続を切り、ダウンロード自体を失敗させる（途中までのファイルを完全なものと誤解させない）
+            raise
+
+    if export_format == 'csv':
+        mimetype = 'text/csv; charset=utf-8'
+    else:
+        mimetype = 'application/x-ndjson; charset=utf-8'
+    filename = f"history_{school_id}_{from_day.isoformat()}_{to_day.isoformat()}.{export_format}"
+    response = Response(generate(), mimetype=mimetype, headers={
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}",
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    })
+    # ストリームが終わるか、クライアントが切断したときに枠を返す
+    response.call_on_close(_export_slots.release)
+    return response
+
+@app.route('/api/schools/<school_id>/stats', methods=['GET'])
+@require_export_token
+def school_stats(school_id):
+    """日別・学年別の質問数と平均処理時間（school_daily_stats の集計済みの値を読む）"""
+    try:
+        from_day, to_day = parse_date_range(default_days=30)
+    except ValueError:
+        return jsonify({"error": "from / to は YYYY-MM-DD 形式で指定してください"}), 400
+    if (to_day - from_day).days >= SCHOOL_STATS_MAX_DAYS:
+        return jsonify({"error": f"期間は{SCHOOL_STATS_MAX_DAYS}日以内で指定してください"}), 400
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(
+                    """
+                    SELECT day, grade_level, questions, processing_ms_sum, processing_count
+                    FROM school_daily_stats
+                    WHERE school_id = %s AND day BETWEEN %s AND %s
+                    ORDER BY day, grade_level
+                    """,
+                    (school_id, from_day, to_day)
+                )
+                rows = cur.fetchall()
+
+        def average_seconds(ms_sum, count):
+            return round(ms_sum / count / 1000, 2) if count else None
+
+        days = {}
+        grades = {}
+        for row in rows:
+            day = days.setdefault(row['day'].isoformat(), {
+                "date": row['day'].isoformat(), "questions": 0, "by_grade": {},
+                "processing_ms_sum": 0, "processing_count": 0,
+            })
+            day["questions"] += row['questions']
+            day["by_grade"][row['grade_level']] = row['questions']
+            day["processing_ms_sum"] += row['processing_ms_sum']
+            day["processing_count"] += row['processing_count']
+            grade = grades.setdefault(row['grade_level'], {"questions": 0, "processing_ms_sum": 0, "processing_count": 0})
+            grade["questions"] += row['questions']
+            grade["processing_ms_sum"] += row['processing_ms_sum']
+            grade["processing_count"] += row['processing_count']
+
+        daily = [{
+            "date": day["date"],
+            "questions": day["questions"],
+            "by_grade": day["by_grade"],
+            "avg_processing_seconds": average_seconds(day["processing_ms_sum"], day["processing_count"]),
+        } for day in days.values()]
+        by_grade = {name: {
+            "questions": grade["questions"],
+            "avg_processing_seconds": average_seconds(grade["processing_ms_sum"], grade["processing_count"]),
+        } for name, grade in grades.items()}
+        total_ms = sum(grade["processing_ms_sum"] for grade in grades.values())
+        total_count = sum(grade["processing_count"] for grade in grades.values())
+
+        return jsonify({
+            "school_id": school_id,
+            "from": from_day.isoformat(),
+            "to": to_day.isoformat(),
+            "timezone": SCHOOL_TIMEZONE,
+            "total_questions": sum(grade["questions"] for grade in grades.values()),
+            "avg_processing_seconds": average_seconds(total_ms, total_count),
+            "by_grade": by_grade,
+            "daily": daily,
+        })
+    except Exception as e:
+        logger.error(f"Error in school_stats: {str(e)}")
+        return jsonify({"error": "統計の取得に失敗しました"}), 500
+
+# 監視ダッシュボードとメトリクスAPI
+# Authorization: Bearer <MONITORING_TOKEN> が必要（未設定なら常に拒否）
+def require_monitoring_token(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        auth = request.headers.get('Authorization', '')
+        if not MONITORING_TOKEN or auth != f"Bearer {MONITORING_TOKEN}":
+            return jsonify({"error": "認証が必要です"}), 401
+        return f(*args, **kwargs)
+    return wrapper
+
+def _monitoring_gauges():
+    """Celeryのキューの長さや接続プールなど、その時点の値"""
+    gauges = {"process_uptime_seconds": time.time() - PROCESS_STARTED_AT}
+    try:
+        for queue, stats in get_queue_stats().items():
+            gauges[f"celery_queue_depth_{queue}"] = stats["depth"]
+            gauges[f"celery_queue_estimated_wait_seconds_{queue}"] = stats["estimated_wait_seconds"]
+    except Exception as e:
+        logger.warning(f"Could not read Celery queue depth: {e}")
+    try:
+        gauges["openai_circuit_open"] = 0 if openai_circuit.state()["state"] == "closed" else 1
+    except Exception as e:
+        logger.warning(f"Could not read circuit breaker state: {e}")
+    pool = db_pool.metrics()
+    gauges["db_pool_in_use"] = pool["in_use"]
+    gauges["db_pool_idle"] = pool["idle"]
+    return gauges
+
+@app.route('/monitoring')
+def monitoring():
+    return render_template('monitoring.html')
+
+@app.route('/api/metrics/current', methods=['GET'])
+@require_monitoring_token
+def metrics_current():
+    try:
+        extra = {"gauges": _monitoring_gauges(), "database_pool": db_pool.metrics()}
+        try:
+            extra["result_cache"] = get_result_cache_stats()
+            extra["openai_circuit"] = openai_circuit.state()
+        except Exception as e:
+            logger.warning(f"Could not read result cache stats: {e}")
+        return jsonify(metrics.current(extra=extra))
+    except Exception as e:
+        logger.error(f"Error in metrics_current: {str(e)}")
+        return jsonify({"error": "メトリクスの取得に失敗しました"}), 500
+
+@app.route('/api/metrics/history', methods=['GET'])
+@require_monitoring_token
+def metrics_history():
+    try:
+        hours = float(request.args.get('hours', 24))
+    except ValueError:
+        return jsonify({"error": "hours は時間数で指定してください"}), 400
+    if not math.isfinite(hours):
+        return jsonify({"error": "hours は時間数で指定してください"}), 400
+    hours = min(max(hours, 0), 24)
+
+    try:
+        return jsonify(metrics.history(hours))
+    except Exception as e:
+        logger.error(f"Error in metrics_history: {str(e)}")
+        return jsonify({"error": "メトリクスの取得に失敗しました"}), 500
+
+@app.route('/api/errors', methods=['GET'])
+@require_monitoring_token
+def recent_errors():
+    try:
+        limit = parse_page_limit(default=10, maximum=200)
+    except ValueError:
+        return jsonify({"error": "limit は整数で指定してください"}), 400
+
+    try:
+        return jsonify(metrics.recent_errors(limit))
+    except Exception as e:
+        logger.error(f"Error in recent_errors: {str(e)}")
+        return jsonify({"error": "エラーログの取得に失敗しました"}), 500
+
+@app.route('/metrics', methods=['GET'])
+@require_monitoring_token
+def prometheus_metrics():
+    return Response(metrics.prometheus(_monitoring_gauges()), mimetype='text/plain; version=0.0.4')
+
 # ヘルスチェック
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -370,76 +2476,50 @@ def health_check():
     return jsonify({
         "status": status,
         "components": {"database": db_status, "redis": redis_status},
+        "database_pool": db_pool.metrics(),
         "timestamp": datetime.now().isoformat()
     })
 
 
 # ▼▼▼ ここから追加したコード ▼▼▼
+# 再質問はタスクとして実行し、結果は /task/<task_id>（SSE・ロングポーリング）で受け取る
 @app.route('/api/re-question', methods=['POST'])
 @rate_limit(max_calls=10, period=60)
 def re_question():
-    """既存の履歴に対する再質問を処理する"""
+    """既存の履歴に対する再質問を受け付ける"""
     try:
         data = request.get_json()
         history_id = data.get('history_id')
-        question_text = data.get('question_text')
+        question_text = (data.get('question_text') or '').strip()
+        user_id = data.get('user_id', 'default_user')
 
         if not history_id or not question_text:
             return jsonify({"error": "履歴IDと質問内容が必要です"}), 400
+        if len(question_text) > REQUESTION_MAX_CHARS:
+            return jsonify({"error": f"質問は{REQUESTION_MAX_CHARS}文字以内で入力してください"}), 400
 
-        # データベースから元の履歴を取得
         with get_db_connection() as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-                cur.execute("SELECT image_base64, explanation FROM history WHERE id = %s", (int(history_id),))
-                history_item = cur.fetchone()
-
-        if not history_item:
-            return jsonify({"error": "元の質問が見つかりません"}), 404
-
-        original_explanation = history_item['explanation']
-        base64_image = history_item['image_base64']
-
-        # OpenAIへのプロンプトを作成
-        prompt = f"""
-        ユーザーは以前、画像（添付）で質問をし、以下の解説を受け取りました。
-
-        【以前の解説】
-        ---
-        {original_explanation}
-        ---
-
-        この解説と元の画像を踏まえて、ユーザーから以下の追加質問がありました。
-        この質問に対して、分かりやすく、丁寧に追加の解説をしてください。
-
-        【ユーザーの追加質問】
-        「{question_text}」
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 FROM history WHERE id = %s AND user_id = %s", (int(history_id), user_id))
+                if cur.fetchone() is None:
+                    return jsonify({"error": "元の質問が見つかりません"}), 404
 
-        【指示】
-        - 元の画像と以前の解説内容を考慮して回答してください。
-        - 重要な数式は $$...$$ を使って表現してください。
-        """
+        deadline_seconds, deadline = request_deadline()
+        rejected = check_admission(REQUESTION_QUEUE, deadline_seconds)
+        if rejected is not None:
+            return rejected
 
-        # OpenAI APIを呼び出す
-        gpt_response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}",
-                        "detail": "auto"
-                    }}
-                ]}
-            ],
-            max_tokens=1000,
-            temperature=0.7,
-            timeout=60
+        task_id = str(uuid.uuid4())
+        set_task_state(task_id, user_id, 'pending', history_id=int(history_id))
+        re_question_task.apply_async(
+            args=[task_id, user_id, int(history_id), question_text],
+            kwargs={"deadline": deadline},
+            task_id=task_id
         )
+        
+        logger.info(f"Re-question task created for history_id: {history_id}, task_id: {task_id}")
 
-        answer_text = gpt_response.choices[0].message.content.strip()
-        logger.info(f"Successfully answered re-question for history_id: {history_id}")
-
-        return jsonify({"success": True, "answer": answer_text})
+        return jsonify({"success": True, "task_id": task_id})
 
     except Exception as e:
         logger.error(f"Error in re_question: {str(e)}")
@@ -0,0 +1,119 @@
+# bench_history.py - /history のクエリのベンチマーク（OFFSET + SELECT * とキーセットの比較）
+#
+# DATABASE_URL のデータベースにベンチマーク用ユーザーの行を投入するので、
+# 本番ではなく検証用のデータベースで実行すること（事前に init_db.py を実行しておく）。
+#
+#   python bench_history.py --rows 5000 --image-kb 300
+
+import argparse
+import base64
+import json
+import os
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import psycopg2
+import psycopg2.extras
+
+PAGE_SIZE = 20
+PREVIEW_LENGTH = 200
+
+def seed(conn, user_id, rows, image_kb):
+    """旧形式（image_base64 あり）と新形式（image_key あり）の両方の列を持つ行を投入する"""
+    image_base64 = base64.b64encode(os.urandom(image_kb * 1024)).decode('ascii')
+    explanation = "解き方の手順を説明します。$$x^2 + 2x + 1 = 0$$ " * 40
+    start = datetime.now() - timedelta(minutes=rows)
+    with conn.cursor() as cur:
+        batch = []
+        for i in range(rows):
+            batch.append((user_id, 'bench_school', image_base64, uuid.uuid4().hex * 2, explanation, start + timedelta(minutes=i)))
+            if len(batch) == 500:
+                psycopg2.extras.execute_values(cur, "INSERT INTO history (user_id, school_id, image_base64, image_key, explanation, timestamp) VALUES %s", batch)
+                batch = []
+        if batch:
+            psycopg2.extras.execute_values(cur, "INSERT INTO history (user_id, school_id, image_base64, image_key, explanation, timestamp) VALUES %s", batch)
+    conn.commit()
+
+def page_before(cur, user_id, page):
+    """変更前: SELECT * と OFFSET、毎回の COUNT(*)"""
+    cur.execute(
+        "SELECT * FROM history WHERE user_id = %s ORDER BY timestamp DESC LIMIT %s OFFSET %s",
+        (user_id, PAGE_SIZE, page * PAGE_SIZE)
+    )
+    rows = [dict(row) for row in cur.fetchall()]
+    cur.execute("SELECT COUNT(*) AS total FROM history WHERE user_id = %s", (user_id,))
+    total = cur.fetchone()['total']
+    return rows, total, None
+
+def page_after(cur, user_id, cursor):
+    """変更後: 軽量な列だけをキーセットで取得し、件数はカウンターテーブルから読む"""
+    query = (
+        "SELECT id, timestamp, image_key, thumbnail_key, LEFT(explanation, %s) AS preview, "
+        "char_length(explanation) > %s AS truncated FROM history WHERE user_id = %s"
+    )
+    params = [PREVIEW_LENGTH, PREVIEW_LENGTH, user_id]
+    if cursor:
+        query += " AND (timestamp, id) < (%s, %s)"
+        params.extend(cursor)
+    query += " ORDER BY timestamp DESC, id DESC LIMIT %s"
+    params.append(PAGE_SIZE)
+    cur.execute(query, params)
+    rows = [dict(row) for row in cur.fetchall()]
+    cur.execute("SELECT total FROM history_counts WHERE user_id = %s", (user_id,))
+    count_row = cur.fetchone()
+    total = count_row['total'] if count_row else 0
+    next_cursor = (rows[-1]['timestamp'], rows[-1]['id']) if rows else None
+    return rows, total, next_cursor
+
+def measure(conn, user_id, pages, after):
+    """先頭から pages ページ分を順にめくり、ページごとの時間と転送量を返す"""
+    latencies, payloads = [], []
+    cursor = None
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        for page in range(pages):
+            started = time.perf_counter()
+            if after:
+                rows, total, cursor = page_after(cur, user_id, cursor)
+            else:
+                rows, total, _ = page_before(cur, user_id, page)
+            latencies.append(time.perf_counter() - started)
+            payloads.append(len(json.dumps({"history": rows, "total": total}, default=str)))
+    conn.rollback()
+    return latencies, payloads
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def report(label, latencies, payloads):
+    print(f"{label:<8} p50={percentile(latencies, 50) * 1000:8.2f}ms  p95={percentile(latencies, 95) * 1000:8.2f}ms  "
+          f"mean={statistics.mean(latencies) * 1000:8.2f}ms  payload/page={statistics.mean(payloads) / 1024:10.1f}KB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/history クエリのベンチマーク")
+    parser.add_argument('--rows', type=int, default=5000, help="投入する履歴の件数")
+    parser.add_argument('--image-kb', type=int, default=300, help="旧形式の画像1枚あたりのサイズ(KB)")
+    parser.add_argument('--pages', type=int, default=50, help="先頭からめくるページ数")
+    parser.add_argument('--keep', action='store_true', help="終了後に投入した行を削除しない")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    user_id = f"bench_user_{uuid.uuid4().hex[:8]}"
+    try:
+        print(f"seeding {args.rows} rows for {user_id} ...")
+        seed(conn, user_id, args.rows, args.image_kb)
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE history")
+        conn.commit()
+        pages = min(args.pages, args.rows // PAGE_SIZE)
+        report("before", *measure(conn, user_id, pages, after=False))
+        report("after", *measure(conn, user_id, pages, after=True))
+    finally:
+        if not args.keep:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM history WHERE user_id = %s", (user_id,))
+                cur.execute("DELETE FROM history_counts WHERE user_id = %s", (user_id,))
+            conn.commit()
+        conn.close()
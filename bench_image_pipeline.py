@@ -0,0 +1,126 @@
+# bench_image_pipeline.py - 画像正規化パイプラインのステージ別ベンチマーク
+#
+# 使い方:
+#   python bench_image_pipeline.py samples/          # ディレクトリ内の画像を計測
+#   python bench_image_pipeline.py                   # 合成画像で計測
+#   python bench_image_pipeline.py samples/ --phash  # 知覚ハッシュの距離の分布（PHASH_MAX_DISTANCE の決め方）
+
+import argparse
+import io
+import os
+import random
+import time
+
+from PIL import Image, ImageDraw
+
+from image_pipeline import normalize_image, make_thumbnail
+
+STAGES = ['decode', 'orient', 'resize', 'grayscale', 'phash', 'encode', 'thumbnail']
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp'}
+
+def load_corpus(directory):
+    """ディレクトリ内の画像を (名前, バイト列) のリストで返す"""
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+            with open(os.path.join(directory, name), 'rb') as f:
+                corpus.append((name, f.read()))
+    return corpus
+
+def synthetic_corpus(count=8, seed=0):
+    """スマホで撮ったプリントを模した合成画像を作る"""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        size = rng.choice([(4032, 3024), (3024, 4032), (1920, 1080), (1200, 1600)])
+        img = Image.new('RGB', size, (rng.randint(225, 255),) * 3)
+        draw = ImageDraw.Draw(img)
+        for y in range(100, size[1] - 100, 60):
+            draw.line([(80, y), (size[0] - 80, y)], fill=(40, 40, 40), width=3)
+        if i % 2:
+            draw.ellipse([200, 200, 800, 800], outline=(220, 30, 30), width=12)
+        buf = io.BytesIO()
+        fmt = 'PNG' if i % 3 == 0 else 'JPEG'
+        img.save(buf, format=fmt, quality=95)
+        corpus.append((f"synthetic-{i}.{fmt.lower()}", buf.getvalue()))
+    return corpus
+
+def run(corpus, repeat):
+    totals = {stage: 0.0 for stage in STAGES}
+    bytes_in = bytes_out = bytes_thumb = 0
+    print(f"{'image':<24}{'in KB':>10}{'out KB':>10}{'thumb KB':>10}{'size':>12}  gray  " + ''.join(f"{s:>10}" for s in STAGES))
+    for name, data in corpus:
+        timings = {}
+        for _ in range(repeat):
+            normalized = normalize_image(data, timings=timings)
+            thumbnail = make_thumbnail(normalized.data, timings=timings)
+        for stage in STAGES:
+            totals[stage] += timings.get(stage, 0.0) / repeat
+        bytes_in += len(data)
+        bytes_out += len(normalized.data)
+        bytes_thumb += len(thumbnail)
+        print(
+            f"{name[:23]:<24}{len(data) / 1024:>10.1f}{len(normalized.data) / 1024:>10.1f}{len(thumbnail) / 1024:>10.1f}"
+            f"{f'{normalized.width}x{normalized.height}':>12}  {'yes' if normalized.grayscale else 'no ':<4}  "
+            + ''.join(f"{timings.get(s, 0.0) / repeat * 1000:>8.1f}ms" for s in STAGES)
+        )
+    n = len(corpus)
+    print()
+    print(f"images: {n}, repeat: {repeat}")
+    print(f"bytes in: {bytes_in / 1024:.1f} KB, out: {bytes_out / 1024:.1f} KB "
+          f"({bytes_out / bytes_in * 100:.1f}%), thumbnails: {bytes_thumb / 1024:.1f} KB")
+    print("mean time per image: " + ', '.join(f"{s}={totals[s] / n * 1000:.1f}ms" for s in STAGES)
+          + f", total={sum(totals.values()) / n * 1000:.1f}ms")
+
+def _recapture(data, scale, quality):
+    """同じプリントを撮り直した画像の代わりに、縮小して再エンコードした画像を作る"""
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=quality)
+    return buf.getvalue()
+
+def _distance(a, b):
+    return bin(a ^ b).count('1')
+
+def run_phash(corpus):
+    """同じ画像の撮り直しどうしと、別の画像どうしの知覚ハッシュの距離を比べる
+
+    PHASH_MAX_DISTANCE は「別の問題どうしの最小距離」より小さくなければならない
+    （そうでないと別の問題の解説を返してしまう）。
+    """
+    hashes = [normalize_image(data).phash for _, data in corpus]
+    same = []
+    for (name, data), phash in zip(corpus, hashes):
+        for scale, quality in ((0.9, 85), (0.75, 70), (0.5, 60)):
+            same.append(_distance(phash, normalize_image(_recapture(data, scale, quality)).phash))
+    different = [
+        (_distance(hashes[i], hashes[j]), corpus[i][0], corpus[j][0])
+        for i in range(len(hashes)) for j in range(i + 1, len(hashes))
+    ]
+    print(f"same image, recaptured:  min={min(same)} max={max(same)} (n={len(same)})")
+    if not different:
+        print("different images: need at least 2 images")
+        return
+    closest = min(different)
+    print(f"different images:        min={closest[0]} ({closest[1]} / {closest[2]}) (n={len(different)})")
+    safe = closest[0] - 1
+    if safe >= max(same):
+        print(f"PHASH_MAX_DISTANCE up to {safe} separates this corpus")
+    else:
+        print(f"no safe PHASH_MAX_DISTANCE for this corpus: recaptures reach {max(same)}, "
+              f"different images come within {closest[0]} (keep 0)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="画像正規化パイプラインのベンチマーク")
+    parser.add_argument('corpus', nargs='?', help="画像を入れたディレクトリ（省略時は合成画像）")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--phash', action='store_true', help="知覚ハッシュの距離の分布を表示する")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus()
+    if args.phash:
+        run_phash(corpus)
+    else:
+        run(corpus, args.repeat)
+    print(f"elapsed: {time.perf_counter() - started:.1f}s")
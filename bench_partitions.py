@@ -0,0 +1,199 @@
+# bench_partitions.py - 月単位のパーティション化の前後で、直近の履歴を読むクエリと保守の費用を比べる
+#
+# DATABASE_URL のデータベースに使い捨てのスキーマを作り、同じ合成データを
+# パーティションなし（移行前の history と同じ形）と月単位のパーティションの2つのテーブルに投入して比べる。
+# 本番ではなく検証用のデータベースで実行すること。終了時にスキーマごと削除する。
+#
+#   python bench_partitions.py --rows 2000000 --months 24
+
+import argparse
+import os
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+from partitions import add_months, month_start, partition_name
+
+PAGE_SIZE = 20
+PREVIEW_LENGTH = 200
+
+COLUMNS = """
+    id BIGINT NOT NULL,
+    user_id VARCHAR(255) NOT NULL,
+    school_id VARCHAR(255),
+    image_key VARCHAR(64),
+    thumbnail_key VARCHAR(64),
+    explanation TEXT NOT NULL,
+    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+"""
+
+
+def create_tables(cur, months, now):
+    cur.execute(f"CREATE TABLE history_plain ({COLUMNS}, PRIMARY KEY (id))")
+    cur.execute(f"CREATE TABLE history_part ({COLUMNS}, PRIMARY KEY (id, timestamp)) PARTITION BY RANGE (timestamp)")
+    first = add_months(month_start(now), -months)
+    for offset in range(months + 2):
+        month = add_months(first, offset)
+        cur.execute(
+            f"CREATE TABLE {partition_name('history_part', month)} PARTITION OF history_part "
+            f"FOR VALUES FROM (%s) TO (%s)",
+            (month, add_months(month, 1))
+        )
+    return first
+
+
+def create_indexes(cur):
+    for table in ('history_plain', 'history_part'):
+        cur.execute(f"CREATE INDEX ON {table} (user_id, timestamp DESC)")
+        cur.execute(f"CREATE INDEX ON {table} (school_id, timestamp)")
+
+
+def seed(cur, rows, users, schools, start, now):
+    """start から now まで均等に行を投入する（両方のテーブルに同じ行）"""
+    span = (now - start).total_seconds()
+    cur.execute(
+        """
+        INSERT INTO history_plain (id, user_id, school_id, image_key, thumbnail_key, explanation, timestamp)
+        SELECT g, 'user_' || (g %% %(users)s), 'school_' || (g %% %(schools)s),
+               md5(g::text) || md5((g + 1)::text), md5((g + 2)::text) || md5((g + 3)::text),
+               repeat('解き方の手順を説明します。$$x^2 + 2x + 1 = 0$$ ', 20),
+               %(start)s::timestamptz + (g * %(step)s) * interval '1 second'
+        FROM generate_series(1, %(rows)s) g
+        """,
+        {'users': users, 'schools': schools, 'rows': rows, 'start': start, 'step': span / rows}
+    )
+    cur.execute("INSERT INTO history_part SELECT * FROM history_plain")
+
+
+def history_page(table, user_id, now):
+    """/history の最初のページ"""
+    return (
+        f"SELECT id, timestamp, image_key, thumbnail_key, LEFT(explanation, %s) AS preview "
+        f"FROM {table} WHERE user_id = %s ORDER BY timestamp DESC, id DESC LIMIT %s",
+        (PREVIEW_LENGTH, user_id, PAGE_SIZE + 1)
+    )
+
+
+def school_week(table, school_id, now):
+    """学校単位のエクスポート（直近7日）"""
+    return (
+        f"SELECT id, timestamp, user_id, explanation FROM {table} "
+        f"WHERE school_id = %s AND timestamp >= %s AND timestamp < %s ORDER BY timestamp, id",
+        (school_id, now - timedelta(days=7), now)
+    )
+
+
+def recent_count(table, _, now):
+    return f"SELECT COUNT(*) FROM {table} WHERE timestamp >= %s", (now - timedelta(days=1),)
+
+
+def detail_by_id(table, history_id, now):
+    """/history/<id>（パーティションキーを含まないので全パーティションの主キーを引く）"""
+    return f"SELECT id, explanation FROM {table} WHERE id = %s", (history_id,)
+
+
+QUERIES = [
+    ('/history page', history_page, 'user_7'),
+    ('school 7 days', school_week, 'school_7'),
+    ('last 24h count', recent_count, None),
+    ('detail by id', detail_by_id, None),
+]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def measure(cur, sql, params, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cur.execute(sql, params)
+        cur.fetchall()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def scanned_relations(cur, sql, params):
+    """EXPLAIN で実際に読むテーブル（パーティション）の数"""
+    cur.execute("EXPLAIN " + sql, params)
+    return sum(1 for (line,) in cur.fetchall() if 'Scan' in line and ' on ' in line)
+
+
+def timed(cur, sql, params=None):
+    started = time.perf_counter()
+    cur.execute(sql, params)
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="history のパーティション化の前後の比較")
+    parser.add_argument('--rows', type=int, default=2000000, help="投入する履歴の件数")
+    parser.add_argument('--months', type=int, default=24, help="行を散らす過去の月数")
+    parser.add_argument('--users', type=int, default=20000, help="行を振り分けるユーザー数")
+    parser.add_argument('--schools', type=int, default=200, help="行を振り分ける学校数")
+    parser.add_argument('--repeat', type=int, default=30, help="1クエリあたりの計測回数")
+    args = parser.parse_args()
+
+    schema = f"bench_partitions_{uuid.uuid4().hex[:8]}"
+    now = datetime.now(timezone.utc)
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"SET search_path = {schema}")
+        start = create_tables(cur, args.months, now)
+        print(f"seeding {args.rows} rows over {args.months} months into {schema} ...")
+        started = time.perf_counter()
+        seed(cur, args.rows, args.users, args.schools, start, now)
+        create_indexes(cur)
+        cur.execute("VACUUM ANALYZE history_plain")
+        cur.execute("VACUUM ANALYZE history_part")
+        print(f"seeded in {time.perf_counter() - started:.0f}s")
+
+        cur.execute("SELECT max(id) FROM history_plain")
+        recent_id = cur.fetchone()[0] - 10
+        args_by_query = {'detail by id': recent_id}
+
+        print(f"\n{'query':<18}{'layout':<14}{'p50':>10}{'p95':>10}{'mean':>10}  scanned")
+        for label, query, arg in QUERIES:
+            arg = args_by_query.get(label, arg)
+            for layout, table in (('plain', 'history_plain'), ('partitioned', 'history_part')):
+                sql, params = query(table, arg, now)
+                latencies = measure(cur, sql, params, args.repeat)
+                print(f"{label:<18}{layout:<14}{percentile(latencies, 50) * 1000:8.2f}ms"
+                      f"{percentile(latencies, 95) * 1000:8.2f}ms{statistics.mean(latencies) * 1000:8.2f}ms"
+                      f"  {scanned_relations(cur, sql, params)}")
+
+        # 保守の費用: 直近の行を更新したあとの VACUUM と、古い1か月分の削除
+        current = partition_name('history_part', month_start(now))
+        oldest = partition_name('history_part', start)
+        cur.execute("UPDATE history_plain SET thumbnail_key = NULL WHERE timestamp >= %s", (month_start(now),))
+        cur.execute("UPDATE history_part SET thumbnail_key = NULL WHERE timestamp >= %s", (month_start(now),))
+        print("\nmaintenance")
+        print(f"  VACUUM plain table            {timed(cur, 'VACUUM history_plain') * 1000:10.0f}ms")
+        print(f"  VACUUM current partition      {timed(cur, f'VACUUM {current}') * 1000:10.0f}ms")
+        # 削除はどちらもロールバックして、テーブルを元のままにしておく
+        cur.execute("BEGIN")
+        delete_seconds = timed(cur, "DELETE FROM history_plain WHERE timestamp < %s", (add_months(start, 1),))
+        cur.execute("ROLLBACK")
+        cur.execute("BEGIN")
+        drop_seconds = timed(cur, f"ALTER TABLE history_part DETACH PARTITION {oldest}; DROP TABLE {oldest}")
+        cur.execute("ROLLBACK")
+        print(f"  DELETE oldest month (plain)   {delete_seconds * 1000:10.0f}ms")
+        print(f"  DETACH + DROP oldest month    {drop_seconds * 1000:10.0f}ms")
+        cur.execute(
+            "SELECT pg_size_pretty(pg_indexes_size('history_plain')), "
+            "pg_size_pretty(pg_indexes_size(%s))", (current,)
+        )
+        plain_size, current_size = cur.fetchone()
+        print(f"  index size: plain {plain_size}, current partition {current_size}")
+    finally:
+        cur.execute("RESET search_path")
+        cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.close()
@@ -0,0 +1,138 @@
+# bench_search.py - /history/search のクエリのベンチマーク（n-gramインデックスあり・なしの比較）
+#
+# DATABASE_URL のデータベースの history に合成データを数百万行投入するので、
+# 本番ではなく検証用のデータベースで実行すること（事前に init_db.py を実行しておく）。
+# インデックスなしの計測はトランザクション内で DROP INDEX してロールバックするので、
+# 計測中は history への書き込みが止まる。
+#
+#   python bench_search.py --rows 2000000 --users 20000 --heavy-rows 50000
+
+import argparse
+import os
+import statistics
+import time
+import uuid
+
+import psycopg2
+
+os.environ.setdefault('OPENAI_API_KEY', 'bench')
+from app import HISTORY_SEARCH_EXPRESSION, build_history_search_query, parse_search_terms
+from migrations import HISTORY_SEARCH_INDEX
+
+PAGE_SIZE = 20
+
+TOPICS = [
+    '二次方程式', '一次関数', '連立方程式', '因数分解', '平方根', '三角形の合同', '円周角', '確率',
+    '比例', '反比例', '相似', '三平方の定理', '二次関数', '判別式', '解の公式', '接線', '数列',
+    'ベクトル', '対数', '指数関数', '三角関数', '微分', '積分', '面積', '体積', '速さ', '割合',
+]
+FILLER = [
+    '考え方', '手順', 'まず', '次に', 'したがって', '式', '求める', '代入', '整理', '両辺', '移項',
+    '条件', '文字で置く', '答え', 'ここで', 'よって', '確認', 'グラフ', '図', '値', '$x$', '$y$',
+    '$$ax + b = c \\tag{1}$$', '$$x^2 + px + q = 0 \\tag{2}$$',
+]
+# ごく一部の行の問題文にだけ現れる語
+RARE_TERM = '複素数平面'
+
+QUERIES = [
+    ('common term', '二次方程式'),
+    ('two terms', '二次関数 接線'),
+    ('rare term', RARE_TERM),
+    ('2-char term', '確率'),
+]
+
+
+def seed(conn, prefix, rows, users, heavy_rows):
+    """合成データを投入する（heavy_rows 行は1人のユーザーにまとめる）"""
+    vocabulary = TOPICS + FILLER * 4
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO history (user_id, school_id, image_key, explanation, problem_text, timestamp)
+            SELECT
+                CASE WHEN g <= %(heavy)s THEN %(prefix)s || 'heavy' ELSE %(prefix)s || (g %% %(users)s) END,
+                'bench_school',
+                md5(g::text) || md5((g + 1)::text),
+                (SELECT string_agg(w, ' ') FROM (
+                    SELECT (%(vocabulary)s::text[])[1 + floor(random() * %(size)s)::int] AS w
+                    FROM generate_series(1, 60) WHERE g > 0
+                ) words),
+                CASE WHEN random() < 0.001 THEN %(rare)s || ' 上の点の移動'
+                     ELSE (%(topics)s::text[])[1 + floor(random() * %(topic_count)s)::int] || 'の問題' END,
+                now() - (g || ' minutes')::interval
+            FROM generate_series(1, %(rows)s) g
+            """,
+            {
+                'prefix': prefix, 'users': users, 'heavy': heavy_rows, 'rows': rows,
+                'vocabulary': vocabulary, 'size': len(vocabulary),
+                'topics': TOPICS, 'topic_count': len(TOPICS), 'rare': RARE_TERM,
+            }
+        )
+        cur.execute("ANALYZE history")
+    conn.commit()
+
+
+def measure(cur, user_id, query_text, repeat):
+    terms = parse_search_terms(query_text)
+    sql, params = build_history_search_query(user_id, terms, limit=PAGE_SIZE + 1)
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        latencies.append(time.perf_counter() - started)
+    cur.execute("EXPLAIN " + sql, params)
+    plan = [line for (line,) in cur.fetchall() if 'Scan' in line]
+    return latencies, len(rows), plan[0].strip() if plan else ''
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_suite(conn, label, users, repeat):
+    print(f"\n[{label}]")
+    with conn.cursor() as cur:
+        for user_label, user_id in users:
+            for query_label, query_text in QUERIES:
+                latencies, hits, plan = measure(cur, user_id, query_text, repeat)
+                print(f"{user_label:<14}{query_label:<14} p50={percentile(latencies, 50) * 1000:8.2f}ms "
+                      f"p95={percentile(latencies, 95) * 1000:8.2f}ms mean={statistics.mean(latencies) * 1000:8.2f}ms "
+                      f"hits={hits:>3}  {plan[:70]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/history/search クエリのベンチマーク")
+    parser.add_argument('--rows', type=int, default=2000000, help="投入する履歴の件数")
+    parser.add_argument('--users', type=int, default=20000, help="行を振り分けるユーザー数")
+    parser.add_argument('--heavy-rows', type=int, default=50000, help="1人に集中させる行数")
+    parser.add_argument('--repeat', type=int, default=20, help="1クエリあたりの計測回数")
+    parser.add_argument('--keep', action='store_true', help="終了後に投入した行を削除しない")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    prefix = f"bench_search_{uuid.uuid4().hex[:8]}_"
+    try:
+        print(f"seeding {args.rows} rows for {prefix}* ...")
+        started = time.perf_counter()
+        seed(conn, prefix, args.rows, args.users, args.heavy_rows)
+        print(f"seeded in {time.perf_counter() - started:.0f}s (index maintained on insert)")
+
+        users = [('typical user', f"{prefix}{args.rows // 2 % args.users}"), ('heavy user', f"{prefix}heavy")]
+        run_suite(conn, f"with {HISTORY_SEARCH_INDEX}", users, args.repeat)
+
+        # インデックスなしの状態をトランザクション内だけで再現する
+        with conn.cursor() as cur:
+            cur.execute(f"DROP INDEX {HISTORY_SEARCH_INDEX}")
+        run_suite(conn, f"without {HISTORY_SEARCH_INDEX}", users, args.repeat)
+        conn.rollback()
+        print(f"\nindex expression: {HISTORY_SEARCH_EXPRESSION}")
+    finally:
+        conn.rollback()
+        if not args.keep:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM history WHERE user_id LIKE %s", (prefix + '%',))
+                cur.execute("DELETE FROM history_counts WHERE user_id LIKE %s", (prefix + '%',))
+            conn.commit()
+        conn.close()
@@ -0,0 +1,125 @@
+# bench_startup.py - プロセスの起動から最初のリクエストを処理するまでの時間を測る
+#
+# render.yaml の起動コマンドと同じ順序（init_db.py → gunicorn / Celeryワーカー）で何度か起動し、
+# 段階ごとの所要時間の中央値を報告する。
+#   init_db       python init_db.py（スキーマが最新なら何もしない）
+#   import app    python -c "import app"
+#   gunicorn      起動から /health が最初に応答するまで
+#   celery        起動から最初のタスク（reconcile_task_states）が完了するまで
+# REDIS_URL と DATABASE_URL は検証用の環境を指すこと（事前に init_db.py を実行しておく）。
+#
+#   python bench_startup.py --runs 5 --output after.json
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+from celery import Celery
+
+# Celeryのタスク名は定義したモジュール名から付く（app.py の reconcile_task_states）
+PROBE_TASK = 'app.reconcile_task_states'
+# render.yaml のワーカーと同じキュー（beat は含めない）
+WORKER_QUEUES = 're_question,analysis,background,celery'
+POLL_INTERVAL = 0.02
+
+
+def time_command(command, env):
+    """コマンドの実行にかかった秒数"""
+    started = time.perf_counter()
+    subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def time_gunicorn(args, env):
+    """gunicorn を起動してから /health が最初に応答するまでの秒数"""
+    url = f"http://127.0.0.1:{args.port}/health"
+    started = time.perf_counter()
+    web = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(args.web_workers), '--threads', '8',
+         '--timeout', '60', '--bind', f"127.0.0.1:{args.port}", 'app:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = started + args.timeout
+        while time.perf_counter() < deadline:
+            if web.poll() is not None:
+                raise RuntimeError(f"gunicorn が終了しました (exit {web.returncode})")
+            try:
+                # Redis やデータベースの状態で 503 を返しても、リクエストを処理できたことには変わりない
+                httpx.get(url, timeout=2)
+                return time.perf_counter() - started
+            except httpx.HTTPError:
+                time.sleep(POLL_INTERVAL)
+        raise RuntimeError("Webサーバーが起動しませんでした")
+    finally:
+        stop(web)
+
+
+def time_celery(args, env, producer):
+    """Celeryワーカーを起動してから最初のタスクが完了するまでの秒数
+
+    タスクは起動と同時にキューに入れておき、ワーカーが読み始めたらすぐに処理されるようにする。
+    """
+    started = time.perf_counter()
+    worker = subprocess.Popen(
+        [sys.executable, '-m', 'celery', '-A', 'app.celery', 'worker', '-Q', WORKER_QUEUES,
+         '--pool', 'threads', '--concurrency', '4', '--loglevel=warning'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        producer.send_task(PROBE_TASK, queue='celery').get(timeout=args.timeout)
+        return time.perf_counter() - started
+    finally:
+        stop(worker)
+
+
+def summarize(samples):
+    return {
+        name: {"median": statistics.median(values), "min": min(values), "max": max(values)}
+        for name, values in samples.items()
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="起動から最初のリクエストを処理するまでの時間の計測")
+    parser.add_argument('--runs', type=int, default=5, help="段階ごとの計測回数")
+    parser.add_argument('--port', type=int, default=8765, help="gunicorn を待ち受けさせるポート")
+    parser.add_argument('--web-workers', type=int, default=2, help="gunicorn のワーカー数（render.yaml と同じ2）")
+    parser.add_argument('--timeout', type=float, default=120, help="1回の起動を待つ上限（秒）")
+    parser.add_argument('--output', help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+
+    redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+    # OpenAI には接続しないので、キーはダミーでよい
+    env = dict(os.environ, OPENAI_API_KEY=os.getenv('OPENAI_API_KEY', 'unused'))
+    producer = Celery(broker=redis_url, backend=redis_url)
+
+    samples = {"init_db": [], "import app": [], "gunicorn": [], "celery": []}
+    for run in range(args.runs):
+        samples["init_db"].append(time_command([sys.executable, 'init_db.py'], env))
+        samples["import app"].append(time_command([sys.executable, '-c', 'import app'], env))
+        samples["gunicorn"].append(time_gunicorn(args, env))
+        samples["celery"].append(time_celery(args, env, producer))
+        print(f"run {run + 1}/{args.runs}: " + ", ".join(f"{name} {values[-1]:.2f}s" for name, values in samples.items()))
+
+    summary = summarize(samples)
+    print(f"\n{'stage':<12}{'median':>10}{'min':>10}{'max':>10}")
+    for name, stats in summary.items():
+        print(f"{name:<12}{stats['median']:9.2f}s{stats['min']:9.2f}s{stats['max']:9.2f}s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"runs": args.runs, "stages": summary}, f, indent=2)
@@ -0,0 +1,128 @@
+# bench_worker_pool.py - Celeryワーカーのプール方式（prefork / threads）の比較
+#
+# ダミーのOpenAIサーバー（fake_openai.py）を立ててワーカーを起動し、解析タスクを
+# まとめて投入して、スループット・タスク所要時間・ワーカーのメモリ使用量を測る。
+# REDIS_URL と DATABASE_URL は検証用の環境を指すこと（事前に init_db.py を実行しておく）。
+#
+#   python bench_worker_pool.py --pool prefork --concurrency 4 --tasks 40
+#   python bench_worker_pool.py --pool threads --concurrency 64 --tasks 200
+
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+import psutil
+from PIL import Image, ImageDraw
+
+from fake_openai import serve
+
+def make_image(seed):
+    """キャッシュに当たらないよう、タスクごとに異なる画像を作る"""
+    img = Image.new('RGB', (1200, 1600), (250, 250, 250))
+    draw = ImageDraw.Draw(img)
+    for i in range(40):
+        y = 40 + i * 38
+        draw.line([(60, y), (60 + (seed * 37 + i * 53) % 1000, y)], fill=(30, 30, 30), width=4)
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=90)
+    return buf.getvalue()
+
+def tree_rss(process):
+    """ワーカーの親プロセスと子プロセスのRSS合計（バイト）"""
+    total = 0
+    for proc in [process] + process.children(recursive=True):
+        try:
+            total += proc.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+def start_worker(pool, concurrency, base_url):
+    env = dict(
+        os.environ,
+        OPENAI_BASE_URL=base_url,
+        OPENAI_API_KEY='fake',
+        CELERY_WORKER_POOL=pool,
+        CELERY_WORKER_CONCURRENCY=str(concurrency),
+        RESULT_CACHE_ENABLED='false',
+    )
+    return subprocess.Popen(
+        [sys.executable, '-m', 'celery', '-A', 'app.celery', 'worker', '-Q', 're_question,analysis,background',
+         '--loglevel=warning'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+def run(args):
+    os.environ['RESULT_CACHE_ENABLED'] = 'false'
+    import app
+
+    server, base_url = serve(latency=args.latency)
+    worker = start_worker(args.pool, args.concurrency, base_url)
+    worker_proc = psutil.Process(worker.pid)
+    user_id = f"bench_pool_{uuid.uuid4().hex[:8]}"
+    task_ids = []
+    try:
+        # ワーカーの起動を待ってからアイドル時のメモリを測る
+        time.sleep(args.warmup)
+        idle_rss = tree_rss(worker_proc)
+
+        images = [make_image(i) for i in range(args.tasks)]
+        enqueued_at = {}
+        started = time.perf_counter()
+        for image_data in images:
+            task_id = str(uuid.uuid4())
+            app.set_task_state(task_id, user_id, 'pending')
+            image_ref = app.stage_upload(task_id, image_data)
+            app.analyze_image_task.apply_async(args=[task_id, user_id, 'bench_school', image_ref, 'junior-high'], task_id=task_id)
+            enqueued_at[task_id] = time.perf_counter()
+            task_ids.append(task_id)
+
+        durations = {}
+        peak_rss = idle_rss
+        deadline = time.perf_counter() + args.timeout
+        while len(durations) < len(task_ids) and time.perf_counter() < deadline:
+            peak_rss = max(peak_rss, tree_rss(worker_proc))
+            pending = [t for t in task_ids if t not in durations]
+            results = app.redis_client.mget([f"task_result:{t}" for t in pending])
+            now = time.perf_counter()
+            for task_id, result in zip(pending, results):
+                if result and json.loads(result).get('status') in ('completed', 'failed'):
+                    durations[task_id] = now - enqueued_at[task_id]
+            time.sleep(0.2)
+        elapsed = time.perf_counter() - started
+
+        values = sorted(durations.values())
+        in_flight = min(args.concurrency, args.tasks)
+        print(f"pool={args.pool} concurrency={args.concurrency} tasks={args.tasks} latency={args.latency}s")
+        print(f"completed: {len(values)}/{args.tasks} in {elapsed:.1f}s -> {len(values) / elapsed:.2f} tasks/s")
+        if values:
+            print(f"task time: p50={values[len(values) // 2]:.2f}s p95={values[min(len(values) - 1, int(len(values) * 0.95))]:.2f}s "
+                  f"mean={statistics.mean(values):.2f}s")
+        print(f"worker RSS: idle={idle_rss / 2**20:.0f}MB peak={peak_rss / 2**20:.0f}MB "
+              f"per in-flight task={(peak_rss - idle_rss) / in_flight / 2**20:.1f}MB "
+              f"(processes={1 + len(worker_proc.children(recursive=True))})")
+    finally:
+        worker.terminate()
+        worker.wait(timeout=30)
+        server.shutdown()
+        with app.get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM history WHERE user_id = %s", (user_id,))
+                cur.execute("DELETE FROM history_counts WHERE user_id = %s", (user_id,))
+                cur.execute("DELETE FROM task_status WHERE user_id = %s", (user_id,))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Celeryワーカーのプール方式の比較")
+    parser.add_argument('--pool', choices=['prefork', 'threads'], default='prefork')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--tasks', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=5.0, help="ダミーAPIの応答時間（秒）")
+    parser.add_argument('--warmup', type=float, default=5.0, help="ワーカー起動待ちの秒数")
+    parser.add_argument('--timeout', type=float, default=600.0)
+    run(parser.parse_args())
@@ -0,0 +1,350 @@
+# blob_store.py - 画像などのバイナリをSHA-256キーで保存するストア
+
+import os
+import re
+import hashlib
+import tempfile
+import logging
+import threading
+import importlib.util
+
+logger = logging.getLogger(__name__)
+
+# 画像形式の判定用マジックバイト
+_IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+def detect_image_mimetype(head):
+    """先頭バイトから画像のMIMEタイプを判定する"""
+    for signature, mimetype in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def blob_key(data):
+    """バイト列からコンテンツアドレス（SHA-256の16進数）を計算する"""
+    return hashlib.sha256(data).hexdigest()
+
+
+_KEY_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+def is_valid_key(key):
+    """キーがSHA-256の16進数文字列（hexdigest() と同じ小文字64桁）かどうか
+
+    int(key, 16) は '0x'・'_'・前後の空白・大文字も受け付けるので、同じ画像に別のキーができてしまう。
+    """
+    return bool(key) and _KEY_PATTERN.fullmatch(key) is not None
+
+
+# ステージング（一時保存）の名前。タスクIDをそのまま使うので、パスやS3キーに使える文字だけを許す
+_STAGING_NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,128}')
+
+
+def _check_staging_name(name):
+    if not name or _STAGING_NAME_PATTERN.fullmatch(name) is None:
+        raise ValueError(f"不正なステージング名です: {name!r}")
+    return name
+
+
+class LocalBlobStore:
+    """ローカルファイルシステム上のブロブストア
+
+    ab/cd/abcd... のように2階層に分けて保存する。書き込みは一時ファイル経由で
+    rename するため、同じキーを複数プロセスが同時に書いても壊れない。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.staging_root = os.path.join(root, 'staging')
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        if not is_valid_key(key):
+            raise ValueError(f"不正なブロブキーです: {key!r}")
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, data):
+        key = blob_key(data)
+        path = self._path(key)
+        if os.path.exists(path):
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return key
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def local_path(self, key):
+        """send_file で直接配信できるパスを返す（存在しなければNone）"""
+        path = self._path(key)
+        return path if os.path.exists(path) else None
+
+    def head(self, key, size=16):
+        with open(self._path(key), 'rb') as f:
+            return f.read(size)
+
+    def _staging_path(self, name):
+        return os.path.join(self.staging_root, _check_staging_name(name))
+
+    def put_staged(self, name, data):
+        """コンテンツアドレスとは別に、名前（タスクID）で一時保存する"""
+        os.makedirs(self.staging_root, exist_ok=True)
+        path = self._staging_path(name)
+        fd, tmp_path = tempfile.mkstemp(dir=self.staging_root, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def get_staged(self, name):
+        with open(self._staging_path(name), 'rb') as f:
+            return f.read()
+
+    def delete_staged(self, name):
+        try:
+            os.unlink(self._staging_path(name))
+        except FileNotFoundError:
+            pass
+
+    def purge_staged(self, older_than):
+        """older_than（UNIX時刻）より前に一時保存したものを消し、消した件数を返す"""
+        purged = 0
+        try:
+            entries = list(os.scandir(self.staging_root))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < older_than:
+                    os.unlink(entry.path)
+                    purged += 1
+            except FileNotFoundError:
+                pass
+        return purged
+
+
+class S3BlobStore:
+    """S3互換ストレージ上のブロブストア（boto3が必要）
+
+    boto3 の import とクライアントの構築は最初の呼び出しまで遅らせ、fork した子プロセスでは作り直す。
+    """
+
+    def __init__(self, bucket, prefix='blobs/', endpoint_url=None, storage_class=None, staging_prefix='staging/'):
+        if importlib.util.find_spec('boto3') is None:
+            raise RuntimeError("S3ブロブストアを使うには boto3 をインストールしてください")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.staging_prefix = staging_prefix
+        self.storage_class = storage_class
+        self.endpoint_url = endpoint_url
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def s3(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    self._client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self._client
+
+    def _object_key(self, key):
+        if not is_valid_key(key):
+            raise ValueError(f"不正なブロブキーです: {key!r}")
+        return f"{self.prefix}{key}"
+
+    def put(self, data):
+        key = blob_key(data)
+        if not self.exists(key):
+            extra = {'StorageClass': self.storage_class} if self.storage_class else {}
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=self._object_key(key),
+                Body=data,
+                ContentType=detect_image_mimetype(data[:16]),
+                **extra,
+            )
+        return key
+
+    def get(self, key):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        except self.s3.exceptions.NoSuchKey as e:
+            raise FileNotFoundError(key) from e
+        return obj['Body'].read()
+
+    def exists(self, key):
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except Exception:
+            return False
+
+    def delete(self, key):
+        self.s3.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def local_path(self, key):
+        return None
+
+    def head(self, key, size=16):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self._object_key(key), Range=f"bytes=0-{size - 1}")
+        except self.s3.exceptions.NoSuchKey as e:
+            raise FileNotFoundError(key) from e
+        return obj['Body'].read()
+
+    def _staging_key(self, name):
+        return f"{self.staging_prefix}{_check_staging_name(name)}"
+
+    def put_staged(self, name, data):
+        """コンテンツアドレスとは別に、名前（タスクID）で一時保存する
+
+        staging_prefix 以下はバケットのライフサイクルルールでも期限切れにできるよう、
+        ブロブの prefix とは分けておく。
+        """
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self._staging_key(name),
+            Body=data,
+            ContentType=detect_image_mimetype(data[:16]),
+        )
+
+    def get_staged(self, name):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self._staging_key(name))
+        except self.s3.exceptions.NoSuchKey as e:
+            raise FileNotFoundError(name) from e
+        return obj['Body'].read()
+
+    def delete_staged(self, name):
+        self.s3.delete_object(Bucket=self.bucket, Key=self._staging_key(name))
+
+    def purge_staged(self, older_than):
+        """older_than（UNIX時刻）より前に一時保存したものを消し、消した件数を返す"""
+        purged = 0
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.staging_prefix):
+            stale = [
+                {'Key': obj['Key']} for obj in page.get('Contents', [])
+                if obj['LastModified'].timestamp() < older_than
+            ]
+            if stale:
+                self.s3.delete_objects(Bucket=self.bucket, Delete={'Objects': stale, 'Quiet': True})
+                purged += len(stale)
+        return purged
+
+
+class TieredBlobStore:
+    """よく使う画像を置くストア（hot）と古い画像を移すストア（cold）を1つに見せる
+
+    書き込みと削除は hot だけに行い、読み出しは hot になければ cold から行う。
+    """
+
+    def __init__(self, hot, cold):
+        self.hot = hot
+        self.cold = cold
+
+    def put(self, data):
+        return self.hot.put(data)
+
+    def get(self, key):
+        try:
+            return self.hot.get(key)
+        except FileNotFoundError:
+            return self.cold.get(key)
+
+    def exists(self, key):
+        return self.hot.exists(key) or self.cold.exists(key)
+
+    def delete(self, key):
+        self.hot.delete(key)
+
+    def local_path(self, key):
+        return self.hot.local_path(key)
+
+    def head(self, key, size=16):
+        try:
+            return self.hot.head(key, size)
+        except FileNotFoundError:
+            return self.cold.head(key, size)
+
+    def put_staged(self, name, data):
+        self.hot.put_staged(name, data)
+
+    def get_staged(self, name):
+        return self.hot.get_staged(name)
+
+    def delete_staged(self, name):
+        self.hot.delete_staged(name)
+
+    def purge_staged(self, older_than):
+        return self.hot.purge_staged(older_than)
+
+    def archive(self, key, data=None, keep_hot=False):
+        """cold にコピーし、keep_hot でなければ hot から消す（data を渡せば hot から読まない）"""
+        if not self.cold.exists(key):
+            if data is None:
+                data = self.hot.get(key)
+            if self.cold.put(data) != key:
+                raise ValueError(f"ブロブの内容がキーと一致しません: {key}")
+        if not keep_hot:
+            self.hot.delete(key)
+
+
+def create_blob_store(env_prefix='BLOB_STORE'):
+    """環境変数からブロブストアを生成する
+
+    BLOB_STORE_BACKEND=local（デフォルト）なら BLOB_STORE_DIR 以下に保存する。
+    Webとワーカーが別ホストの場合は共有ディスクか s3 を指定すること。
+    env_prefix=COLD_BLOB_STORE のように変えると、同じ形式の別の設定を読む。
+    """
+    backend = os.getenv(f'{env_prefix}_BACKEND', 'local')
+    if backend == 's3':
+        return S3BlobStore(
+            bucket=os.environ[f'{env_prefix}_BUCKET'],
+            prefix=os.getenv(f'{env_prefix}_PREFIX', 'blobs/'),
+            endpoint_url=os.getenv(f'{env_prefix}_ENDPOINT_URL'),
+            storage_class=os.getenv(f'{env_prefix}_STORAGE_CLASS'),
+            staging_prefix=os.getenv(f'{env_prefix}_STAGING_PREFIX', 'staging/'),
+        )
+    if backend == 'local':
+        default_dir = os.path.join(os.getcwd(), env_prefix.lower())
+        return LocalBlobStore(os.getenv(f'{env_prefix}_DIR', default_dir))
+    raise ValueError(f"未対応の{env_prefix}_BACKENDです: {backend}")
@@ -0,0 +1,207 @@
+# fake_openai.py - ベンチマーク用のOpenAI互換のダミーサーバー
+#
+# /v1/chat/completions だけを実装し、指定した分布の時間だけ待ってから定型の解説を返す。
+# 有料APIを呼ばずにワーカーや負荷試験を動かすために使う。app.py の OpenAI クライアントは
+# 環境変数 OPENAI_BASE_URL を読むので、それをこのサーバーに向ければよい。
+#
+#   python fake_openai.py --port 8900 --latency lognormal:8,0.4 --error 429=0.02 --error 500=0.01
+#   OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=fake celery -A app.celery worker
+#
+# レイテンシの指定: 秒数（固定）/ uniform:最小,最大 / lognormal:中央値,sigma
+# 注入できるエラー: 429（retry-after付き）・500・503・disconnect（応答せずに切断）・hang（応答しない）
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_EXPLANATION = (
+    "【考え方】\n問題文から分かっていることを整理します。\n\n"
+    "【手順】\n1. 求めるものを文字で置きます。\n2. 条件から式を立てます。\n"
+    "$$ax + b = c \\tag{1}$$\n3. 式(1)を x について解きます。\n"
+)
+ERROR_KINDS = ('429', '500', '503', 'disconnect', 'hang')
+
+
+class LatencyModel:
+    """1回の補完にかける秒数の分布"""
+
+    def __init__(self, spec):
+        spec = str(spec)
+        kind, _, params = spec.partition(':')
+        if not params:
+            kind, params = 'fixed', spec
+        values = [float(v) for v in params.split(',')]
+        if kind == 'fixed' and len(values) == 1:
+            self.sample = lambda rng: values[0]
+        elif kind == 'uniform' and len(values) == 2:
+            self.sample = lambda rng: rng.uniform(values[0], values[1])
+        elif kind == 'lognormal' and len(values) == 2:
+            self.sample = lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+        else:
+            raise ValueError(f"不正なレイテンシの指定です: {spec}")
+        self.spec = spec
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = LatencyModel(1.0)
+    # エラーの種類ごとの発生確率（例: {'429': 0.02}）
+    errors = {}
+    # hang のときに応答せずに待つ秒数（クライアントのタイムアウトより長くする）
+    hang_seconds = 90.0
+    chunk_size = 8
+    rng = random.Random()
+    rng_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _draw(self):
+        """このリクエストのレイテンシと注入するエラー（なければNone）を決める"""
+        with self.rng_lock:
+            latency = max(0.0, self.latency.sample(self.rng))
+            roll = self.rng.random()
+        for kind, rate in self.errors.items():
+            if roll < rate:
+                return latency, kind
+            roll -= rate
+        return latency, None
+
+    def do_POST(self):
+        if not self.path.endswith('/chat/completions'):
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        model = body.get('model', 'gpt-5')
+        latency, error = self._draw()
+        if error is not None:
+            self._error(error)
+        elif body.get('stream'):
+            self._stream(model, latency, include_usage=(body.get('stream_options') or {}).get('include_usage', False))
+        else:
+            time.sleep(latency)
+            self._json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": CANNED_EXPLANATION},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 800, "completion_tokens": 120, "total_tokens": 920},
+            })
+
+    def _error(self, kind):
+        if kind == 'hang':
+            time.sleep(self.hang_seconds)
+            self.close_connection = True
+            return
+        if kind == 'disconnect':
+            time.sleep(0.05)
+            self.close_connection = True
+            return
+        status = int(kind)
+        messages = {429: "Rate limit reached", 500: "The server had an error", 503: "The engine is currently overloaded"}
+        headers = {'retry-after': '2'} if status == 429 else {}
+        self._json(status, {"error": {"message": messages[status], "type": "fake_error", "code": None}}, headers)
+
+    def _json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, model, latency, include_usage=False):
+        """レイテンシを各チャンクに均等に割り振ってSSEで返す
+
+        include_usage なら、本物のAPIと同じく choices が空で usage だけを持つチャンクを最後に送る。
+        """
+        chunks = [CANNED_EXPLANATION[i:i + self.chunk_size] for i in range(0, len(CANNED_EXPLANATION), self.chunk_size)]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for i, text in enumerate(chunks + [None]):
+            time.sleep(latency / (len(chunks) + 1))
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "delta": {"content": text} if text is not None else {},
+                    "finish_reason": None if text is not None else "stop",
+                }],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+        if include_usage:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": {"prompt_tokens": 800, "completion_tokens": 120, "total_tokens": 920},
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def serve(port=0, latency=1.0, background=True, errors=None, seed=None, hang_seconds=90.0):
+    """ダミーサーバーを起動し、(サーバー, base_url) を返す
+
+    latency は秒数か分布の指定文字列、errors はエラーの種類ごとの発生確率。
+    seed を指定すると、同じリクエスト順なら同じレイテンシとエラーが再現される。
+    """
+    errors = dict(errors or {})
+    unknown = set(errors) - set(ERROR_KINDS)
+    if unknown:
+        raise ValueError(f"不明なエラーの種類です: {', '.join(sorted(unknown))}")
+    handler = type('ConfiguredHandler', (FakeOpenAIHandler,), {
+        'latency': LatencyModel(latency),
+        'errors': errors,
+        'hang_seconds': hang_seconds,
+        'rng': random.Random(seed),
+        'rng_lock': threading.Lock(),
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, base_url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI互換のダミーサーバー")
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', default='1.0', help="1回の補完にかける秒数、または uniform:a,b / lognormal:中央値,sigma")
+    parser.add_argument('--error', action='append', default=[], metavar='KIND=RATE',
+                        help=f"エラーの注入（KIND は {' / '.join(ERROR_KINDS)}、複数指定可）")
+    parser.add_argument('--hang-seconds', type=float, default=90.0, help="hang のときに応答しない秒数")
+    parser.add_argument('--seed', type=int, help="乱数のシード")
+    args = parser.parse_args()
+    errors = {kind: float(rate) for kind, rate in (item.split('=', 1) for item in args.error)}
+    server, base_url = serve(args.port, args.latency, background=False, errors=errors,
+                             seed=args.seed, hang_seconds=args.hang_seconds)
+    print(f"fake OpenAI server listening on {base_url} (latency={args.latency}, errors={errors or 'none'})")
+    server.serve_forever()
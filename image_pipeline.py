@@ -0,0 +1,202 @@
+# image_pipeline.py - Vision API に送る前の画像の正規化
+
+import io
+import os
+import time
+from collections import namedtuple
+
+from PIL import Image, ImageOps
+
+# 長辺の上限。これより大きくてもモデル側で縮小されるだけなので送る意味がない
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', 1568))
+# エンコード後のサイズ上限（バイト）
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', 800 * 1024))
+# 出力形式: JPEG または WEBP
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+# グレースケール化: auto（色がほぼない画像だけ）/ always / never
+IMAGE_GRAYSCALE = os.getenv('IMAGE_GRAYSCALE', 'auto')
+# 履歴一覧用サムネイルの長辺
+THUMBNAIL_EDGE = int(os.getenv('THUMBNAIL_EDGE', 320))
+# デコードする画素数の上限。小さなファイルが巨大な画像に展開されてワーカーのメモリを使い切るのを防ぐ
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', 40_000_000))
+
+# 彩度がこれを超える画素が一定割合未満なら白黒のプリント・ノートとみなす
+# （赤ペンの書き込みなど、小さくても色が意味を持つ部分は残したい）
+GRAYSCALE_SATURATION_THRESHOLD = 64
+GRAYSCALE_COLORED_RATIO = 0.002
+JPEG_QUALITY_STEPS = (85, 75, 65, 55, 45)
+
+_MIMETYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+# 可逆圧縮の元画像（スクリーンショットや線画）。縮小した画像をJPEGにすると元の数倍に膨らむことがあるので、
+# PNG（カラーは256色のパレット）でも圧縮して小さいほうを使う
+LOSSLESS_SOURCE_FORMATS = ('PNG', 'GIF')
+PNG_PALETTE_COLORS = 256
+
+NormalizedImage = namedtuple('NormalizedImage', ['data', 'mimetype', 'width', 'height', 'grayscale', 'phash'])
+
+
+class _StageTimer:
+    """ステージごとの処理時間（秒）を timings に記録する"""
+
+    def __init__(self, timings):
+        self.timings = timings
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        if self.timings is not None:
+            self.timings[stage] = self.timings.get(stage, 0.0) + (now - self.last)
+        self.last = now
+
+
+def _is_mostly_gray(img):
+    """縮小コピーの彩度から、色情報がほとんどない画像かを判定する"""
+    sample = img.copy()
+    sample.thumbnail((128, 128))
+    histogram = sample.convert('HSV').getchannel('S').histogram()
+    colored = sum(histogram[GRAYSCALE_SATURATION_THRESHOLD + 1:])
+    return colored < sum(histogram) * GRAYSCALE_COLORED_RATIO
+
+
+def perceptual_hash(img):
+    """64ビットの差分ハッシュ（dHash）を返す
+
+    撮り直した同じプリントのように、見た目がほぼ同じ画像はハミング距離が小さくなる。
+    """
+    small = img.convert('L').resize((9, 8), Image.BOX)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _to_rgb(img):
+    """透過やパレットを白背景のRGBに変換する"""
+    if img.mode in ('RGB', 'L'):
+        return img
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def _encode(img, image_format, max_bytes):
+    """サイズ上限に収まるまで品質、次に解像度を下げてエンコードする"""
+    while True:
+        for quality in JPEG_QUALITY_STEPS:
+            buf = io.BytesIO()
+            img.save(buf, format=image_format, quality=quality, optimize=True)
+            if buf.tell() <= max_bytes:
+                return buf.getvalue(), img
+        if max(img.size) <= THUMBNAIL_EDGE:
+            return buf.getvalue(), img
+        img = img.resize((max(1, img.width * 3 // 4), max(1, img.height * 3 // 4)), Image.LANCZOS)
+
+
+def _encode_png(img):
+    """PNGでエンコードする（カラーは減色してから。白黒はそのまま8ビットのグレースケール）"""
+    if img.mode == 'RGB':
+        img = img.quantize(PNG_PALETTE_COLORS)
+    buf = io.BytesIO()
+    img.save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+
+def _can_send_source(data, width, height, max_bytes):
+    """元の画像を再エンコードせずにそのまま送れるか
+
+    縮小も向きの補正も要らず、そのまま送れる形式で、EXIF（撮影位置など）も透過もない場合だけ。
+    """
+    if len(data) > max_bytes:
+        return False
+    src = Image.open(io.BytesIO(data))
+    return (
+        src.format in _MIMETYPES
+        and src.size == (width, height)
+        and getattr(src, 'n_frames', 1) == 1
+        and 'exif' not in src.info
+        and 'transparency' not in src.info
+        and 'A' not in src.mode
+    )
+
+
+def _open_image(data, edge):
+    """画像を開き、長辺 edge 程度までの縮小デコードを指示する
+
+    画素数の確認は draft() の後、load() の前に行う。JPEGはデコード時に縮小されるので
+    高画素のスマートフォン写真は通り、縮小できない形式の巨大な画像はデコード前に弾かれる。
+    """
+    img = Image.open(io.BytesIO(data))
+    img.draft(img.mode, (edge, edge))  # JPEGはデコード時に縮小できる
+    if img.width * img.height > IMAGE_MAX_PIXELS:
+        raise Image.DecompressionBombError(
+            f"画像が大きすぎます: {img.width}x{img.height} ({IMAGE_MAX_PIXELS} 画素まで)"
+        )
+    return img
+
+
+def normalize_image(data, max_edge=None, max_bytes=None, image_format=None, grayscale=None, timings=None):
+    """画像をデコードし、向き補正・縮小・グレースケール化・再エンコードする
+
+    PNGなどの元画像はPNGでも圧縮し、縮小などが要らなかった画像は元のバイト列とも比べて、
+    サイズ上限に収まるうちで最も小さいものを返す。
+    timings に dict を渡すとステージごとの処理時間（秒）が記録される。
+    """
+    max_edge = max_edge or IMAGE_MAX_EDGE
+    max_bytes = max_bytes or IMAGE_MAX_BYTES
+    image_format = image_format or IMAGE_FORMAT
+    grayscale = grayscale or IMAGE_GRAYSCALE
+    timer = _StageTimer(timings)
+
+    img = _open_image(data, max_edge)
+    source_format = img.format
+    img.load()
+    timer.mark('decode')
+
+    img = ImageOps.exif_transpose(img)
+    timer.mark('orient')
+
+    img = _to_rgb(img)
+    img.thumbnail((max_edge, max_edge), Image.LANCZOS, reducing_gap=3.0)
+    timer.mark('resize')
+
+    is_gray = img.mode == 'L' or grayscale == 'always' or (grayscale == 'auto' and _is_mostly_gray(img))
+    if is_gray:
+        img = img.convert('L')
+    timer.mark('grayscale')
+
+    phash = perceptual_hash(img)
+    timer.mark('phash')
+
+    processed = img
+    encoded, img = _encode(img, image_format, max_bytes)
+    output_format = image_format
+    if source_format in LOSSLESS_SOURCE_FORMATS:
+        png = _encode_png(processed)
+        if len(png) < len(encoded) and len(png) <= max_bytes:
+            encoded, img, output_format = png, processed, 'PNG'
+    if len(data) < len(encoded) and _can_send_source(data, processed.width, processed.height, max_bytes):
+        encoded, img, output_format = data, processed, Image.open(io.BytesIO(data)).format
+    timer.mark('encode')
+
+    return NormalizedImage(encoded, _MIMETYPES[output_format], img.width, img.height, is_gray, phash)
+
+
+def make_thumbnail(data, edge=None, timings=None):
+    """履歴一覧用のサムネイルを作る"""
+    edge = edge or THUMBNAIL_EDGE
+    timer = _StageTimer(timings)
+    img = _open_image(data, edge)
+    # 16ビットのPNG（I・I;16）などはそのままでは縮小できないので、先にRGBにする
+    img = _to_rgb(ImageOps.exif_transpose(img))
+    img.thumbnail((edge, edge), Image.LANCZOS, reducing_gap=3.0)
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=70, optimize=True)
+    timer.mark('thumbnail')
+    return buf.getvalue()
@@ -1,9 +1,15 @@
 # init_db.py (改良版)
+#
+# 起動のたびに実行される（render.yaml）。未適用のマイグレーションだけを適用し、
+# スキーマが最新ならそのまま終わる。app は import しない（Redis・Celery・OpenAI の初期化が不要なため）。
+# --prepare-only ではマイグレーションを適用せず、時間のかかるインデックスを書き込みを止めずに作るだけにする
+# （デプロイ前に実行する。render.yaml の preDeployCommand）。
 
 import os
+import sys
 import time
 import logging
-from app import app, init_db
+from migrations import migrate, prepare_history_search_index
 
 # psycopg2.OperationalError をインポートして、特定のエラーを捕捉する
 try:
@@ -16,9 +22,18 @@ except ImportError:
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def wait_for_db_and_initialize():
+def prepare_indexes():
+    """マイグレーションが必要とするインデックスを CONCURRENTLY で先に作っておく"""
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        prepare_history_search_index(conn)
+    finally:
+        conn.close()
+
+def wait_for_db_and_initialize(prepare_only=False):
     """
-    データベースが利用可能になるまで待機し、その後テーブルを初期化する。
+    データベースが利用可能になるまで待機し、その後未適用のマイグレーションを適用する。
     """
     max_retries = 15
     retry_interval = 5  # 5秒ごと
@@ -27,9 +42,11 @@ def wait_for_db_and_initialize():
 
     for attempt in range(max_retries):
         try:
-            # appコンテキスト内でデータベース初期化を実行
-            with app.app_context():
-                init_db()
+            if prepare_only:
+                prepare_indexes()
+                logger.info("インデックスの準備に成功しました。")
+                return
+            migrate()
             logger.info("データベースの初期化に成功しました。")
             return # 成功したら関数を抜ける
         except OperationalError as e:
@@ -46,4 +63,4 @@ def wait_for_db_and_initialize():
             exit(1)
 
 if __name__ == "__main__":
-    wait_for_db_and_initialize()
\ No newline at end of file
+    wait_for_db_and_initialize(prepare_only='--prepare-only' in sys.argv[1:])
\ No newline at end of file
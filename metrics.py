@@ -0,0 +1,301 @@
+# metrics.py - リクエスト・OpenAI・Celery・DBの計測とRedisへの集計
+
+import os
+import json
+import time
+import bisect
+import atexit
+import logging
+import threading
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# レイテンシのヒストグラムの境界（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Redis上の集計単位（秒）と保持期間
+BUCKET_SECONDS = int(os.getenv('METRICS_BUCKET_SECONDS', 300))
+RETENTION_SECONDS = 25 * 3600
+# プロセス内の集計をRedisへ書き出す間隔（秒）
+FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 10))
+MAX_STORED_ERRORS = 200
+
+PROCESS_STARTED_AT = time.time()
+
+
+class MetricsRecorder:
+    """計測値をプロセス内で集計し、一定間隔でRedisの時間バケットに加算する
+
+    記録時の処理は辞書の加算だけなので、リクエストの処理中にRedisへの
+    往復は発生しない。全ワーカーの値は同じハッシュに HINCRBYFLOAT で足し込まれる。
+    フィールド名は「種類|名前|統計」（例: req|/upload|count）。
+    """
+
+    def __init__(self, redis_client, prefix='metrics'):
+        self.redis = redis_client
+        self.prefix = prefix
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(float)
+        self._errors = deque(maxlen=MAX_STORED_ERRORS)
+        self._flusher = None
+
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flusher', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Failed to flush metrics: {e}")
+
+    def _add(self, fields):
+        bucket = int(time.time()) // BUCKET_SECONDS * BUCKET_SECONDS
+        with self._lock:
+            for field, value in fields:
+                self._pending[(bucket, field)] += value
+        self._ensure_flusher()
+
+    def observe(self, kind, name, seconds, error=False):
+        """レイテンシを1件記録する"""
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        le = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else '+Inf'
+        fields = [
+            (f"{kind}|{name}|count", 1),
+            (f"{kind}|{name}|sum", seconds),
+            (f"{kind}|{name}|le_{le}", 1),
+        ]
+        if error:
+            fields.append((f"{kind}|{name}|errors", 1))
+        self._add(fields)
+
+    def record_request(self, endpoint, seconds, status_code):
+        self.observe('req', endpoint, seconds, error=status_code >= 500)
+
+    def record_openai(self, model, seconds, kind='text', prompt_tokens=None, completion_tokens=None,
+                      time_to_first_token=None, error=False):
+        self.observe('openai', model, seconds, error=error)
+        fields = [(f"openai_calls|{kind}|count", 1)]
+        if prompt_tokens:
+            fields.append((f"openai|{model}|prompt_tokens", prompt_tokens))
+        if completion_tokens:
+            fields.append((f"openai|{model}|completion_tokens", completion_tokens))
+        self._add(fields)
+        if time_to_first_token is not None:
+            self.observe('openai_ttft', model, time_to_first_token)
+
+    def record_task(self, name, seconds, failed=False):
+        self.observe('task', name, seconds, error=failed)
+
+    def record_db(self, seconds, error=False):
+        self.observe('db', 'transaction', seconds, error=error)
+
+    def record_error(self, endpoint, message):
+        entry = json.dumps({
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "endpoint": endpoint,
+            "error_message": message[:1000],
+        }, ensure_ascii=False)
+        # flush() のコピーとクリアの間に追加されたエラーを失わないよう、同じロックで追加する
+        with self._lock:
+            self._errors.append(entry)
+        self._ensure_flusher()
+
+    def flush(self):
+        """溜まった計測値をRedisに書き出す"""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+            errors = list(self._errors)
+            self._errors.clear()
+        if not pending and not errors:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        buckets = set()
+        for (bucket, field), value in pending.items():
+            buckets.add(bucket)
+            pipe.hincrbyfloat(f"{self.prefix}:bucket:{bucket}", field, value)
+            pipe.hincrbyfloat(f"{self.prefix}:totals", field, value)
+        for bucket in buckets:
+            pipe.expire(f"{self.prefix}:bucket:{bucket}", RETENTION_SECONDS)
+        if errors:
+            pipe.lpush(f"{self.prefix}:errors", *errors)
+            pipe.ltrim(f"{self.prefix}:errors", 0, MAX_STORED_ERRORS - 1)
+        pipe.execute()
+
+    # ここから下は集計結果の読み出し（ダッシュボード・Prometheus用）
+
+    def _read_buckets(self, seconds):
+        now = int(time.time()) // BUCKET_SECONDS * BUCKET_SECONDS
+        starts = list(range(now - seconds + BUCKET_SECONDS, now + 1, BUCKET_SECONDS))
+        pipe = self.redis.pipeline(transaction=False)
+        for start in starts:
+            pipe.hgetall(f"{self.prefix}:bucket:{start}")
+        return list(zip(starts, pipe.execute()))
+
+    @staticmethod
+    def _summarize(fields):
+        request_counts, error_counts, sums = {}, {}, {}
+        api_calls = {}
+        for field, value in fields.items():
+            kind, name, stat = field.split('|', 2)
+            value = float(value)
+            if kind == 'req':
+                if stat == 'count':
+                    request_counts[name] = request_counts.get(name, 0) + int(value)
+                elif stat == 'errors':
+                    error_counts[name] = error_counts.get(name, 0) + int(value)
+                elif stat == 'sum':
+                    sums[name] = sums.get(name, 0.0) + value
+            elif kind == 'openai_calls' and stat == 'count':
+                api_calls[f"openai_{name}"] = api_calls.get(f"openai_{name}", 0) + int(value)
+            elif kind == 'openai' and stat == 'count':
+                api_calls[name] = api_calls.get(name, 0) + int(value)
+        average_response_times = {
+            name: sums.get(name, 0.0) / count for name, count in request_counts.items() if count
+        }
+        return {
+            "request_counts": request_counts,
+            "error_counts": error_counts,
+            "average_response_times": average_response_times,
+            "api_calls": api_calls,
+        }
+
+    def _merge(self, buckets):
+        merged = defaultdict(float)
+        for _, fields in buckets:
+            for field, value in fields.items():
+                merged[field] += float(value)
+        return merged
+
+    def current(self, window_seconds=3600, extra=None):
+        """直近 window_seconds の集計とプロセス・システムの状態"""
+        merged = self._merge(self._read_buckets(window_seconds))
+        summary = self._summarize(merged)
+        summary["latency"] = {
+            kind: {
+                name: merged[f"{kind}|{name}|sum"] / merged[f"{kind}|{name}|count"]
+                for name in {f.split('|')[1] for f in merged if f.startswith(f"{kind}|")}
+                if merged.get(f"{kind}|{name}|count")
+            }
+            for kind in ('openai', 'openai_ttft', 'task', 'task_stage', 'queue_wait', 'db')
+        }
+        summary["tokens"] = {
+            field.split('|')[1] + ':' + field.split('|')[2]: int(value)
+            for field, value in merged.items() if field.endswith('_tokens')
+        }
+        memory = psutil.virtual_memory()
+        process = psutil.Process()
+        summary["system"] = {
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "memory_percent": memory.percent,
+            "memory_available_mb": memory.available / (1024 * 1024),
+            "process_rss_mb": process.memory_info().rss / (1024 * 1024),
+        }
+        summary["uptime_seconds"] = time.time() - PROCESS_STARTED_AT
+        summary["window_seconds"] = window_seconds
+        summary["timestamp"] = datetime.now(timezone.utc).isoformat()
+        if extra:
+            summary.update(extra)
+        return summary
+
+    def history(self, hours=24):
+        """時間バケットごとの集計（データのあるバケットのみ）"""
+        points = []
+        for start, fields in self._read_buckets(int(hours * 3600)):
+            if not fields:
+                continue
+            point = self._summarize(fields)
+            point["timestamp"] = datetime.fromtimestamp(start, timezone.utc).isoformat()
+            points.append(point)
+        return points
+
+    def recent_errors(self, limit=10):
+        return [json.loads(item) for item in self.redis.lrange(f"{self.prefix}:errors", 0, limit - 1)]
+
+    def prometheus(self, gauges=None):
+        """起動以降の累積値をPrometheusのテキスト形式で返す"""
+        totals = {field: float(value) for field, value in self.redis.hgetall(f"{self.prefix}:totals").items()}
+        series = defaultdict(dict)
+        for field, value in totals.items():
+            kind, name, stat = field.split('|', 2)
+            series[(kind, name)][stat] = value
+
+        metric_names = {
+            'req': ('http_request_duration_seconds', 'endpoint'),
+            'openai': ('openai_request_duration_seconds', 'model'),
+            'openai_ttft': ('openai_time_to_first_token_seconds', 'model'),
+            'task': ('celery_task_duration_seconds', 'task'),
+            'queue_wait': ('celery_queue_wait_seconds', 'queue'),
+            'task_stage': ('celery_task_stage_seconds', 'stage'),
+            'db': ('db_transaction_duration_seconds', 'kind'),
+        }
+        lines = []
+        for kind, (metric, label) in metric_names.items():
+            lines.append(f"# TYPE {metric} histogram")
+            for (series_kind, name), stats in sorted(series.items()):
+                if series_kind != kind:
+                    continue
+                cumulative = 0
+                for le in LATENCY_BUCKETS:
+                    cumulative += stats.get(f"le_{le}", 0)
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{le}"}} {cumulative:g}')
+                cumulative += stats.get("le_+Inf", 0)
+                lines.append(f'{metric}_bucket{{{label}="{name}",le="+Inf"}} {cumulative:g}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {stats.get("sum", 0):g}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {stats.get("count", 0):g}')
+            errors = [(name, stats["errors"]) for (k, name), stats in sorted(series.items()) if k == kind and "errors" in stats]
+            if errors:
+                error_metric = metric.replace('_duration_seconds', '').removesuffix('_seconds') + '_errors_total'
+                lines.append(f"# TYPE {error_metric} counter")
+                for name, value in errors:
+                    lines.append(f'{error_metric}{{{label}="{name}"}} {value:g}')
+
+        lines.append("# TYPE openai_tokens_total counter")
+        for (kind, name), stats in sorted(series.items()):
+            if kind == 'openai':
+                for token_type in ('prompt_tokens', 'completion_tokens'):
+                    if token_type in stats:
+                        lines.append(f'openai_tokens_total{{model="{name}",type="{token_type[:-7]}"}} {stats[token_type]:g}')
+
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+
+class ErrorLogHandler(logging.Handler):
+    """ERROR以上のログを最近のエラーとして記録する
+
+    例外のメッセージにはリクエストの値が含まれうるので、ダッシュボードには
+    「Error in upload: ...」の「: 」より前（どこで失敗したか）と例外の型だけを残す。
+    詳細は通常のログで確認する。
+    """
+
+    def __init__(self, recorder, endpoint_getter):
+        super().__init__(level=logging.ERROR)
+        self.recorder = recorder
+        self.endpoint_getter = endpoint_getter
+
+    def emit(self, record):
+        try:
+            self.recorder.record_error(self.endpoint_getter() or record.funcName, self._summary(record))
+        except Exception:
+            self.handleError(record)
+
+    @staticmethod
+    def _summary(record):
+        summary = record.getMessage().split(': ', 1)[0]
+        if record.exc_info and record.exc_info[0] is not None:
+            summary += f" ({record.exc_info[0].__name__})"
+        return summary
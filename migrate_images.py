@@ -0,0 +1,55 @@
+# migrate_images.py - history.image_base64 の画像をブロブストアへ移行する
+
+import argparse
+import base64
+import logging
+from app import blob_store, get_db_connection
+from image_pipeline import make_thumbnail
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def migrate_batch(batch_size):
+    """未移行の行を1バッチ分ブロブストアへ移し、移行した件数を返す"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            # SKIP LOCKED で複数プロセスから並行して実行できるようにする
+            cur.execute(
+                "SELECT id, image_base64 FROM history WHERE image_key IS NULL AND image_base64 IS NOT NULL "
+                "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED",
+                (batch_size,)
+            )
+            rows = cur.fetchall()
+            for history_id, image_base64 in rows:
+                image_data = base64.b64decode(image_base64)
+                image_key = blob_store.put(image_data)
+                try:
+                    thumbnail_key = blob_store.put(make_thumbnail(image_data))
+                except Exception as e:
+                    logger.warning(f"サムネイルを作成できませんでした (history_id={history_id}): {e}")
+                    thumbnail_key = None
+                cur.execute(
+                    "UPDATE history SET image_key = %s, thumbnail_key = %s, image_base64 = NULL WHERE id = %s",
+                    (image_key, thumbnail_key, history_id)
+                )
+    return len(rows)
+
+def migrate_images(batch_size=100, max_rows=None):
+    """画像をバッチ単位で移行する（1バッチ1トランザクション）"""
+    total = 0
+    while max_rows is None or total < max_rows:
+        size = batch_size if max_rows is None else min(batch_size, max_rows - total)
+        migrated = migrate_batch(size)
+        if migrated == 0:
+            break
+        total += migrated
+        logger.info(f"{total}件の画像を移行しました")
+    logger.info(f"移行完了: 合計{total}件")
+    return total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="history の画像をブロブストアへ移行します")
+    parser.add_argument('--batch-size', type=int, default=100, help="1トランザクションで移行する行数")
+    parser.add_argument('--max-rows', type=int, default=None, help="移行する最大行数（省略時は全件）")
+    args = parser.parse_args()
+    migrate_images(batch_size=args.batch_size, max_rows=args.max_rows)
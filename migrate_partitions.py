@@ -0,0 +1,287 @@
+# migrate_partitions.py - history / task_status を月単位のパーティションテーブルへ無停止で移行する
+#
+# 既存のテーブルの行はコピーせず、テーブルごと <table>_legacy という名前で新しい親テーブルの
+# パーティション（下限なし〜再来月の月初）にする。時間のかかる処理は書き込みを止めないロックで先に済ませ、
+# 書き込みが止まるのは最後の入れ替えのトランザクション（カタログの更新だけ）の間だけ。
+#
+#   1. CHECK (key IS NOT NULL) と CHECK (key < 再来月の月初) を NOT VALID で追加してから VALIDATE する
+#      （ATTACH PARTITION と SET NOT NULL がこの制約を使い、全行の走査を省く）
+#   2. 新しい主キー（元の主キー + key）の一意インデックスを CREATE INDEX CONCURRENTLY で作る
+#   3. 1トランザクションで旧テーブルを改名し、同じ列・インデックス・トリガーの親テーブルを作って ATTACH する
+#
+# 途中で止まっても再実行すれば続きから進む。旧テーブルを参照する外部キー（history_messages.history_id）は
+# パーティションテーブルには張れないので削除する。
+#
+# 既存のデータベースでは次の順に実行する。
+#   a. デプロイ前に --table task_status --prepare-only で2だけを済ませる（render.yaml の preDeployCommand。
+#      init_db.py のバージョン1が task_status の新しい一意インデックスを必要とするため）。
+#      1の上限の CHECK は入れ替えるまでの時限爆弾になる（上限を過ぎると書き込みがすべて失敗する）ので、
+#      入れ替えと同じ実行（c）でだけ追加する。以前の --prepare-only が残した上限の制約はここで削除する
+#   b. init_db.py（デプロイ時に実行される）
+#   c. デプロイ後、負荷の低い時間に引数なしで実行して入れ替える
+# テーブルがまだなければ何もしない（init_db.py が最初からパーティションテーブルとして作る）。
+#
+#   python migrate_partitions.py                 # history と task_status を移行
+#   python migrate_partitions.py --table task_status --dry-run
+#   python migrate_partitions.py --table task_status --prepare-only   # 2だけ（a の手順）
+
+import argparse
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import psycopg2.errors
+
+from partitions import PARTITION_KEYS, PARTITION_MONTHS_AHEAD, add_months, ensure_partitions, is_partitioned, month_start
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 制約の上限と今の差がこれより短ければ、入れ替え前に上限に達して書き込みが失敗するおそれがある
+MIN_BOUND_MARGIN = timedelta(days=7)
+
+
+def legacy_name(table):
+    return f"{table}_legacy"
+
+
+def _fetch_all(conn, query, params):
+    with conn.cursor() as cur:
+        cur.execute(query, params)
+        return cur.fetchall()
+
+
+def _has_constraint(conn, table, name):
+    return bool(_fetch_all(conn, "SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass(%s) AND conname = %s",
+                           (table, name)))
+
+
+def primary_key_columns(conn, table):
+    rows = _fetch_all(conn, """
+        SELECT a.attname FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = to_regclass(%s) AND i.indisprimary
+        ORDER BY array_position(i.indkey::int2[], a.attnum)
+    """, (table,))
+    return [name for (name,) in rows]
+
+
+def prepare_bound_constraints(conn, table, column, lock_timeout):
+    """1. パーティションの範囲を示す CHECK 制約を追加して検証し、上限の時刻を返す"""
+    existing = _fetch_all(conn, """
+        SELECT conname, convalidated FROM pg_constraint
+        WHERE conrelid = to_regclass(%s) AND conname LIKE %s
+    """, (table, f"{table}_before_%"))
+    if existing:
+        # 前回の実行で追加した上限を使う（名前に年月が入っている）
+        bound_name = existing[0][0]
+        match = re.search(r'_before_(\d{4})(\d{2})$', bound_name)
+        bound = datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+    else:
+        bound = add_months(month_start(datetime.now(timezone.utc)), 2)
+        bound_name = f"{table}_before_{bound:%Y%m}"
+    if bound - datetime.now(timezone.utc) < MIN_BOUND_MARGIN:
+        raise RuntimeError(
+            f"{bound_name} の上限 {bound:%Y-%m-%d} が近すぎます。"
+            f"ALTER TABLE {table} DROP CONSTRAINT {bound_name} で削除してから再実行してください"
+        )
+
+    not_null_name = f"{table}_{column}_not_null"
+    with conn.cursor() as cur:
+        # NOT VALID の追加は一瞬で終わり、以降の書き込みにだけ制約がかかる
+        # （ロック待ちの間は後続の読み書きも待たされるので、待つ時間を限る）
+        cur.execute("SET lock_timeout = %s", (lock_timeout,))
+        if not _has_constraint(conn, table, not_null_name):
+            cur.execute(f"ALTER TABLE {table} ADD CONSTRAINT {not_null_name} CHECK ({column} IS NOT NULL) NOT VALID")
+        if not existing:
+            cur.execute(
+                f"ALTER TABLE {table} ADD CONSTRAINT {bound_name} CHECK ({column} < %s) NOT VALID", (bound,)
+            )
+        cur.execute("RESET lock_timeout")
+        # VALIDATE は全行を読むが、SHARE UPDATE EXCLUSIVE なので読み書きは止めない
+        logger.info(f"Validating {not_null_name} and {bound_name} on {table} ...")
+        cur.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {not_null_name}")
+        cur.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {bound_name}")
+    return bound, [not_null_name, bound_name]
+
+
+def drop_bound_constraints(conn, table, lock_timeout):
+    """入れ替えずに残っている上限の CHECK 制約を削除する（--prepare-only のとき）"""
+    names = [name for (name,) in _fetch_all(conn, """
+        SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND conname LIKE %s
+    """, (table, f"{table}_before_%"))]
+    with conn.cursor() as cur:
+        cur.execute("SET lock_timeout = %s", (lock_timeout,))
+        for name in names:
+            logger.info(f"Dropping {name} from {table} (added by an earlier run that did not swap)")
+            cur.execute(f"ALTER TABLE {table} DROP CONSTRAINT {name}")
+        cur.execute("RESET lock_timeout")
+    return names
+
+
+def prepare_key_index(conn, table, columns):
+    """2. 新しい主キーの一意インデックスを読み書きを止めずに作り、名前を返す"""
+    name = f"{table}_{'_'.join(columns)}_key"
+    rows = _fetch_all(conn, """
+        SELECT x.indisvalid FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+        WHERE c.relname = %s AND x.indrelid = to_regclass(%s)
+    """, (name, table))
+    with conn.cursor() as cur:
+        if rows and not rows[0][0]:
+            # 中断した CONCURRENTLY の作成は無効なインデックスを残すので作り直す
+            cur.execute(f"DROP INDEX CONCURRENTLY {name}")
+            rows = []
+        if not rows:
+            logger.info(f"Building {name} concurrently ...")
+            cur.execute(f"CREATE UNIQUE INDEX CONCURRENTLY {name} ON {table} ({', '.join(columns)})")
+    return name
+
+
+def swap(conn, table, column, bound, constraints, key_index, key_columns, lock_timeout, now):
+    """3. 旧テーブルを改名して新しい親テーブルのパーティションにする（1トランザクション）"""
+    legacy = legacy_name(table)
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+        cur.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+
+        # 親テーブルに作り直すため、改名する前の定義（ON public.<table>）を控えておく
+        cur.execute("""
+            SELECT c.relname, pg_get_indexdef(c.oid) FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+            WHERE x.indrelid = to_regclass(%s) AND NOT x.indisunique
+        """, (table,))
+        indexes = cur.fetchall()
+        cur.execute("""
+            SELECT tgname, pg_get_triggerdef(oid) FROM pg_trigger
+            WHERE tgrelid = to_regclass(%s) AND NOT tgisinternal
+        """, (table,))
+        triggers = cur.fetchall()
+        cur.execute("""
+            SELECT s.relname, a.attname FROM pg_depend d
+            JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+            JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+            WHERE d.refobjid = to_regclass(%s) AND d.deptype = 'a'
+        """, (table,))
+        sequences = cur.fetchall()
+        cur.execute("""
+            SELECT conname, conrelid::regclass::text FROM pg_constraint
+            WHERE confrelid = to_regclass(%s) AND contype = 'f'
+        """, (table,))
+        foreign_keys = cur.fetchall()
+        cur.execute("SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'p'", (table,))
+        primary_key = cur.fetchone()
+
+        for name, referencing in foreign_keys:
+            logger.info(f"Dropping foreign key {referencing}.{name}")
+            cur.execute(f"ALTER TABLE {referencing} DROP CONSTRAINT {name}")
+        for name, _ in triggers:
+            cur.execute(f"DROP TRIGGER {name} ON {table}")
+        for name, _ in indexes:
+            cur.execute(f"ALTER INDEX {name} RENAME TO {(name + '_legacy')[:63]}")
+
+        # 旧テーブルの主キーを (元の主キー + key) に付け替える（親の主キーと対応させるため）
+        cur.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL")
+        if primary_key:
+            cur.execute(f"ALTER TABLE {table} DROP CONSTRAINT {primary_key[0]}")
+        cur.execute(f"ALTER TABLE {table} ADD CONSTRAINT {legacy}_pkey PRIMARY KEY USING INDEX {key_index}")
+        cur.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+
+        cur.execute(f"""
+            CREATE TABLE {table} (
+                LIKE {legacy} INCLUDING DEFAULTS INCLUDING STORAGE INCLUDING COMMENTS,
+                PRIMARY KEY ({', '.join(key_columns)})
+            ) PARTITION BY RANGE ({column})
+        """)
+        for sequence, owner_column in sequences:
+            cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.{owner_column}")
+        # 空の親テーブルへの作成なので一瞬で終わる（ATTACH で旧テーブルの同じ定義のインデックスが紐づく）
+        for _, definition in indexes:
+            cur.execute(definition)
+        for _, definition in triggers:
+            cur.execute(definition)
+
+        cur.execute(
+            f"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO (%s)", (bound,)
+        )
+        # パーティションの範囲と同じ内容なので、ATTACH 後は不要
+        for name in constraints:
+            cur.execute(f"ALTER TABLE {legacy} DROP CONSTRAINT {name}")
+        created = ensure_partitions(cur, table, PARTITION_MONTHS_AHEAD, now)
+    return created
+
+
+def _abandon_bound_constraints(conn, table, lock_timeout):
+    """入れ替えなかったときは上限の制約を残さない（上限を過ぎると書き込みが失敗するため）"""
+    conn.autocommit = True
+    try:
+        drop_bound_constraints(conn, table, lock_timeout)
+    finally:
+        conn.autocommit = False
+
+
+def migrate_table(conn, table, lock_timeout, retries, dry_run, prepare_only=False):
+    column = PARTITION_KEYS[table]
+    # 1・2 は CONCURRENTLY などトランザクションの外で実行する必要がある
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s)", (table,))
+        if cur.fetchone()[0] is None:
+            logger.info(f"{table} does not exist yet; init_db.py creates it partitioned")
+            return
+        if is_partitioned(cur, table):
+            logger.info(f"{table} is already partitioned")
+            return
+    key_columns = primary_key_columns(conn, table)
+    key_columns += [] if column in key_columns else [column]
+
+    if prepare_only:
+        drop_bound_constraints(conn, table, lock_timeout)
+        key_index = prepare_key_index(conn, table, key_columns)
+        conn.autocommit = False
+        logger.info(f"{table} prepared: {key_index}")
+        return
+    bound, constraints = prepare_bound_constraints(conn, table, column, lock_timeout)
+    key_index = prepare_key_index(conn, table, key_columns)
+    conn.autocommit = False
+
+    for attempt in range(1, retries + 1):
+        try:
+            started = time.perf_counter()
+            created = swap(conn, table, column, bound, constraints, key_index, key_columns, lock_timeout,
+                           datetime.now(timezone.utc))
+            if dry_run:
+                conn.rollback()
+                logger.info(f"[dry-run] {table} swap succeeded and was rolled back")
+                _abandon_bound_constraints(conn, table, lock_timeout)
+                return
+            conn.commit()
+            logger.info(
+                f"{table} partitioned in {(time.perf_counter() - started) * 1000:.0f}ms: "
+                f"{legacy_name(table)} holds rows before {bound:%Y-%m-%d}, created {', '.join(created)}"
+            )
+            return
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            logger.warning(f"Could not lock {table} within {lock_timeout} (attempt {attempt}/{retries})")
+            time.sleep(min(30, 2 ** attempt))
+    _abandon_bound_constraints(conn, table, lock_timeout)
+    raise RuntimeError(f"{table} の入れ替えに必要なロックを取得できませんでした。負荷の低い時間に再実行してください")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="history / task_status を月単位のパーティションテーブルへ移行します")
+    parser.add_argument('--table', choices=list(PARTITION_KEYS), action='append', help="移行するテーブル（省略時は両方）")
+    parser.add_argument('--lock-timeout', default='2s', help="入れ替え時にロックを待つ最大時間")
+    parser.add_argument('--retries', type=int, default=10, help="ロックを取得できなかったときの再試行回数")
+    parser.add_argument('--dry-run', action='store_true', help="入れ替えまで実行してロールバックする（2は実行され、1の制約は最後に削除する）")
+    parser.add_argument('--prepare-only', action='store_true', help="2だけを実行し、入れ替えはしない（上限の制約は追加せず、残っていれば削除する）")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        for table in args.table or list(PARTITION_KEYS):
+            migrate_table(conn, table, args.lock_timeout, args.retries, args.dry_run, args.prepare_only)
+    finally:
+        conn.close()
@@ -0,0 +1,387 @@
+# migrations.py - バージョン付きのスキーママイグレーション
+#
+# 適用したバージョンを schema_migrations に記録し、未適用のものだけを古い順に
+# 1バージョン1トランザクションで実行する。スキーマが最新なら SELECT 2回で終わる。
+# Webとワーカーが同時に起動しても、アドバイザリーロックで1プロセスだけが適用する。
+#
+# スキーマを変えるときは、適用済みの関数を書き換えずに MIGRATIONS の末尾へ新しいバージョンを追加すること。
+# バージョン1〜7は以前の init_db() の内容で、どれも IF NOT EXISTS なので
+# init_db() で作った既存のデータベースにもそのまま適用できる。ただしパーティション化する前の task_status には
+# (task_id, created_at) の一意インデックスが要る。デプロイ前に
+# migrate_partitions.py --table task_status --prepare-only で書き込みを止めずに作っておく
+# （render.yaml の preDeployCommand）。作られていなければバージョン1が書き込みを止めて作る。
+# 履歴の検索のインデックス（バージョン8）も同じで、デプロイ前に init_db.py --prepare-only
+# （prepare_history_search_index）で書き込みを止めずに作っておく。
+#
+# このモジュールは app を import しない（起動のたびに Redis・Celery・OpenAI の初期化をしないため）。
+
+import os
+import logging
+from datetime import datetime, timezone
+
+import psycopg2
+
+from partitions import PARTITION_KEYS, PARTITION_MONTHS_AHEAD, ensure_partitions, is_partitioned
+
+logger = logging.getLogger(__name__)
+
+# 履歴の検索に使う式（HISTORY_SEARCH_INDEX はこの式そのものに張る。変えるならインデックスも作り直す）
+HISTORY_SEARCH_EXPRESSION = "(coalesce(problem_text, '') || ' ' || explanation)"
+# ユーザーごとの検索インデックス（btree_gin で user_id と式のn-gramを1つのGINインデックスにまとめる）。
+# 全ユーザーで1つのn-gramインデックスでは、ユーザーで絞る前に全員分の一致を集めてしまうため
+HISTORY_SEARCH_INDEX = 'idx_history_search_user_trgm'
+HISTORY_SEARCH_INDEX_COLUMNS = f"user_id, {HISTORY_SEARCH_EXPRESSION} gin_trgm_ops"
+# 日付の区切り（日別の集計とエクスポートの期間指定に使う）。
+# 集計のトリガー関数に埋め込むので、変えたら関数を作り直すマイグレーションを追加すること。
+SCHOOL_TIMEZONE = os.getenv('SCHOOL_TIMEZONE', 'Asia/Tokyo')
+
+# 同時に起動したプロセスのうち1つだけが適用するためのロックのキー
+MIGRATION_LOCK_KEY = 7203451
+
+
+def _has_index(cur, name):
+    cur.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid "
+        "WHERE c.relname = %s AND x.indisvalid)",
+        (name,)
+    )
+    return cur.fetchone()[0]
+
+
+def create_tables(cur):
+    # history と task_status は月単位のレンジパーティション（partitions.py）。
+    # 既存のパーティション化されていないテーブルは migrate_partitions.py で移行する。
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS history (
+        id SERIAL,
+        user_id VARCHAR(255) NOT NULL,
+        school_id VARCHAR(255),
+        image_base64 TEXT,
+        image_key VARCHAR(64),
+        thumbnail_key VARCHAR(64),
+        explanation TEXT NOT NULL,
+        timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp)
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS task_status (
+        task_id VARCHAR(255) NOT NULL,
+        user_id VARCHAR(255) NOT NULL,
+        status VARCHAR(50) NOT NULL,
+        result TEXT,
+        error_message TEXT,
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (task_id, created_at)
+    ) PARTITION BY RANGE (created_at)
+    ''')
+    # 完了・失敗の確定は ON CONFLICT (task_id, created_at) で行うので、移行前のテーブルにも同じ一意インデックスが要る。
+    # 通常はデプロイ前に migrate_partitions.py の手順2（CREATE INDEX CONCURRENTLY）で作ってある。
+    # 作られていなければ（preDeployCommand より先にワーカーが起動したときなど）、ここで作る。
+    # 作り終えるまで task_status への書き込みは止まるが、起動できないよりはよい。
+    if not is_partitioned(cur, 'task_status') and not _has_index(cur, 'task_status_task_id_created_at_key'):
+        logger.warning(
+            "task_status_task_id_created_at_key is missing; building it while blocking writes. "
+            "Run migrate_partitions.py --table task_status --prepare-only before deploying to avoid this"
+        )
+        cur.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS task_status_task_id_created_at_key ON task_status (task_id, created_at)"
+        )
+    # 以降のパーティションは maintain_partitions が毎日作る
+    for table in PARTITION_KEYS:
+        if is_partitioned(cur, table):
+            ensure_partitions(cur, table, PARTITION_MONTHS_AHEAD, datetime.now(timezone.utc))
+        else:
+            logger.warning(f"{table} is not partitioned yet; run migrate_partitions.py")
+
+
+def move_images_to_blob_store(cur):
+    # 画像はブロブストアに移し、historyにはキーだけを持たせる
+    cur.execute('ALTER TABLE history ADD COLUMN IF NOT EXISTS image_key VARCHAR(64)')
+    cur.execute('ALTER TABLE history ADD COLUMN IF NOT EXISTS thumbnail_key VARCHAR(64)')
+    cur.execute('ALTER TABLE history ALTER COLUMN image_base64 DROP NOT NULL')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_history_user_timestamp ON history(user_id, timestamp DESC)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_task_status_user ON task_status(user_id, created_at DESC)')
+    # 完了したタスクの結果は history.explanation を参照する（result は旧データ用）
+    cur.execute('ALTER TABLE task_status ADD COLUMN IF NOT EXISTS history_id INTEGER')
+
+
+def add_followup_threads(cur):
+    # 再質問のスレッド（問題文は解析時に一度だけ書き起こし、以降はテキストだけで質問する）
+    # パーティション化した history の id だけを参照する外部キーは張れないので、history_id は参照のみ
+    cur.execute('ALTER TABLE history ADD COLUMN IF NOT EXISTS problem_text TEXT')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS history_messages (
+        id SERIAL PRIMARY KEY,
+        history_id INTEGER NOT NULL,
+        role VARCHAR(16) NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_history_messages_history ON history_messages(history_id, id)')
+    cur.execute('ALTER TABLE task_status ADD COLUMN IF NOT EXISTS message_id INTEGER')
+
+
+def add_school_daily_stats(cur):
+    # 学校単位のエクスポートと日別の集計
+    cur.execute('ALTER TABLE history ADD COLUMN IF NOT EXISTS grade_level VARCHAR(20)')
+    cur.execute('ALTER TABLE history ADD COLUMN IF NOT EXISTS processing_ms INTEGER')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_history_school_timestamp ON history(school_id, timestamp)')
+    cur.execute("SELECT to_regclass('school_daily_stats') IS NULL")
+    needs_stats_backfill = cur.fetchone()[0]
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS school_daily_stats (
+        school_id VARCHAR(255) NOT NULL,
+        day DATE NOT NULL,
+        grade_level VARCHAR(20) NOT NULL,
+        questions BIGINT NOT NULL DEFAULT 0,
+        processing_ms_sum BIGINT NOT NULL DEFAULT 0,
+        processing_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (school_id, day, grade_level)
+    )
+    ''')
+    # 集計は追加時だけ加算する（保存期間を過ぎた履歴を消しても統計は残す）
+    cur.execute('''
+    CREATE OR REPLACE FUNCTION school_daily_stats_update() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO school_daily_stats (school_id, day, grade_level, questions, processing_ms_sum, processing_count)
+        VALUES (
+            COALESCE(NEW.school_id, 'unknown'), (NEW.timestamp AT TIME ZONE %s)::date,
+            COALESCE(NEW.grade_level, 'unknown'), 1,
+            COALESCE(NEW.processing_ms, 0), (NEW.processing_ms IS NOT NULL)::int
+        )
+        ON CONFLICT (school_id, day, grade_level) DO UPDATE SET
+            questions = school_daily_stats.questions + 1,
+            processing_ms_sum = school_daily_stats.processing_ms_sum + EXCLUDED.processing_ms_sum,
+            processing_count = school_daily_stats.processing_count + EXCLUDED.processing_count;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    ''', (SCHOOL_TIMEZONE,))
+    cur.execute('DROP TRIGGER IF EXISTS trg_school_daily_stats ON history')
+    cur.execute('''
+    CREATE TRIGGER trg_school_daily_stats AFTER INSERT ON history
+    FOR EACH ROW EXECUTE FUNCTION school_daily_stats_update()
+    ''')
+    if needs_stats_backfill:
+        cur.execute('''
+        INSERT INTO school_daily_stats (school_id, day, grade_level, questions, processing_ms_sum, processing_count)
+        SELECT COALESCE(school_id, 'unknown'), (timestamp AT TIME ZONE %s)::date, COALESCE(grade_level, 'unknown'),
+               COUNT(*), COALESCE(SUM(processing_ms), 0), COUNT(processing_ms)
+        FROM history GROUP BY 1, 2, 3
+        ''', (SCHOOL_TIMEZONE,))
+
+
+def add_image_archive(cur):
+    # 古い画像の cold ストアへの移動（maintain_partitions）。移動前の行だけをインデックスに載せる
+    cur.execute('ALTER TABLE history ADD COLUMN IF NOT EXISTS image_archived_at TIMESTAMP WITH TIME ZONE')
+    cur.execute(
+        'CREATE INDEX IF NOT EXISTS idx_history_image_unarchived ON history(timestamp) '
+        'WHERE image_archived_at IS NULL'
+    )
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_history_image_key ON history(image_key)')
+
+
+def add_history_search(cur):
+    # 履歴の検索。以前はここで全ユーザー共通のn-gramインデックスをトランザクション内で作っていたが、
+    # 既存のデータベースでは作り終えるまで履歴の追加が止まり、検索も速くならなかった。
+    # インデックスはバージョン8（ユーザーごと）で作る（適用済みのデータベースの分は8が削除する）
+    cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+
+def add_history_counts(cur):
+    # ユーザーごとの履歴件数（/history のたびに COUNT(*) しないようにトリガーで維持する）
+    cur.execute("SELECT to_regclass('history_counts') IS NULL")
+    needs_backfill = cur.fetchone()[0]
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS history_counts (
+        user_id VARCHAR(255) PRIMARY KEY,
+        total BIGINT NOT NULL DEFAULT 0
+    )
+    ''')
+    cur.execute('''
+    CREATE OR REPLACE FUNCTION history_counts_update() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO history_counts (user_id, total) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET total = history_counts.total + 1;
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE history_counts SET total = total - 1 WHERE user_id = OLD.user_id;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    ''')
+    cur.execute('DROP TRIGGER IF EXISTS trg_history_counts ON history')
+    cur.execute('''
+    CREATE TRIGGER trg_history_counts AFTER INSERT OR DELETE ON history
+    FOR EACH ROW EXECUTE FUNCTION history_counts_update()
+    ''')
+    if needs_backfill:
+        cur.execute('''
+        INSERT INTO history_counts (user_id, total)
+        SELECT user_id, COUNT(*) FROM history GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET total = EXCLUDED.total
+        ''')
+
+
+def _index_state(cur, name):
+    """インデックスが有効なら True、作りかけ（無効）なら False、なければ None"""
+    cur.execute(
+        "SELECT x.indisvalid FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid WHERE c.relname = %s",
+        (name,)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def add_history_search_user_index(cur):
+    # 履歴の検索をユーザーごとのn-gramインデックスに替える。
+    # 通常はデプロイ前に prepare_history_search_index（init_db.py --prepare-only）で作ってある。
+    # 作られていなければここで作る。作り終えるまで履歴の追加は止まるが、空のデータベースなら一瞬で終わる。
+    cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    cur.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+    state = _index_state(cur, HISTORY_SEARCH_INDEX)
+    if not state:
+        if state is False:
+            cur.execute(f'DROP INDEX {HISTORY_SEARCH_INDEX}')
+        cur.execute("SELECT EXISTS (SELECT 1 FROM history LIMIT 1)")
+        if cur.fetchone()[0]:
+            logger.warning(
+                f"{HISTORY_SEARCH_INDEX} is missing; building it while blocking writes. "
+                "Run init_db.py --prepare-only before deploying to avoid this"
+            )
+        cur.execute(f'CREATE INDEX {HISTORY_SEARCH_INDEX} ON history USING gin ({HISTORY_SEARCH_INDEX_COLUMNS})')
+    cur.execute('DROP INDEX IF EXISTS idx_history_search_trgm')
+
+
+def prepare_history_search_index(conn):
+    """バージョン8のインデックスを履歴の追加を止めずに作る（デプロイ前に実行する）
+
+    パーティションテーブルには CREATE INDEX CONCURRENTLY を使えないので、親に ON ONLY で
+    無効なインデックスを作り、パーティションごとに CONCURRENTLY で作って ATTACH する。
+    すべて ATTACH すると親のインデックスが有効になる。途中で止まっても再実行すれば続きから進む。
+    """
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('history') IS NULL")
+            if cur.fetchone()[0] or _index_state(cur, HISTORY_SEARCH_INDEX):
+                return
+            cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cur.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+            if not is_partitioned(cur, 'history'):
+                if _index_state(cur, HISTORY_SEARCH_INDEX) is False:
+                    cur.execute(f'DROP INDEX CONCURRENTLY {HISTORY_SEARCH_INDEX}')
+                logger.info(f"Building {HISTORY_SEARCH_INDEX} concurrently ...")
+                cur.execute(
+                    f'CREATE INDEX CONCURRENTLY {HISTORY_SEARCH_INDEX} ON history '
+                    f'USING gin ({HISTORY_SEARCH_INDEX_COLUMNS})'
+                )
+                return
+            # 空の親テーブルだけに作るので一瞬で終わる（以降に作るパーティションにはPostgresが自動で作る）
+            cur.execute(
+                f'CREATE INDEX IF NOT EXISTS {HISTORY_SEARCH_INDEX} ON ONLY history '
+                f'USING gin ({HISTORY_SEARCH_INDEX_COLUMNS})'
+            )
+            cur.execute(
+                """
+                SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'history'::regclass
+                AND NOT EXISTS (
+                    SELECT 1 FROM pg_inherits ii
+                    JOIN pg_index x ON x.indexrelid = ii.inhrelid AND x.indrelid = c.oid
+                    WHERE ii.inhparent = to_regclass(%s)
+                )
+                """,
+                (HISTORY_SEARCH_INDEX,)
+            )
+            for (partition,) in cur.fetchall():
+                name = f"{partition}_search_user_trgm_idx"[:63]
+                state = _index_state(cur, name)
+                if state is False:
+                    # 中断した CONCURRENTLY の作成は無効なインデックスを残すので作り直す
+                    cur.execute(f'DROP INDEX CONCURRENTLY {name}')
+                if not state:
+                    logger.info(f"Building {name} concurrently ...")
+                    cur.execute(f'CREATE INDEX CONCURRENTLY {name} ON {partition} USING gin ({HISTORY_SEARCH_INDEX_COLUMNS})')
+                cur.execute(f'ALTER INDEX {HISTORY_SEARCH_INDEX} ATTACH PARTITION {name}')
+            logger.info(f"{HISTORY_SEARCH_INDEX} is valid: {_index_state(cur, HISTORY_SEARCH_INDEX)}")
+    finally:
+        conn.autocommit = False
+
+
+# (バージョン, 名前, 関数)。バージョンは1から連番で、適用済みのものは変更しない
+MIGRATIONS = [
+    (1, 'create_tables', create_tables),
+    (2, 'move_images_to_blob_store', move_images_to_blob_store),
+    (3, 'add_followup_threads', add_followup_threads),
+    (4, 'add_school_daily_stats', add_school_daily_stats),
+    (5, 'add_image_archive', add_image_archive),
+    (6, 'add_history_search', add_history_search),
+    (7, 'add_history_counts', add_history_counts),
+    (8, 'add_history_search_user_index', add_history_search_user_index),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(cur):
+    """適用済みの最新バージョン（まだ何も適用していなければ0）"""
+    cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return cur.fetchone()[0]
+
+
+def migrate(conn=None):
+    """未適用のマイグレーションを適用し、適用したバージョンのリストを返す"""
+    own_connection = conn is None
+    if own_connection:
+        database_url = os.getenv('DATABASE_URL')
+        if not database_url:
+            raise ValueError("DATABASE_URL environment variable is not set.")
+        conn = psycopg2.connect(database_url)
+    try:
+        with conn.cursor() as cur:
+            version = current_version(cur)
+        conn.commit()
+        if version >= LATEST_VERSION:
+            logger.info(f"Database schema is up to date (version {version})")
+            return []
+
+        applied = []
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        try:
+            with conn.cursor() as cur:
+                cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                )
+                ''')
+                # ロックを待つ間に他のプロセスが適用していれば、その続きから
+                version = current_version(cur)
+            conn.commit()
+            for number, name, apply in MIGRATIONS:
+                if number <= version:
+                    continue
+                started = datetime.now()
+                with conn:
+                    with conn.cursor() as cur:
+                        apply(cur)
+                        cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (number, name))
+                logger.info(f"Applied migration {number} {name} in {(datetime.now() - started).total_seconds():.2f}s")
+                applied.append(number)
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+            conn.commit()
+        return applied
+    finally:
+        if own_connection:
+            conn.close()
@@ -0,0 +1,116 @@
+# partitions.py - history / task_status の月単位のレンジパーティションの管理
+#
+# パーティションは UTC の月初で区切り、<テーブル名>_pYYYYMM と名付ける。
+# 範囲外の行を受け止める DEFAULT パーティションも作るが、通常は空のままにしておく
+# （DEFAULT に行があると、その月のパーティションを作れなくなる）。
+
+import os
+import re
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# パーティション化するテーブルとパーティションキーの列
+PARTITION_KEYS = {
+    'history': 'timestamp',
+    'task_status': 'created_at',
+}
+
+# 今月から何か月先までパーティションを作っておくか（maintain_partitions が毎日補充する）
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', 3))
+
+# 保存期間を過ぎて切り離したパーティションの移動先（pg_dump -n archive で退避してから消す）
+ARCHIVE_SCHEMA = 'archive'
+
+_BOUND_PATTERN = re.compile(r"FROM \((.+)\) TO \((.+)\)")
+
+
+def month_start(moment):
+    """その時刻を含む月の月初（UTC）"""
+    moment = moment.astimezone(timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y%m}"
+
+
+def default_partition_name(table):
+    return f"{table}_default"
+
+
+def is_partitioned(cur, table):
+    """テーブルがパーティション化済みか（移行前なら False）"""
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))", (table,))
+    return cur.fetchone()[0]
+
+
+def _parse_bound(value):
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+
+def list_partitions(cur, table):
+    """(名前, 下限, 上限) のリストを古い順に返す（端のない側は None、DEFAULTは含めない）"""
+    cur.execute(
+        """
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        """,
+        (table,)
+    )
+    partitions = []
+    for name, bound in cur.fetchall():
+        match = _BOUND_PATTERN.search(bound)
+        if match:
+            partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+    return sorted(partitions, key=lambda p: p[1] or datetime.min.replace(tzinfo=timezone.utc))
+
+
+def _overlaps(start, end, lower, upper):
+    return (lower is None or lower < end) and (upper is None or start < upper)
+
+
+def ensure_partitions(cur, table, months_ahead, now):
+    """今月から months_ahead か月先までのパーティションと DEFAULT パーティションを作り、作った名前を返す
+
+    移行前の行をまとめたパーティション（下限なし）と範囲が重なる月は作らない。
+    """
+    existing = list_partitions(cur, table)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {default_partition_name(table)} PARTITION OF {table} DEFAULT")
+    created = []
+    month = month_start(now)
+    for _ in range(months_ahead + 1):
+        end = add_months(month, 1)
+        if not any(_overlaps(month, end, lower, upper) for _, lower, upper in existing):
+            name = partition_name(table, month)
+            cur.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", (month, end))
+            created.append(name)
+        month = end
+    if created:
+        logger.info(f"Created partitions {', '.join(created)}")
+    return created
+
+
+def expired_partitions(cur, table, cutoff):
+    """中の行がすべて cutoff より古いパーティションの名前"""
+    return [name for name, _, upper in list_partitions(cur, table) if upper is not None and upper <= cutoff]
+
+
+def retire_partition(cur, table, name, mode='drop'):
+    """パーティションを切り離し、mode='drop' なら削除、'archive' なら archive スキーマへ移す"""
+    cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+    if mode == 'archive':
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}")
+        cur.execute(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}")
+    else:
+        cur.execute(f"DROP TABLE {name}")
+    logger.info(f"Retired partition {name} ({mode})")
@@ -0,0 +1,262 @@
+# resilience.py - タスクのリトライ判定とOpenAI呼び出しのサーキットブレーカー
+
+import os
+import time
+import uuid
+import random
+import logging
+from contextlib import contextmanager
+from functools import lru_cache
+
+import redis
+from PIL import Image, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+# リトライ間隔（秒）: RETRY_BASE_DELAY * 2^回数 を上限 RETRY_MAX_DELAY で頭打ちにし、ジッターを加える
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 10))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 300))
+
+# openai の import は重いので、例外の分類が必要になったときに初めて読み込む
+# （OpenAIの例外が起きる時点でクライアントが openai を import 済みなので、実質的な追加の費用はない）
+
+class InvalidInputError(ValueError):
+    """タスクの入力そのものの誤り（不正な画像参照、削除された履歴など）"""
+
+
+@lru_cache(maxsize=None)
+def permanent_errors():
+    """直しようがない入力の誤り（リトライしても結果は変わらない）
+
+    ValueError や KeyError のような一般的な例外は内部の不具合や一時的な不整合でも起きるので含めず、
+    入力の誤りは InvalidInputError で明示する。
+    """
+    import openai
+    return (
+        UnidentifiedImageError,
+        Image.DecompressionBombError,
+        FileNotFoundError,
+        InvalidInputError,
+        openai.BadRequestError,
+        openai.AuthenticationError,
+        openai.PermissionDeniedError,
+        openai.NotFoundError,
+        openai.UnprocessableEntityError,
+    )
+
+
+@lru_cache(maxsize=None)
+def upstream_failures():
+    """上流の不調とみなしてサーキットブレーカーに数える失敗"""
+    import openai
+    return (
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+
+class CircuitOpenError(RuntimeError):
+    """サーキットブレーカーが開いていて呼び出しを行わなかった"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} は一時的に利用できません（{retry_after:.0f}秒後に再試行）")
+        self.retry_after = retry_after
+
+
+def is_retryable(exc):
+    """リトライする価値のある例外か"""
+    if isinstance(exc, permanent_errors()):
+        return False
+    import openai
+    if isinstance(exc, openai.APIStatusError):
+        # 上で挙げていない4xx（408・409・429以外）はリクエスト自体の誤り
+        return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    # タイムアウト・接続エラー・DBやRedisの瞬断など、分類できないものはリトライする
+    return True
+
+
+def user_error_message(exc):
+    """タスクが失敗したときに利用者に見せるメッセージ
+
+    内部の例外の文字列（SQL・接続先・スタックの一部など）は見せず、ログにだけ残す。
+    """
+    if isinstance(exc, (UnidentifiedImageError, Image.DecompressionBombError)):
+        return "画像を読み込めませんでした。別の画像でお試しください。"
+    if isinstance(exc, CircuitOpenError):
+        return "解説サービスが混み合っています。しばらくしてからもう一度お試しください。"
+    if isinstance(exc, InvalidInputError):
+        # 利用者向けに書いたメッセージだけを持つ
+        return str(exc)
+    if isinstance(exc, FileNotFoundError):
+        return "アップロードされた画像が見つかりませんでした。もう一度アップロードしてください。"
+    return "処理中にエラーが発生しました。しばらくしてからもう一度お試しください。"
+
+
+def retry_after_hint(exc):
+    """例外から上流が指定した待ち時間（秒）を取り出す（なければNone）"""
+    if isinstance(exc, CircuitOpenError):
+        return exc.retry_after
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        # HTTP日付形式は使われないので無視する
+        return None
+    return None
+
+
+def retry_countdown(exc, retries):
+    """次のリトライまでの秒数（指数バックオフ + ジッター、上流の指定があればそれ以上）"""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** retries))
+    countdown = random.uniform(delay / 2, delay)
+    hint = retry_after_hint(exc)
+    if hint is not None:
+        countdown = max(countdown, min(hint, RETRY_MAX_DELAY))
+    return round(countdown, 1)
+
+
+class CircuitBreaker:
+    """全ワーカーで共有するサーキットブレーカー（状態はRedisのハッシュ）
+
+    window 秒の間に min_calls 回以上呼び出し、そのうち failure_ratio 以上が
+    上流の不調で失敗したら cooldown 秒間開いて、呼び出しを即座に失敗させる。
+    cooldown 後は1件だけ試しに通し（半開）、成功すれば閉じ、失敗すればまた開く。
+    """
+
+    ALLOW_SCRIPT = """
+    if redis.call('HGET', KEYS[1], 'state') ~= 'open' then
+        return 0
+    end
+    local now = tonumber(ARGV[1])
+    local open_until = tonumber(redis.call('HGET', KEYS[1], 'open_until'))
+    if now < open_until then
+        return math.ceil((open_until - now) * 1000)
+    end
+    if redis.call('SET', KEYS[2], ARGV[4], 'NX', 'PX', ARGV[2]) then
+        return -1
+    end
+    return tonumber(ARGV[3])
+    """
+
+    RELEASE_PROBE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    RECORD_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local failed = ARGV[2] == '1'
+    if redis.call('HGET', KEYS[1], 'state') == 'open' then
+        if now < tonumber(redis.call('HGET', KEYS[1], 'open_until')) then
+            return 0
+        end
+        -- 半開のときの試しの呼び出しの結果
+        redis.call('DEL', KEYS[2])
+        if failed then
+            redis.call('HSET', KEYS[1], 'open_until', now + tonumber(ARGV[5]))
+            return 1
+        end
+        redis.call('DEL', KEYS[1], KEYS[3])
+        return -1
+    end
+    local calls = redis.call('HINCRBY', KEYS[3], 'calls', 1)
+    if calls == 1 then
+        redis.call('PEXPIRE', KEYS[3], ARGV[3])
+    end
+    if not failed then
+        return 0
+    end
+    local failures = redis.call('HINCRBY', KEYS[3], 'failures', 1)
+    if calls >= tonumber(ARGV[4]) and failures >= calls * tonumber(ARGV[6]) then
+        redis.call('HSET', KEYS[1], 'state', 'open', 'open_until', now + tonumber(ARGV[5]))
+        redis.call('DEL', KEYS[3])
+        return 1
+    end
+    return 0
+    """
+
+    def __init__(self, redis_client, name, window=30, min_calls=10, failure_ratio=0.5, cooldown=30, probe_timeout=90):
+        self.redis = redis_client
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.keys = [f"circuit:{name}", f"circuit:{name}:probe", f"circuit:{name}:window"]
+        self._allow = redis_client.register_script(self.ALLOW_SCRIPT)
+        self._record = redis_client.register_script(self.RECORD_SCRIPT)
+        self._release = redis_client.register_script(self.RELEASE_PROBE_SCRIPT)
+
+    def _check(self):
+        """開いていれば CircuitOpenError を送出する。半開の試しの呼び出しになったらそのトークンを返す"""
+        token = uuid.uuid4().hex
+        try:
+            wait_ms = self._allow(keys=self.keys, args=[
+                time.time(), int(self.probe_timeout * 1000), int(self.cooldown * 1000), token,
+            ])
+        except redis.RedisError as e:
+            # Redisが使えないときはブレーカーなしで通す
+            logger.warning(f"Circuit breaker {self.name} unavailable: {e}")
+            return None
+        if wait_ms == -1:
+            return token
+        if wait_ms:
+            raise CircuitOpenError(self.name, wait_ms / 1000)
+        return None
+
+    def _release_probe(self, token):
+        try:
+            self._release(keys=[self.keys[1]], args=[token])
+        except redis.RedisError as e:
+            logger.warning(f"Circuit breaker {self.name} unavailable: {e}")
+
+    def _report(self, failed):
+        try:
+            changed = self._record(keys=self.keys, args=[
+                time.time(), '1' if failed else '0', int(self.window * 1000),
+                self.min_calls, self.cooldown, self.failure_ratio,
+            ])
+        except redis.RedisError as e:
+            logger.warning(f"Circuit breaker {self.name} unavailable: {e}")
+            return
+        if changed == 1:
+            logger.error(f"Circuit breaker {self.name} opened for {self.cooldown}s")
+        elif changed == -1:
+            logger.info(f"Circuit breaker {self.name} closed")
+
+    @contextmanager
+    def guard(self):
+        """開いていれば CircuitOpenError を送出し、閉じていれば呼び出しの結果を記録する
+
+        入力の誤りなど、上流の不調ではない失敗は成否に数えない。
+        """
+        probe_token = self._check()
+        try:
+            yield
+        except Exception as e:
+            if isinstance(e, upstream_failures()):
+                self._report(failed=True)
+            elif probe_token:
+                # 上流の状態がわからない失敗なので、試しの枠を返して次の呼び出しに判定を任せる
+                self._release_probe(probe_token)
+            raise
+        else:
+            self._report(failed=False)
+
+    def state(self):
+        """ダッシュボード用の現在の状態"""
+        state = self.redis.hgetall(self.keys[0])
+        if state.get('state') != 'open':
+            return {"state": "closed"}
+        remaining = float(state['open_until']) - time.time()
+        return {"state": "open" if remaining > 0 else "half_open", "retry_after": max(0.0, round(remaining, 1))}
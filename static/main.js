@@ -24,6 +24,7 @@ document.getElementById('qform').addEventListener('submit', async function(e) {
     
     formData.append('school_id', 'default_school');
     formData.append('user_id', 'default_user');
+    formData.append('deadline_seconds', TASK_WAIT_SECONDS);
 
     const submitBtn = e.target.querySelector('button[type="submit"]');
     const originalText = submitBtn.textContent;
@@ -31,9 +32,11 @@ document.getElementById('qform').addEventListener('submit', async function(e) {
     submitBtn.disabled = true;
 
     try {
+        const idempotencyKey = await uploadIdempotencyKey(file, selectedGrade);
         const uploadResponse = await fetch('/upload', {
             method: 'POST',
-            body: formData
+            body: formData,
+            headers: idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : {}
         });
 
         if (!uploadResponse.ok) {
@@ -48,17 +51,19 @@ document.getElementById('qform').addEventListener('submit', async function(e) {
         }
 
         const taskId = uploadData.task_id;
-        const result = await pollTaskStatus(taskId);
+        const result = await waitForTaskResult(taskId, updateLiveExplanation);
 
+        hideLiveExplanation();
         if (result.status === 'completed') {
             alert('解析が完了しました！');
-            await loadHistory();
+            await prependLatestHistory();
             fileInput.value = '';
         } else {
             throw new Error(result.error || '解析中に不明なエラーが発生しました');
         }
 
     } catch (error) {
+        hideLiveExplanation();
         alert('エラー: ' + error.message);
         console.error(error);
     } finally {
@@ -67,13 +72,95 @@ document.getElementById('qform').addEventListener('submit', async function(e) {
     }
 });
 
-async function pollTaskStatus(taskId) {
-    const maxAttempts = 30;
+// 同じ画像・学年の再送は受け付け済みのタスクにまとめる（タイムアウト後に送り直しても二重に解析しない）
+async function uploadIdempotencyKey(file, grade) {
+    if (!window.crypto || !window.crypto.subtle) {
+        return null;
+    }
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    const hex = Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    return `${hex}:${grade}`;
+}
+
+// 結果を待つ時間（秒）。サーバーにも伝え、これを過ぎても始まっていないタスクは実行されない
+const TASK_WAIT_SECONDS = 240;
+
+// タスクの完了を待つ（SSEが使えなければロングポーリング）
+// onEvent には途中経過（processing / streaming など）が渡される
+async function waitForTaskResult(taskId, onEvent) {
+    const deadline = Date.now() + TASK_WAIT_SECONDS * 1000;
+    if (window.EventSource) {
+        try {
+            return await waitForTaskEvents(taskId, onEvent);
+        } catch (error) {
+            console.warn('SSEでの待機に失敗したためロングポーリングに切り替えます:', error);
+        }
+    }
+    return pollTaskStatus(taskId, deadline);
+}
+
+// ストリーミングの差分を組み立てる（offset は先頭からの文字数なので重複しても崩れない）
+function applyStreamEvent(text, data) {
+    if (data.status === 'processing' || data.status === 'retrying') {
+        return '';
+    }
+    if (data.status === 'streaming') {
+        return Array.from(text).slice(0, data.offset).join('') + data.delta;
+    }
+    return text;
+}
+
+// 生成中の解説を表示する
+let liveText = '';
+
+function updateLiveExplanation(data) {
+    const liveDiv = document.getElementById('liveExplanation');
+    liveText = applyStreamEvent(liveText, data);
+    liveDiv.textContent = liveText;
+    liveDiv.style.display = liveText ? 'block' : 'none';
+}
+
+function hideLiveExplanation() {
+    liveText = '';
+    const liveDiv = document.getElementById('liveExplanation');
+    liveDiv.textContent = '';
+    liveDiv.style.display = 'none';
+}
+
+function waitForTaskEvents(taskId, onEvent) {
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`/task/${taskId}/events`);
+
+        source.onmessage = (event) => {
+            const data = JSON.parse(event.data);
+            if (onEvent) {
+                onEvent(data);
+            }
+            if (data.status === 'completed' || data.status === 'failed') {
+                source.close();
+                resolve(data);
+            }
+        };
+
+        source.addEventListener('end', () => {
+            source.close();
+            reject(new Error('解析がタイムアウトしました。'));
+        });
+
+        source.onerror = () => {
+            source.close();
+            reject(new Error('イベントストリームの接続に失敗しました'));
+        };
+    });
+}
+
+async function pollTaskStatus(taskId, deadline) {
     const interval = 3000;
 
-    for (let i = 0; i < maxAttempts; i++) {
+    while (Date.now() < deadline) {
+        const waitSeconds = Math.max(1, Math.min(25, Math.floor((deadline - Date.now()) / 1000)));
         try {
-            const response = await fetch(`/task/${taskId}`);
+            const response = await fetch(`/task/${taskId}?wait=${waitSeconds}`);
             if (!response.ok) {
                 await new Promise(resolve => setTimeout(resolve, interval));
                 continue;
@@ -84,8 +171,12 @@ async function pollTaskStatus(taskId) {
             if (data.status === 'completed' || data.status === 'failed') {
                 return data;
             }
-            
-            await new Promise(resolve => setTimeout(resolve, interval));
+
+            // サーバーが混み合っていて待たずに返したときは、指定された秒数おいてから再確認する
+            const retryAfter = Number(response.headers.get('Retry-After'));
+            if (retryAfter > 0) {
+                await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+            }
 
         } catch (error) {
             console.error('ステータス確認中にエラー:', error);
@@ -96,72 +187,204 @@ async function pollTaskStatus(taskId) {
     throw new Error('解析がタイムアウトしました。しばらくしてからもう一度お試しください。');
 }
 
+// 履歴はカーソルで少しずつ読み込む
+const HISTORY_PAGE_SIZE = 20;
+let historyCursor = null;
+let historyTotal = 0;
+let renderedHistoryCount = 0;
+// 検索中は一覧の代わりに検索結果を同じ形で表示する（空文字なら通常の一覧）
+let historySearchQuery = '';
+
+async function fetchHistoryPage(limit, cursor) {
+    let url = historySearchQuery
+        ? `/history/search?user_id=default_user&limit=${limit}&q=${encodeURIComponent(historySearchQuery)}`
+        : `/history?user_id=default_user&limit=${limit}`;
+    if (cursor) {
+        url += `&cursor=${encodeURIComponent(cursor)}`;
+    }
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(`履歴の取得に失敗しました (HTTP ${response.status})`);
+    }
+    return response.json();
+}
+
+// 一覧は新しい順の通し番号、検索結果は上からの順位
+function nextHistoryNumber() {
+    return historySearchQuery ? renderedHistoryCount + 1 : historyTotal - renderedHistoryCount;
+}
+
+function renderHistoryItem(item, number) {
+    const itemDiv = document.createElement('div');
+    itemDiv.dataset.historyId = item.id;
+    const timestamp = new Date(item.timestamp).toLocaleString('ja-JP');
+
+    itemDiv.innerHTML = `
+        <div style="margin-bottom: 15px;">
+            <strong>${historySearchQuery ? '検索結果' : '質問'} ${number}</strong> 
+            <small>(${timestamp})</small>
+        </div>
+        <a href="${item.image_url}" target="_blank" rel="noopener">
+            <img src="${item.thumbnail_url}" 
+                 alt="質問画像"
+                 loading="lazy"
+                 style="max-width: 300px; margin-bottom: 10px; border-radius: 5px;">
+        </a>
+        <div class="explanation" id="explanation-${item.id}"></div>
+        ${item.truncated ? `<button class="read-more-btn re-question-btn" data-history-id="${item.id}">続きを読む</button>` : ''}
+        
+        <button class="re-question-btn" data-history-id="${item.id}">さらに質問する</button>
+        
+        <div class="re-question-form" id="form-${item.id}" style="display: none;">
+            <textarea placeholder="わからなかったことを詳しく書いてください。"></textarea>
+            <button class="re-question-submit-btn" data-history-id="${item.id}">送信</button>
+            <div class="loading-indicator">回答を生成中...</div>
+        </div>
+        
+        <div class="re-question-answer" id="answer-${item.id}"></div>
+    `;
+    // 解説は利用者の入力を含みうるので、HTMLとして解釈させない
+    itemDiv.querySelector('.explanation').textContent = `${item.preview}${item.truncated ? '…' : ''}`;
+    return itemDiv;
+}
+
+async function typesetMath(element) {
+    if (window.MathJax && typeof window.MathJax.typesetPromise === 'function') {
+        await MathJax.typesetPromise([element]);
+    }
+}
+
+function updateLoadMoreButton() {
+    document.getElementById('loadMoreHistory').style.display = historyCursor ? 'block' : 'none';
+}
+
 async function loadHistory() {
+    const historyDiv = document.getElementById('history');
     try {
-        const response = await fetch('/history?user_id=default_user&limit=20');
-        if (!response.ok) {
-            throw new Error(`履歴の取得に失敗しました (HTTP ${response.status})`);
-        }
-        
-        const data = await response.json();
+        const data = await fetchHistoryPage(HISTORY_PAGE_SIZE, null);
         const history = data.history || [];
+        historyTotal = data.total;
+        historyCursor = data.next_cursor;
+        renderedHistoryCount = 0;
 
-        const historyDiv = document.getElementById('history');
         historyDiv.innerHTML = '';
 
         if (history.length === 0) {
-            historyDiv.innerHTML = '<p>まだ質問履歴はありません</p>';
+            historyDiv.innerHTML = historySearchQuery
+                ? '<p>該当する履歴はありません</p>'
+                : '<p>まだ質問履歴はありません</p>';
+            updateLoadMoreButton();
             return;
         }
 
-        history.forEach((item, index) => {
-            const itemDiv = document.createElement('div');
-            const timestamp = new Date(item.timestamp).toLocaleString('ja-JP');
-
-            itemDiv.innerHTML = `
-                <div style="margin-bottom: 15px;">
-                    <strong>質問 ${data.total - index}</strong> 
-                    <small>(${timestamp})</small>
-                </div>
-                <img src="data:image/jpeg;base64,${item.image_base64}" 
-                     alt="質問画像"
-                     style="max-width: 300px; margin-bottom: 10px; border-radius: 5px;">
-                <div class="explanation">${item.explanation}</div>
-                
-                <button class="re-question-btn" data-history-id="${item.id}">さらに質問する</button>
-                
-                <div class="re-question-form" id="form-${item.id}" style="display: none;">
-                    <textarea placeholder="わからなかったことを詳しく書いてください。"></textarea>
-                    <button class="re-question-submit-btn" data-history-id="${item.id}">送信</button>
-                    <div class="loading-indicator">回答を生成中...</div>
-                </div>
-                
-                <div class="re-question-answer" id="answer-${item.id}"></div>
-            `;
-            historyDiv.appendChild(itemDiv);
+        history.forEach(item => {
+            historyDiv.appendChild(renderHistoryItem(item, nextHistoryNumber()));
+            renderedHistoryCount++;
         });
+        updateLoadMoreButton();
 
-        if (window.MathJax && typeof window.MathJax.typesetPromise === 'function') {
-            await MathJax.typesetPromise([historyDiv]);
-        }
+        await typesetMath(historyDiv);
 
     } catch (error) {
         console.error('履歴の読み込みに失敗しました:', error);
-        const historyDiv = document.getElementById('history');
         historyDiv.innerHTML = '<p style="color: red;">履歴の読み込みに失敗しました。</p>';
     }
 }
 
+async function loadMoreHistory() {
+    if (!historyCursor) return;
+    const historyDiv = document.getElementById('history');
+    try {
+        const data = await fetchHistoryPage(HISTORY_PAGE_SIZE, historyCursor);
+        historyCursor = data.next_cursor;
+        (data.history || []).forEach(item => {
+            const itemDiv = renderHistoryItem(item, nextHistoryNumber());
+            renderedHistoryCount++;
+            historyDiv.appendChild(itemDiv);
+        });
+        updateLoadMoreButton();
+        await typesetMath(historyDiv);
+    } catch (error) {
+        console.error('履歴の読み込みに失敗しました:', error);
+    }
+}
+
+// アップロード後は一覧を読み直さず、最新の1件だけを先頭に追加する
+async function prependLatestHistory() {
+    const historyDiv = document.getElementById('history');
+    if (historySearchQuery) {
+        // 検索結果を表示中なら検索を解除して一覧に戻す
+        document.getElementById('historySearchInput').value = '';
+        historySearchQuery = '';
+        await loadHistory();
+        return;
+    }
+    try {
+        const data = await fetchHistoryPage(1, null);
+        const latest = (data.history || [])[0];
+        if (!latest || historyDiv.querySelector(`[data-history-id="${latest.id}"]`)) {
+            return;
+        }
+        if (renderedHistoryCount === 0) {
+            historyDiv.innerHTML = '';
+        }
+        historyTotal = data.total;
+        renderedHistoryCount++;
+        const itemDiv = renderHistoryItem(latest, historyTotal);
+        historyDiv.insertBefore(itemDiv, historyDiv.firstChild);
+        await typesetMath(itemDiv);
+    } catch (error) {
+        console.error('履歴の更新に失敗しました:', error);
+        await loadHistory();
+    }
+}
+
+async function showFullExplanation(historyId, button) {
+    button.disabled = true;
+    try {
+        const response = await fetch(`/history/${historyId}?user_id=default_user`);
+        if (!response.ok) {
+            throw new Error(`履歴の取得に失敗しました (HTTP ${response.status})`);
+        }
+        const data = await response.json();
+        const explanationDiv = document.getElementById(`explanation-${historyId}`);
+        explanationDiv.textContent = data.explanation;
+        button.remove();
+        await typesetMath(explanationDiv);
+    } catch (error) {
+        console.error(error);
+        button.disabled = false;
+    }
+}
+
 function setupEventListeners() {
     const historyDiv = document.getElementById('history');
 
+    document.getElementById('loadMoreHistory').addEventListener('click', loadMoreHistory);
+
+    document.getElementById('historySearch').addEventListener('submit', async (e) => {
+        e.preventDefault();
+        historySearchQuery = document.getElementById('historySearchInput').value.trim();
+        await loadHistory();
+    });
+
     historyDiv.addEventListener('click', async (e) => {
+        // 「続きを読む」ボタンが押された場合
+        if (e.target.classList.contains('read-more-btn')) {
+            await showFullExplanation(e.target.dataset.historyId, e.target);
+            return;
+        }
+
         // 「さらに質問する」ボタンが押された場合
         if (e.target.classList.contains('re-question-btn')) {
             const historyId = e.target.dataset.historyId;
             const form = document.getElementById(`form-${historyId}`);
             if (form) {
                 form.style.display = form.style.display === 'none' ? 'block' : 'none';
+                if (form.style.display === 'block' && !form.dataset.threadLoaded) {
+                    form.dataset.threadLoaded = 'true';
+                    await loadThread(historyId);
+                }
             }
         }
 
@@ -173,6 +396,28 @@ function setupEventListeners() {
     });
 }
 
+// これまでの再質問のやり取りを表示する
+function appendThreadMessage(answerDiv, role, content) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = role === 'user' ? 'thread-question' : 'thread-answer';
+    messageDiv.textContent = content;
+    answerDiv.appendChild(messageDiv);
+    return messageDiv;
+}
+
+async function loadThread(historyId) {
+    const answerDiv = document.getElementById(`answer-${historyId}`);
+    try {
+        const response = await fetch(`/history/${historyId}/messages?user_id=default_user`);
+        if (!response.ok) return;
+        const data = await response.json();
+        data.messages.forEach(message => appendThreadMessage(answerDiv, message.role, message.content));
+        await typesetMath(answerDiv);
+    } catch (error) {
+        console.error('Failed to load thread:', error);
+    }
+}
+
 async function handleReQuestionSubmit(historyId) {
     const form = document.getElementById(`form-${historyId}`);
     const textarea = form.querySelector('textarea');
@@ -188,7 +433,6 @@ async function handleReQuestionSubmit(historyId) {
 
     submitBtn.disabled = true;
     loadingIndicator.style.display = 'block';
-    answerDiv.innerHTML = '';
 
     try {
         const response = await fetch('/api/re-question', {
@@ -198,7 +442,9 @@ async function handleReQuestionSubmit(historyId) {
             },
             body: JSON.stringify({
                 history_id: historyId,
-                question_text: questionText
+                question_text: questionText,
+                user_id: 'default_user',
+                deadline_seconds: TASK_WAIT_SECONDS
             })
         });
 
@@ -207,18 +453,28 @@ async function handleReQuestionSubmit(historyId) {
             throw new Error(errorData.error || 'サーバーエラーが発生しました。');
         }
 
+        // 回答はタスクとして生成されるので、解析と同じように途中経過を受け取って表示する
         const data = await response.json();
-        answerDiv.textContent = data.answer;
-        
-        if (window.MathJax && typeof window.MathJax.typesetPromise === 'function') {
-            await MathJax.typesetPromise([answerDiv]);
+        appendThreadMessage(answerDiv, 'user', questionText);
+        const currentAnswer = appendThreadMessage(answerDiv, 'assistant', '');
+        textarea.value = '';
+
+        let answerText = '';
+        const result = await waitForTaskResult(data.task_id, (event) => {
+            answerText = applyStreamEvent(answerText, event);
+            currentAnswer.textContent = answerText;
+        });
+        if (result.status !== 'completed') {
+            throw new Error(result.error || '再質問の処理中にエラーが発生しました');
         }
-        
-        textarea.value = ''; // テキストエリアをクリア
-        form.style.display = 'none'; // フォームを非表示
+        currentAnswer.textContent = result.result;
+        await typesetMath(currentAnswer);
 
     } catch (error) {
-        answerDiv.innerHTML = `<p style="color: red;">エラー: ${error.message}</p>`;
+        const errorP = document.createElement('p');
+        errorP.style.color = 'red';
+        errorP.textContent = `エラー: ${error.message}`;
+        answerDiv.appendChild(errorP);
     } finally {
         submitBtn.disabled = false;
         loadingIndicator.style.display = 'none';
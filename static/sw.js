@@ -1,5 +1,5 @@
 // Service Worker - sw.js
-const CACHE_NAME = 'study-support-v2';
+const CACHE_NAME = 'study-support-v3';
 const urlsToCache = [
   '/',
   '/static/main.js',
@@ -41,6 +41,11 @@ self.addEventListener('fetch', event => {
     return;
   }
 
+  // SSEのストリームはService Workerを通さない
+  if (url.pathname.endsWith('/events')) {
+    return;
+  }
+
   // APIエンドポイントはネットワークファースト戦略
   if (networkFirstUrls.some(path => url.pathname.includes(path))) {
     event.respondWith(networkFirst(request));